@@ -0,0 +1,95 @@
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from smartcity.traffic.config import CONFIG
+from smartcity.traffic.rolling import rolling_mad, rolling_quantiles, run_length
+
+
+def synthetic_counts(minutes: int, seed: int = 0) -> pd.Series:
+    rng = np.random.default_rng(seed)
+    tod = np.arange(minutes) % 1440
+    counts = rng.poisson(3 + 8 * np.sin(np.pi * tod / 1440) ** 2).astype("float32")
+
+    for start in rng.integers(0, minutes - 60, minutes // 2000):
+        counts[start:start + rng.integers(3, 40)] = 0
+    counts[rng.integers(0, minutes, minutes // 500)] = rng.integers(20, 60, minutes // 500)
+    counts[rng.integers(0, minutes, minutes // 1000)] = np.nan
+
+    return pd.Series(counts)
+
+
+def pandas_flags(counts: pd.Series) -> dict:
+    n = CONFIG["spike_window_minutes"]
+    diffs = counts.diff()
+    rolling_med = diffs.rolling(window=n, min_periods=5).median()
+    mad = (diffs - rolling_med).abs().rolling(window=n, min_periods=5).median()
+    with np.errstate(invalid="ignore"):
+        spike = (diffs.abs() > CONFIG["spike_mad_multiplier"] * mad).to_numpy()
+
+    q75 = counts.rolling(window=60, min_periods=20).quantile(0.75)
+    q10 = counts.rolling(window=60, min_periods=20).quantile(0.10)
+    cliff = ((counts.shift(1) > q75) & (counts < q10)).to_numpy()
+
+    zero = (counts == 0).astype(float)
+    w = CONFIG["zero_run_soft_minutes"]
+    zero_soft = zero.rolling(window=w, min_periods=w).sum().fillna(0).ge(w).to_numpy()
+    return {"spike": spike, "cliff": cliff, "zero_run_soft": zero_soft}
+
+
+def kernel_flags(counts: pd.Series) -> dict:
+    values = counts.to_numpy()
+    diffs = np.empty_like(values)
+    diffs[0] = np.nan
+    diffs[1:] = values[1:] - values[:-1]
+    _, mad = rolling_mad(diffs, CONFIG["spike_window_minutes"], 5)
+    with np.errstate(invalid="ignore"):
+        spike = np.abs(diffs) > CONFIG["spike_mad_multiplier"] * mad
+
+    q75, q10 = rolling_quantiles(values, (0.75, 0.10), 60, 20)
+    prev = np.concatenate([[np.nan], values[:-1]])
+    with np.errstate(invalid="ignore"):
+        cliff = (prev > q75) & (values < q10)
+
+    zero_soft = run_length(values == 0) >= CONFIG["zero_run_soft_minutes"]
+    return {"spike": spike, "cliff": cliff, "zero_run_soft": zero_soft}
+
+
+def timed(func, counts, repeat):
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(counts)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark rolling kernels against pandas rolling for the cleaning detectors."
+    )
+
+    parser.add_argument("--minutes", type=int, default=525_600, help="Series length (default: one year of minutes).")
+    parser.add_argument("--repeat", type=int, default=3, help="Timing repetitions (best is reported).")
+
+    args = parser.parse_args()
+
+    counts = synthetic_counts(args.minutes)
+
+    t_pandas, ref = timed(pandas_flags, counts, args.repeat)
+    t_kernel, got = timed(kernel_flags, counts, args.repeat)
+
+    print(f"Rows: {len(counts)}")
+    print(f"pandas rolling: {t_pandas:.3f}s")
+    print(f"rolling kernels: {t_kernel:.3f}s")
+    print(f"Speedup: {t_pandas / t_kernel:.1f}x")
+
+    for name in ref:
+        same = np.array_equal(ref[name], got[name])
+        print(f"{name}: identical={same} flagged={int(ref[name].sum())}")
+
+
+if __name__ == "__main__":
+    main()
@@ -7,7 +7,9 @@ from smartcity.utils.logging import setup_logger
 def main():
     parser = argparse.ArgumentParser(description="Build traffic observation ABox.")
 
-    parser.add_argument("--input-parquet", required=True)
+    parser.add_argument("--input-parquet", default=None)
+    parser.add_argument("--store", default=None, help="Read the --freq aggregate of this DuckDB traffic store instead of --input-parquet.")
+    parser.add_argument("--freq", default="10min", help="Aggregate frequency to read from --store.")
     parser.add_argument("--output-nt-gz", required=True)
     parser.add_argument("--sensor-map-json", required=True)
     parser.add_argument("--sensor-to-lane-json", required=True)
@@ -15,6 +17,8 @@ def main():
     parser.add_argument("--threads", type=int, default=8)
 
     args = parser.parse_args()
+    if (args.input_parquet is None) == (args.store is None):
+        parser.error("Give exactly one of --input-parquet and --store.")
 
     logger = setup_logger(
         name="traffic_abox",
@@ -30,6 +34,8 @@ def main():
         sensor_to_lane_json=args.sensor_to_lane_json,
         batch_size=args.batch_size,
         threads=args.threads,
+        store_path=args.store,
+        freq=args.freq,
     )
 
     logger.info("Traffic ABox generation finished")
@@ -0,0 +1,45 @@
+import argparse
+
+from smartcity.traffic.store_refresh import refresh_traffic_store
+from smartcity.utils.logging import setup_logger
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load imputed minute traffic into the persistent DuckDB traffic store and update its aggregates."
+    )
+
+    parser.add_argument("--store", required=True, help="DuckDB traffic store file (created if missing).")
+    parser.add_argument("--input", required=True, help="Imputed traffic parquet file or dataset folder.")
+    parser.add_argument(
+        "--freq",
+        nargs="*",
+        default=["10min"],
+        help="Aggregate frequencies to materialise, e.g. 10min 1h 1d. Frequencies already in the store are always updated.",
+    )
+    parser.add_argument("--threads", type=int, default=8, help="Number of DuckDB threads.")
+
+    args = parser.parse_args()
+
+    logger = setup_logger(
+        name="traffic_store",
+        log_file="outputs/logs/traffic_store.log",
+    )
+
+    logger.info("Starting traffic store refresh")
+    logger.info(f"Store: {args.store}")
+    logger.info(f"Input: {args.input}")
+    logger.info(f"Frequencies: {args.freq}")
+
+    refresh_traffic_store(
+        store_path=args.store,
+        input_path=args.input,
+        freqs=args.freq,
+        threads=args.threads,
+    )
+
+    logger.info("Traffic store refresh finished successfully")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+import argparse
+
+from smartcity.utils.logging import setup_logger
+from smartcity.validation.imputation import run_imputation_validation
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Monte-Carlo validation of the traffic imputation layers."
+    )
+
+    parser.add_argument("--input", required=True, help="Cleaned traffic input file.")
+    parser.add_argument("--output-dir", required=True, help="Folder for the metric CSV tables.")
+    parser.add_argument("--trials", type=int, default=30, help="Gap-injection trials (cycled over the layers).")
+    parser.add_argument("--gaps-per-sensor", type=int, default=100, help="Hidden gaps per sensor and trial.")
+    parser.add_argument("--workers", type=int, default=1, help="Processes running trials over shared memory.")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed of the gap patterns.")
+    parser.add_argument("--start", default=None, help="Only use rows at or after this UTC timestamp.")
+    parser.add_argument("--end", default=None, help="Only use rows before this UTC timestamp.")
+    parser.add_argument("--sensor-ids", nargs="+", default=None, help="Only validate these sensors.")
+    parser.add_argument("--lane-metadata", default=None, help="Lane metadata CSV; also validates loop <-> video lane fusion.")
+    parser.add_argument("--scale-cache-dir", default=None, help="Folder of the cached lane scale table (default: lane_scales/ in the output dir).")
+    parser.add_argument("--ml-model", default=None, choices=["ridge", "rf", "xgb"], help="Also validate per-sensor ML models of this kind.")
+    parser.add_argument("--ml-model-dir", default=None, help="Model registry folder (default: models/ in the output dir).")
+    parser.add_argument("--intersection-id", default=None, help="Intersection id of the models (default: input file name prefix).")
+    parser.add_argument("--train-start", default=None, help="Start of the scale / model training window (default: first timestamp).")
+    parser.add_argument("--train-end", default=None, help="End of the scale / model training window (default: 70%% into the data).")
+
+    args = parser.parse_args()
+
+    logger = setup_logger(
+        name="imputation_validation",
+        log_file="outputs/logs/imputation_validation.log",
+    )
+
+    logger.info("Starting imputation validation")
+    logger.info(f"Input: {args.input}")
+    logger.info(f"Output dir: {args.output_dir}")
+
+    run_imputation_validation(
+        input_path=args.input,
+        output_dir=args.output_dir,
+        n_trials=args.trials,
+        gaps_per_sensor=args.gaps_per_sensor,
+        workers=args.workers,
+        seed=args.seed,
+        start=args.start,
+        end=args.end,
+        sensor_ids=args.sensor_ids,
+        lane_metadata=args.lane_metadata,
+        scale_cache_dir=args.scale_cache_dir,
+        ml_model=args.ml_model,
+        ml_model_dir=args.ml_model_dir,
+        intersection_id=args.intersection_id,
+        train_start=args.train_start,
+        train_end=args.train_end,
+    )
+
+    logger.info("Imputation validation finished successfully")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 import argparse
 
-from smartcity.traffic.aggregation import run_traffic_aggregation
+from smartcity.traffic.aggregation import run_traffic_aggregation, run_traffic_aggregation_cascade
+from smartcity.traffic.incremental_aggregation import run_traffic_aggregation_incremental
 from smartcity.utils.logging import setup_logger
 
 
@@ -9,12 +10,64 @@ def main():
         description="Aggregate imputed traffic data to a selected temporal granularity."
     )
 
-    parser.add_argument("--input", required=True, help="Input imputed traffic parquet file.")
-    parser.add_argument("--output", required=True, help="Output aggregated parquet file.")
+    parser.add_argument("--input", default=None, help="Input imputed traffic parquet file (or dataset folder with --incremental).")
+    parser.add_argument(
+        "--store",
+        default=None,
+        help="Read the minute data from this DuckDB traffic store (see refresh_traffic_store.py) instead of --input.",
+    )
+    parser.add_argument(
+        "--output",
+        required=True,
+        help="Output aggregated parquet file (one frequency) or output folder (several frequencies).",
+    )
     parser.add_argument(
         "--freq",
-        default="10min",
-        help="Aggregation frequency, e.g. 10min, 30min, 1h.",
+        nargs="+",
+        default=["10min"],
+        help="Aggregation frequencies, e.g. 10min 15min 30min 1h 1d. Several frequencies are rolled up from one scan.",
+    )
+    parser.add_argument(
+        "--partition-by-freq",
+        action="store_true",
+        help="Write all frequencies as one freq-partitioned dataset at --output.",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Update the day-partitioned aggregate folder at --output, recomputing only buckets of new or changed input files.",
+    )
+    parser.add_argument(
+        "--summary-output",
+        default=None,
+        help="Also write the aggregation validation summary CSV from the same scan (single --freq only).",
+    )
+    parser.add_argument(
+        "--sensor-output",
+        default=None,
+        help="Also write the per-sensor aggregation validation CSV from the same scan (single --freq only).",
+    )
+    parser.add_argument(
+        "--rollup-output",
+        default=None,
+        help="Also write lane, street and intersection rollups to this parquet file (single --freq only).",
+    )
+    parser.add_argument(
+        "--sensor-to-lane-json",
+        nargs="+",
+        default=None,
+        help="sensor_to_lane_map.json file(s) of build_intersection_abox, for --rollup-output.",
+    )
+    parser.add_argument(
+        "--lane-map-json",
+        nargs="+",
+        default=None,
+        help="Lane map JSON file(s) of build_intersection_abox, for --rollup-output.",
+    )
+    parser.add_argument(
+        "--intersection-id",
+        default=None,
+        help="Intersection of the input's sensors, for --rollup-output (default: input file name prefix).",
     )
     parser.add_argument(
         "--threads",
@@ -24,6 +77,18 @@ def main():
     )
 
     args = parser.parse_args()
+    if (args.input is None) == (args.store is None):
+        parser.error("Give exactly one of --input and --store.")
+    if args.store and args.incremental:
+        parser.error("--incremental reads parquet input; refresh a store with refresh_traffic_store.py.")
+    if args.incremental and (len(args.freq) > 1 or args.partition_by_freq):
+        parser.error("--incremental takes a single --freq.")
+    if (args.summary_output or args.sensor_output) and (args.incremental or len(args.freq) > 1 or args.partition_by_freq):
+        parser.error("--summary-output and --sensor-output take a single --freq without --incremental.")
+    if args.rollup_output and (args.incremental or len(args.freq) > 1 or args.partition_by_freq):
+        parser.error("--rollup-output takes a single --freq without --incremental.")
+    if args.rollup_output and not (args.sensor_to_lane_json and args.lane_map_json):
+        parser.error("--rollup-output needs --sensor-to-lane-json and --lane-map-json.")
 
     logger = setup_logger(
         name="traffic_aggregation",
@@ -31,17 +96,41 @@ def main():
     )
 
     logger.info("Starting traffic aggregation pipeline")
-    logger.info(f"Input: {args.input}")
+    logger.info(f"Input: {args.store or args.input}")
     logger.info(f"Output: {args.output}")
     logger.info(f"Frequency: {args.freq}")
     logger.info(f"Threads: {args.threads}")
 
-    run_traffic_aggregation(
-        input_path=args.input,
-        output_path=args.output,
-        freq=args.freq,
-        threads=args.threads,
-    )
+    if args.incremental:
+        run_traffic_aggregation_incremental(
+            input_path=args.input,
+            output_dir=args.output,
+            freq=args.freq[0],
+            threads=args.threads,
+        )
+    elif len(args.freq) > 1 or args.partition_by_freq:
+        run_traffic_aggregation_cascade(
+            input_path=args.input,
+            output_path=args.output,
+            freqs=args.freq,
+            threads=args.threads,
+            partition_by_freq=args.partition_by_freq,
+            store_path=args.store,
+        )
+    else:
+        run_traffic_aggregation(
+            input_path=args.input,
+            output_path=args.output,
+            freq=args.freq[0],
+            threads=args.threads,
+            summary_output=args.summary_output,
+            sensor_output=args.sensor_output,
+            store_path=args.store,
+            rollup_output=args.rollup_output,
+            sensor_to_lane_json=args.sensor_to_lane_json,
+            lane_map_json=args.lane_map_json,
+            intersection_id=args.intersection_id,
+        )
 
     logger.info("Traffic aggregation pipeline finished successfully")
 
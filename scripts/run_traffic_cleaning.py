@@ -1,6 +1,8 @@
 import argparse
 from smartcity.utils.logging import setup_logger
 from smartcity.traffic.cleaning import process_file
+from smartcity.traffic.incremental import process_file_incremental
+from smartcity.traffic.partitioned import process_file_partitioned
 
 
 def main():
@@ -11,8 +13,44 @@ def main():
     parser.add_argument("--input", required=True, help="Path to raw traffic file")
     parser.add_argument("--outdir", required=True, help="Output directory")
     parser.add_argument("--intersection-id", required=True, help="Intersection ID, e.g. A142")
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only clean rows newer than the persisted state and append them to the cleaned dataset folder.",
+    )
+    parser.add_argument(
+        "--partition-freq",
+        help="Clean out-of-core in time partitions of this pandas period alias (e.g. M for months).",
+    )
+    parser.add_argument(
+        "--chunk-rows",
+        type=int,
+        default=200_000,
+        help="Input rows read per chunk in partitioned mode.",
+    )
+    parser.add_argument(
+        "--sensor-batch",
+        type=int,
+        help="Reshape and flag this many sensors at a time (full cleaning only).",
+    )
+    parser.add_argument(
+        "--profile-store-dir",
+        help="Reuse (or build) the weekday x bucket profile store in this folder (full cleaning only).",
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="Write the compact output schema (flag bitmask, categoricals, float32).",
+    )
 
     args = parser.parse_args()
+    if args.incremental and args.partition_freq:
+        parser.error("--incremental and --partition-freq cannot be combined.")
+    if args.sensor_batch and (args.incremental or args.partition_freq):
+        parser.error("--sensor-batch only applies to full cleaning.")
+    if args.profile_store_dir and (args.incremental or args.partition_freq):
+        parser.error("--profile-store-dir only applies to full cleaning.")
+
     logger = setup_logger(
         name="traffic_cleaning",
         log_file=f"outputs/logs/{args.intersection_id}_traffic_cleaning.log",
@@ -22,11 +60,35 @@ def main():
     logger.info(f"Input file: {args.input}")
     logger.info(f"Output directory: {args.outdir}")
     logger.info(f"Intersection ID: {args.intersection_id}")
-    process_file(
-        input_path=args.input,
-        outdir=args.outdir,
-        intersection_id=args.intersection_id,
-    )
+    logger.info(f"Incremental: {args.incremental}")
+    logger.info(f"Partition frequency: {args.partition_freq}")
+    logger.info(f"Compact schema: {args.compact}")
+
+    if args.partition_freq:
+        process_file_partitioned(
+            input_path=args.input,
+            outdir=args.outdir,
+            intersection_id=args.intersection_id,
+            partition_freq=args.partition_freq,
+            chunk_rows=args.chunk_rows,
+            compact=args.compact,
+        )
+    elif args.incremental:
+        process_file_incremental(
+            input_path=args.input,
+            outdir=args.outdir,
+            intersection_id=args.intersection_id,
+            compact=args.compact,
+        )
+    else:
+        process_file(
+            input_path=args.input,
+            outdir=args.outdir,
+            intersection_id=args.intersection_id,
+            compact=args.compact,
+            sensor_batch=args.sensor_batch,
+            profile_store_dir=args.profile_store_dir,
+        )
     logger.info("Traffic cleaning pipeline finished successfully")
 
 if __name__ == "__main__":
@@ -0,0 +1,50 @@
+import argparse
+
+from smartcity.traffic.cleaning_batch import clean_intersections
+from smartcity.traffic.io import discover_intersection_inputs
+from smartcity.utils.logging import setup_logger
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run traffic cleaning pipeline for many intersections in parallel."
+    )
+
+    parser.add_argument("--input-glob", help="Glob of combined traffic files, e.g. 'data/interim/traffic/A*_traffic_1min.parquet'.")
+    parser.add_argument("--input-template", help="Input path template, e.g. 'data/interim/traffic/{intersection_id}_traffic_1min.parquet'.")
+    parser.add_argument("--intersection-ids", nargs="*", help="Intersection IDs to clean, e.g. A003 A142.")
+    parser.add_argument("--outdir", required=True, help="Output directory")
+    parser.add_argument("--workers", type=int, default=4, help="Number of worker processes.")
+    parser.add_argument("--log-dir", default="outputs/logs", help="Directory for per-intersection logs.")
+    parser.add_argument("--compact", action="store_true", help="Write the compact output schema (flag bitmask, categoricals, float32).")
+
+    args = parser.parse_args()
+    logger = setup_logger(
+        name="traffic_cleaning_batch",
+        log_file=f"{args.log_dir}/traffic_cleaning_batch.log",
+    )
+
+    inputs = discover_intersection_inputs(
+        input_glob=args.input_glob,
+        input_template=args.input_template,
+        intersection_ids=args.intersection_ids,
+    )
+
+    logger.info("Starting traffic cleaning batch")
+    logger.info(f"Intersections: {', '.join(inputs)}")
+    logger.info(f"Output directory: {args.outdir}")
+    logger.info(f"Workers: {args.workers}")
+
+    report_csv, _ = clean_intersections(
+        inputs=inputs,
+        outdir=args.outdir,
+        workers=args.workers,
+        log_dir=args.log_dir,
+        compact=args.compact,
+    )
+    logger.info(f"Run report: {report_csv}")
+    logger.info("Traffic cleaning batch finished")
+
+
+if __name__ == "__main__":
+    main()
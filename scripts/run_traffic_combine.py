@@ -12,7 +12,14 @@ def main():
     parser.add_argument("--traffic-root", required=True, help="Root folder containing raw traffic CSV files.")
     parser.add_argument("--metadata-file", required=True, help="Intersection metadata file containing sensor_id column.")
     parser.add_argument("--intersection-id", required=True, help="Intersection ID, e.g. A142.")
-    parser.add_argument("--output", required=True, help="Output combined 1-minute CSV file.")
+    parser.add_argument("--output", required=True, help="Output combined 1-minute file; its suffix must match --output-format.")
+    parser.add_argument(
+        "--output-format",
+        choices=["parquet", "csv"],
+        default="parquet",
+        help="Typed Parquet (default) or a CSV export.",
+    )
+    parser.add_argument("--workers", type=int, default=4, help="Number of processes parsing raw CSV files.")
     parser.add_argument("--sensor-column", default="sensor_id", help="Sensor ID column in metadata file.")
 
     args = parser.parse_args()
@@ -34,6 +41,8 @@ def main():
         intersection_id=args.intersection_id,
         output_path=args.output,
         sensor_column=args.sensor_column,
+        workers=args.workers,
+        output_format=args.output_format,
     )
 
     logger.info("Traffic combine pipeline finished successfully")
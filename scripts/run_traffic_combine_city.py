@@ -0,0 +1,51 @@
+import argparse
+
+from smartcity.traffic.combine import combine_city_traffic, combine_city_traffic_incremental
+from smartcity.utils.logging import setup_logger
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Combine raw traffic CSV files for many intersections with one scan of the archive."
+    )
+
+    parser.add_argument("--traffic-root", required=True, help="Root folder containing raw traffic CSV files.")
+    parser.add_argument("--metadata-glob", required=True, help="Glob of intersection metadata files, e.g. 'data/metadata/intersections/*.xlsx'.")
+    parser.add_argument("--outdir", required=True, help="Output dataset folder (intersection=/year=/month= partitions).")
+    parser.add_argument("--intersection-ids", nargs="*", help="Only combine these intersection IDs.")
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only ingest files that are new or changed since the manifest and merge them into the output.",
+    )
+    parser.add_argument("--workers", type=int, default=4, help="Number of processes parsing raw CSV files.")
+    parser.add_argument("--sensor-column", default="sensor_id", help="Sensor ID column in metadata files.")
+
+    args = parser.parse_args()
+
+    logger = setup_logger(
+        name="traffic_combine_city",
+        log_file="outputs/logs/traffic_combine_city.log",
+    )
+
+    logger.info("Starting city traffic combine pipeline")
+    logger.info(f"Traffic root: {args.traffic_root}")
+    logger.info(f"Metadata glob: {args.metadata_glob}")
+    logger.info(f"Output directory: {args.outdir}")
+    logger.info(f"Incremental: {args.incremental}")
+
+    combine = combine_city_traffic_incremental if args.incremental else combine_city_traffic
+    combine(
+        traffic_root=args.traffic_root,
+        metadata_glob=args.metadata_glob,
+        output_dir=args.outdir,
+        intersection_ids=args.intersection_ids,
+        sensor_column=args.sensor_column,
+        workers=args.workers,
+    )
+
+    logger.info("City traffic combine pipeline finished successfully")
+
+
+if __name__ == "__main__":
+    main()
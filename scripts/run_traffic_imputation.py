@@ -11,6 +11,21 @@ def main():
 
     parser.add_argument("--input", required=True, help="Cleaned traffic input file.")
     parser.add_argument("--output", required=True, help="Imputed traffic output parquet.")
+    parser.add_argument("--start", default=None, help="Only impute rows at or after this UTC timestamp.")
+    parser.add_argument("--end", default=None, help="Only impute rows before this UTC timestamp.")
+    parser.add_argument("--sensor-ids", nargs="+", default=None, help="Only impute these sensors.")
+    parser.add_argument("--workers", type=int, default=1, help="Processes imputing sensor ranges over shared memory.")
+    parser.add_argument("--lane-metadata", default=None, help="Lane metadata CSV; enables loop <-> video lane fusion.")
+    parser.add_argument("--scale-cache-dir", default=None, help="Folder of the cached lane scale table (default: next to the output).")
+    parser.add_argument("--scale-train-start", default=None, help="Start of the scale training window (default: first timestamp).")
+    parser.add_argument("--scale-train-end", default=None, help="End of the scale training window (default: after the last timestamp).")
+
+    parser.add_argument("--profile-store-dir", default=None, help="Reuse (or build) the profile median store in this folder.")
+    parser.add_argument("--ml-model", default=None, choices=["ridge", "rf", "xgb"], help="Fill remaining gaps with per-sensor ML models.")
+    parser.add_argument("--ml-model-dir", default=None, help="Model registry folder (default: models/ next to the output).")
+    parser.add_argument("--intersection-id", default=None, help="Intersection id of the models (default: input file name prefix).")
+    parser.add_argument("--ml-train-start", default=None, help="Start of the model training window (default: first timestamp).")
+    parser.add_argument("--ml-train-end", default=None, help="End of the model training window (default: after the last timestamp).")
 
     args = parser.parse_args()
 
@@ -26,6 +41,20 @@ def main():
     run_traffic_imputation(
         input_path=args.input,
         output_path=args.output,
+        start=args.start,
+        end=args.end,
+        sensor_ids=args.sensor_ids,
+        workers=args.workers,
+        lane_metadata=args.lane_metadata,
+        scale_cache_dir=args.scale_cache_dir,
+        scale_train_start=args.scale_train_start,
+        scale_train_end=args.scale_train_end,
+        ml_model=args.ml_model,
+        ml_model_dir=args.ml_model_dir,
+        intersection_id=args.intersection_id,
+        ml_train_start=args.ml_train_start,
+        ml_train_end=args.ml_train_end,
+        profile_store_dir=args.profile_store_dir,
     )
 
     logger.info("Traffic imputation pipeline finished successfully")
@@ -0,0 +1,55 @@
+import argparse
+
+from smartcity.traffic.pipeline import run_traffic_pipeline
+from smartcity.utils.logging import setup_logger
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Impute, aggregate and validate cleaned traffic in one process, without intermediate files."
+    )
+
+    parser.add_argument("--input", required=True, help="Cleaned traffic input file.")
+    parser.add_argument("--freq", default="10min", help="Aggregation frequency, e.g. 10min, 30min, 1h, 1d.")
+    parser.add_argument("--start", default=None, help="Only use rows at or after this UTC timestamp.")
+    parser.add_argument("--end", default=None, help="Only use rows before this UTC timestamp.")
+    parser.add_argument("--sensor-ids", nargs="+", default=None, help="Only process these sensors.")
+    parser.add_argument("--workers", type=int, default=1, help="Processes imputing sensor ranges over shared memory.")
+    parser.add_argument("--threads", type=int, default=8, help="Number of DuckDB threads.")
+    parser.add_argument("--profile-store-dir", default=None, help="Reuse (or build) the profile median store in this folder.")
+    parser.add_argument("--imputed-output", default=None, help="Also write the imputed minutes to this parquet file.")
+    parser.add_argument("--aggregate-output", default=None, help="Also write the aggregate to this parquet file.")
+    parser.add_argument("--summary-output", default=None, help="Also write the dataset-level validation CSV.")
+    parser.add_argument("--sensor-output", default=None, help="Also write the per-sensor validation CSV.")
+
+    args = parser.parse_args()
+
+    logger = setup_logger(
+        name="traffic_pipeline",
+        log_file="outputs/logs/traffic_pipeline.log",
+    )
+
+    logger.info("Starting traffic pipeline")
+    logger.info(f"Input: {args.input}")
+    logger.info(f"Frequency: {args.freq}")
+
+    run_traffic_pipeline(
+        input_path=args.input,
+        freq=args.freq,
+        start=args.start,
+        end=args.end,
+        sensor_ids=args.sensor_ids,
+        workers=args.workers,
+        threads=args.threads,
+        profile_store_dir=args.profile_store_dir,
+        imputed_output=args.imputed_output,
+        aggregate_output=args.aggregate_output,
+        summary_output=args.summary_output,
+        sensor_output=args.sensor_output,
+    )
+
+    logger.info("Traffic pipeline finished successfully")
+
+
+if __name__ == "__main__":
+    main()
@@ -74,6 +74,8 @@ def summarize_imputation(df: pd.DataFrame) -> pd.DataFrame:
                 "temporal_linear_count": int((g["impute_method"] == "TEMPORAL_LINEAR").sum()),
                 "rolling_median_count": int((g["impute_method"] == "ROLLING_MEDIAN").sum()),
                 "profile_median_count": int((g["impute_method"] == "PROFILE_MEDIAN").sum()),
+                "lane_video_scale_count": int((g["impute_method"] == "LANE_VIDEO_SCALE").sum()),
+                "ml_model_count": int(g["impute_method"].astype(str).str.startswith("ML_").sum()),
                 "logic_invalid_count": int((g["missing_reason"] == "LOGIC_INVALID").sum()),
                 "stuck_off_count": int((g["missing_reason"] == "STUCK_OFF").sum()),
                 "cap_exceeded_count": int((g["missing_reason"] == "CAP_EXCEEDED").sum()),
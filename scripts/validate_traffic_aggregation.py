@@ -9,13 +9,16 @@ def main():
         description="Validate aggregated traffic parquet output."
     )
 
-    parser.add_argument("--input", required=True, help="Aggregated traffic parquet file.")
+    parser.add_argument("--input", default=None, help="Aggregated traffic parquet file.")
+    parser.add_argument("--store", default=None, help="Validate the --expected-freq aggregate of this DuckDB traffic store instead of --input.")
     parser.add_argument("--summary-output", required=True, help="Dataset-level validation CSV.")
     parser.add_argument("--sensor-output", required=True, help="Per-sensor validation CSV.")
     parser.add_argument("--expected-freq", default="10min", help="Expected frequency label.")
     parser.add_argument("--threads", type=int, default=8, help="DuckDB thread count.")
 
     args = parser.parse_args()
+    if (args.input is None) == (args.store is None):
+        parser.error("Give exactly one of --input and --store.")
 
     logger = setup_logger(
         name="traffic_aggregation_validation",
@@ -23,7 +26,7 @@ def main():
     )
 
     logger.info("Starting traffic aggregation validation")
-    logger.info(f"Input: {args.input}")
+    logger.info(f"Input: {args.store or args.input}")
     logger.info(f"Summary output: {args.summary_output}")
     logger.info(f"Sensor output: {args.sensor_output}")
     logger.info(f"Expected frequency: {args.expected_freq}")
@@ -34,6 +37,7 @@ def main():
         sensor_output=args.sensor_output,
         expected_freq=args.expected_freq,
         threads=args.threads,
+        store_path=args.store,
     )
 
     logger.info("Traffic aggregation validation finished successfully")
@@ -0,0 +1,317 @@
+"""
+Loop <-> video same-lane fusion imputation.
+
+Loop detectors (D*) and video detectors (V*) on the same lane (lane_key =
+road_name | coord_dir | lane_index) count the same vehicles up to a scale.
+Per (loop, video) pair the scale loop ~ scale * video is learned as a ratio
+of sums over minutes where both are clean observations, per weekday x
+15-minute bucket with fallbacks (pair x bucket, pair, global) wherever the
+video total is below `min_points`.
+
+Learned scales are cached in `{cache_dir}/lane_scales.parquet` with a JSON
+sidecar. The cache key covers the table version, the training window,
+`min_points` and the pairs, so re-running imputation reuses the table and
+only relearns when one of them changes.
+
+apply_lane_fusion fills loop minutes that are still missing after the
+layered imputation with scale * video count (impute_method
+LANE_VIDEO_SCALE). Only rows cleaning marked imputable are filled; hard
+failures such as STUCK_ON or PHYS_INVALID stay missing. Dwell times are not
+scaled.
+"""
+
+import hashlib
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from smartcity.traffic.cleaning import utc_timestamp
+from smartcity.traffic.profiles import WEEKDAYS, buckets_per_day, cell_index
+from smartcity.traffic.schema import flag_values
+
+
+SCALE_TABLE_VERSION = 1
+SCALE_BUCKET_MINUTES = 15
+LANE_FUSION_METHOD = "LANE_VIDEO_SCALE"
+
+# fallback levels of a scale, most specific first
+SCALE_LEVELS = ["pair_weekday_bucket", "pair_bucket", "pair", "global"]
+
+
+def load_lane_metadata(meta_csv_path: str | Path) -> pd.DataFrame:
+    """Sensor lane metadata with a lane_key of road_name | coord_dir | lane_index."""
+    m = pd.read_csv(meta_csv_path)
+
+    m.columns = (
+        m.columns.astype(str)
+        .str.strip()
+        .str.replace(r"\s+", " ", regex=True)
+    )
+    m = m.rename(columns={
+        "lane_index(0-based from left to right)": "lane_index",
+        "Coordinate direction": "coord_dir",
+    })
+
+    if "has_data_in_csv" in m.columns:
+        m = m[m["has_data_in_csv"].astype(str).str.lower().eq("yes")].copy()
+
+    if "sensor_id" not in m.columns:
+        raise ValueError("Expected column 'sensor_id' in metadata CSV.")
+
+    required = ["road_name", "coord_dir", "lane_index"]
+    missing = [c for c in required if c not in m.columns]
+    if missing:
+        raise ValueError(f"Missing required metadata columns: {missing}")
+
+    m["sensor_id"] = m["sensor_id"].astype(str).str.strip()
+    m["sensor_prefix"] = m["sensor_id"].str[:1]
+    m["lane_index"] = pd.to_numeric(m["lane_index"], errors="coerce").astype("Int64")
+    m["lane_key"] = (
+        m["road_name"].astype(str).str.strip() + " | " +
+        m["coord_dir"].astype(str).str.strip() + " | " +
+        m["lane_index"].astype(str)
+    )
+
+    out_cols = ["sensor_id", "sensor_prefix", "lane_key", "road_name", "lane_index", "coord_dir"]
+    for c in ["detector_type", "intersection_id"]:
+        if c in m.columns:
+            out_cols.append(c)
+    return m[out_cols].reset_index(drop=True)
+
+
+def build_lane_pairs(meta: pd.DataFrame) -> pd.DataFrame:
+    """Every (loop, video) sensor pair on the same lane, sorted by loop then video."""
+    loops = meta[meta["sensor_prefix"] == "D"][["lane_key", "sensor_id"]].rename(columns={"sensor_id": "loop_sensor_id"})
+    vids = meta[meta["sensor_prefix"] == "V"][["lane_key", "sensor_id"]].rename(columns={"sensor_id": "video_sensor_id"})
+    pairs = loops.merge(vids, on="lane_key", how="inner").drop_duplicates(["loop_sensor_id", "video_sensor_id"])
+    return pairs.sort_values(["loop_sensor_id", "video_sensor_id"]).reset_index(drop=True)
+
+
+def observed_counts(df: pd.DataFrame) -> pd.DataFrame:
+    """(sensor_id, timestamp, count) of clean observed minutes."""
+    ts = pd.to_datetime(df["timestamp"], errors="coerce", utc=True)
+    keep = (df["count_clean"].notna() & ts.notna()).to_numpy() & (flag_values(df, "is_clean_observed") == 1)
+    return pd.DataFrame({
+        "sensor_id": df["sensor_id"].astype(str).to_numpy()[keep],
+        "timestamp": ts.to_numpy()[keep],
+        "count": df["count_clean"].to_numpy(dtype=np.float64)[keep],
+    })
+
+
+def pair_cells(pair_codes: np.ndarray, ts: pd.Series) -> np.ndarray:
+    """Dense [pair, weekday, bucket] cell per row."""
+    dt = pd.DatetimeIndex(ts)
+    minutes = np.asarray(dt.hour * 60 + dt.minute, dtype=np.int64)
+    bucket = (minutes // SCALE_BUCKET_MINUTES) * SCALE_BUCKET_MINUTES
+    return cell_index(pair_codes, np.asarray(dt.weekday, dtype=np.int64), bucket, SCALE_BUCKET_MINUTES)
+
+
+def aligned_pair_counts(obs: pd.DataFrame, pairs: pd.DataFrame) -> pd.DataFrame:
+    """(pair, timestamp, loop_count, video_count) for minutes where both sensors of a pair are observed."""
+    p = pairs[["loop_sensor_id", "video_sensor_id"]].assign(pair=np.arange(len(pairs)))
+    loops = obs.merge(p, left_on="sensor_id", right_on="loop_sensor_id", how="inner")
+    vids = obs.rename(columns={"sensor_id": "video_sensor_id", "count": "video_count"})
+    joined = loops.merge(vids, on=["video_sensor_id", "timestamp"], how="inner")
+    return joined.rename(columns={"count": "loop_count"})[["pair", "timestamp", "loop_count", "video_count"]]
+
+
+def learn_scale_table(
+    df: pd.DataFrame,
+    pairs: pd.DataFrame,
+    min_points: int = 30,
+    train_start=None,
+    train_end=None,
+) -> tuple[pd.DataFrame, float]:
+    """
+    Learn loop/video scales for every pair x weekday x bucket cell in one
+    pass. Returns (dense scale table with its fallback level, global scale).
+    """
+    obs = observed_counts(df)
+    if train_start is not None:
+        obs = obs[obs["timestamp"] >= utc_timestamp(train_start)]
+    if train_end is not None:
+        obs = obs[obs["timestamp"] < utc_timestamp(train_end)]
+    joined = aligned_pair_counts(obs, pairs)
+
+    n_buckets = buckets_per_day(SCALE_BUCKET_MINUTES)
+    shape = (len(pairs), WEEKDAYS, n_buckets)
+    cells = pair_cells(joined["pair"].to_numpy(), joined["timestamp"])
+    n_cells = int(np.prod(shape))
+
+    sums = {}
+    for name, weights in [
+        ("loop_sum", joined["loop_count"].to_numpy()),
+        ("video_sum", joined["video_count"].to_numpy()),
+        ("n", None),
+    ]:
+        sums[name] = np.bincount(cells, weights=weights, minlength=n_cells).astype(np.float64).reshape(shape)
+
+    total_video = sums["video_sum"].sum()
+    global_scale = float(sums["loop_sum"].sum() / total_video) if total_video > 0 else np.nan
+
+    # level sums, broadcast back to the dense cell grid
+    levels = [
+        {k: v for k, v in sums.items()},
+        {k: np.broadcast_to(v.sum(axis=1, keepdims=True), shape) for k, v in sums.items()},
+        {k: np.broadcast_to(v.sum(axis=(1, 2), keepdims=True), shape) for k, v in sums.items()},
+    ]
+
+    scale = np.full(shape, global_scale)
+    level = np.full(shape, len(SCALE_LEVELS) - 1, dtype=np.int8)
+    chosen = {k: np.full(shape, np.nan) for k in sums}
+    # least specific first, so more specific levels overwrite
+    for i in reversed(range(len(levels))):
+        lv = levels[i]
+        ok = (lv["video_sum"] >= min_points) & (lv["video_sum"] > 0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            scale = np.where(ok, lv["loop_sum"] / lv["video_sum"], scale)
+        level = np.where(ok, i, level).astype(np.int8)
+        for k in sums:
+            chosen[k] = np.where(ok, lv[k], chosen[k])
+
+    pair_idx, weekday, bucket = np.indices(shape).reshape(3, -1)
+    table = pd.DataFrame({
+        "loop_sensor_id": pairs["loop_sensor_id"].to_numpy()[pair_idx],
+        "video_sensor_id": pairs["video_sensor_id"].to_numpy()[pair_idx],
+        "weekday": weekday.astype("int64"),
+        "bucket": (bucket * SCALE_BUCKET_MINUTES).astype("int64"),
+        "scale": scale.ravel(),
+        "level": pd.Categorical.from_codes(level.ravel(), categories=SCALE_LEVELS),
+        "n": chosen["n"].ravel(),
+        "loop_sum": chosen["loop_sum"].ravel(),
+        "video_sum": chosen["video_sum"].ravel(),
+    })
+    return table, global_scale
+
+
+def scale_cache_key(pairs: pd.DataFrame, min_points: int, train_start, train_end) -> str:
+    payload = {
+        "version": SCALE_TABLE_VERSION,
+        "bucket_minutes": SCALE_BUCKET_MINUTES,
+        "min_points": min_points,
+        "train_start": str(train_start),
+        "train_end": str(train_end),
+        "pairs": pairs[["loop_sensor_id", "video_sensor_id"]].astype(str).values.tolist(),
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+def training_window(df: pd.DataFrame, train_start=None, train_end=None) -> tuple[str, str]:
+    """Explicit window bounds, else the data's [first, last + 1 minute) range, as ISO strings."""
+    ts = pd.to_datetime(df["timestamp"], errors="coerce", utc=True)
+    start = utc_timestamp(train_start) if train_start is not None else ts.min()
+    end = utc_timestamp(train_end) if train_end is not None else ts.max() + pd.Timedelta(minutes=1)
+    return start.isoformat(), end.isoformat()
+
+
+def load_or_learn_scales(
+    df: pd.DataFrame,
+    pairs: pd.DataFrame,
+    cache_dir: str | Path,
+    min_points: int = 30,
+    train_start=None,
+    train_end=None,
+) -> pd.DataFrame:
+    """Return the cached scale table for this training setup, learning and caching it if needed."""
+    cache_dir = Path(cache_dir)
+    table_path = cache_dir / "lane_scales.parquet"
+    meta_path = cache_dir / "lane_scales.json"
+
+    start, end = training_window(df, train_start, train_end)
+    key = scale_cache_key(pairs, min_points, start, end)
+
+    if meta_path.exists() and table_path.exists():
+        with open(meta_path, "r") as f:
+            meta = json.load(f)
+        if meta.get("key") == key:
+            print(f"Using cached lane scales: {table_path}")
+            return pd.read_parquet(table_path)
+
+    table, global_scale = learn_scale_table(df, pairs, min_points, start, end)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    table.to_parquet(table_path, index=False)
+    with open(meta_path, "w") as f:
+        json.dump({
+            "key": key,
+            "version": SCALE_TABLE_VERSION,
+            "train_start": start,
+            "train_end": end,
+            "min_points": min_points,
+            "pairs": len(pairs),
+            "global_scale": global_scale,
+        }, f, indent=2)
+    print(f"Learned lane scales for {len(pairs)} pairs: {table_path}")
+    return table
+
+
+def apply_lane_fusion(df: pd.DataFrame, pairs: pd.DataFrame, scales: pd.DataFrame) -> pd.DataFrame:
+    """
+    Fill imputable loop rows whose count_imputed is still missing with scale
+    * the observed count of a paired video sensor at the same minute. With
+    several videos on the lane, the first pair (by video ID) with an
+    observation wins.
+    """
+    out = df.copy()
+    if pairs.empty:
+        return out
+
+    ts = pd.to_datetime(out["timestamp"], errors="coerce", utc=True)
+    loop_ids = set(pairs["loop_sensor_id"])
+    target = (out["count_imputed"].isna() & ts.notna() & out["sensor_id"].astype(str).isin(loop_ids)).to_numpy()
+    target = target & (flag_values(out, "imputable") == 1)
+    if not target.any():
+        return out
+
+    rows = pd.DataFrame({
+        "row": np.flatnonzero(target),
+        "loop_sensor_id": out["sensor_id"].astype(str).to_numpy()[target],
+        "timestamp": ts.to_numpy()[target],
+    })
+    p = pairs[["loop_sensor_id", "video_sensor_id"]].assign(pair=np.arange(len(pairs)))
+    vids = observed_counts(out).rename(columns={"sensor_id": "video_sensor_id", "count": "video_count"})
+    cand = rows.merge(p, on="loop_sensor_id").merge(vids, on=["video_sensor_id", "timestamp"])
+    if cand.empty:
+        return out
+    cand = cand.sort_values(["row", "pair"], kind="stable").drop_duplicates("row")
+
+    # scale table rows are in dense [pair, weekday, bucket] order for `pairs`
+    per_pair = WEEKDAYS * buckets_per_day(SCALE_BUCKET_MINUTES)
+    if len(scales) != len(pairs) * per_pair or not (
+        np.array_equal(scales["loop_sensor_id"].to_numpy()[::per_pair], pairs["loop_sensor_id"].to_numpy())
+        and np.array_equal(scales["video_sensor_id"].to_numpy()[::per_pair], pairs["video_sensor_id"].to_numpy())
+    ):
+        raise ValueError("Scale table does not match the lane pairs; relearn it for these pairs.")
+    scale = scales["scale"].to_numpy(dtype=np.float64)[pair_cells(cand["pair"].to_numpy(), cand["timestamp"])]
+
+    values = scale * cand["video_count"].to_numpy()
+    ok = ~np.isnan(values)
+    fill_rows = cand["row"].to_numpy()[ok]
+
+    count = out["count_imputed"].to_numpy(dtype=np.float64, copy=True)
+    count[fill_rows] = values[ok]
+    out["count_imputed"] = count
+    out.loc[out.index[fill_rows], "impute_method"] = LANE_FUSION_METHOD
+    return out
+
+
+def run_lane_fusion(
+    df: pd.DataFrame,
+    meta_csv_path: str | Path,
+    cache_dir: str | Path,
+    min_points: int = 30,
+    train_start=None,
+    train_end=None,
+) -> pd.DataFrame:
+    """Lane fusion layer: load pairs, reuse or learn the cached scales, fill loop gaps."""
+    pairs = build_lane_pairs(load_lane_metadata(meta_csv_path))
+    if pairs.empty:
+        print("No loop/video pairs on shared lanes; lane fusion skipped.")
+        return df
+
+    scales = load_or_learn_scales(df, pairs, cache_dir, min_points, train_start, train_end)
+    out = apply_lane_fusion(df, pairs, scales)
+    filled = int((out["impute_method"] == LANE_FUSION_METHOD).sum())
+    print(f"Lane fusion: {len(pairs)} pairs, {filled} loop minutes filled.")
+    return out
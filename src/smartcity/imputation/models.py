@@ -0,0 +1,357 @@
+"""
+ML imputation layer with an on-disk model registry.
+
+One model per target sensor predicts its count from the counts of the
+other sensors of the intersection at the same minute plus time features
+(tod_sin, tod_cos, weekday), as in legacy/imputation/MlModel.py. Models
+are group-wise per weekday x `group_minutes` bucket, as in
+ConditionalScailing.py; groups with fewer than `min_samples` training rows
+use the sensor-level model.
+
+Models are keyed by (intersection, sensor, feature set, training window
+hash) and pickled under `{root}/{intersection}/{sensor}/`. The registry
+loads them lazily and keeps at most `max_in_memory` of them (LRU).
+
+apply_ml_models fills only missing rows that cleaning marked imputable, and
+rejects a model whose predictor sensors are not all in the frame.
+
+Model kinds:
+- "ridge": built-in closed-form ridge (standardised features, alpha=1)
+  whose group coefficients are one [group, feature] array, so inference
+  is a single gather + row-wise dot product;
+- "rf", "xgb": scikit-learn RandomForestRegressor / xgboost XGBRegressor
+  (optional dependencies), predicted per group in batches.
+"""
+
+import hashlib
+import json
+import pickle
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from smartcity.imputation.lane_fusion import training_window
+from smartcity.traffic.cleaning import utc_timestamp
+from smartcity.traffic.profiles import WEEKDAYS, buckets_per_day
+from smartcity.traffic.schema import flag_values
+
+
+MODEL_VERSION = 1
+FEATURE_SET = "intersection_counts"
+TIME_FEATURES = ["tod_sin", "tod_cos", "weekday"]
+RIDGE_ALPHA = 1.0
+
+# (intersection_id, sensor_id, feature_set, window_hash)
+ModelKey = Tuple[str, str, str, str]
+
+
+def get_estimator(name: str, random_state: int = 42):
+    """scikit-learn / xgboost regressor for `name` ("rf" or "xgb")."""
+    name = name.lower()
+    if name == "rf":
+        try:
+            from sklearn.ensemble import RandomForestRegressor
+        except ImportError as e:
+            raise ImportError("scikit-learn not installed. pip install scikit-learn") from e
+        return RandomForestRegressor(n_estimators=100, random_state=random_state, n_jobs=1)
+    if name == "xgb":
+        try:
+            from xgboost import XGBRegressor
+        except ImportError as e:
+            raise ImportError("xgboost not installed. pip install xgboost") from e
+        return XGBRegressor(n_estimators=200, objective="reg:squarederror", random_state=random_state, n_jobs=1)
+    raise ValueError(f"Unknown model name: {name}. Use 'ridge', 'rf' or 'xgb'.")
+
+
+def group_slices(groups: np.ndarray, n_groups: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Row order sorting `groups` and the [start, end) offsets of every group in it."""
+    order = np.argsort(groups, kind="stable")
+    offsets = np.searchsorted(groups[order], np.arange(n_groups + 1))
+    return order, offsets
+
+
+class RidgeGroupModel:
+    """Ridge per group plus a sensor-level fallback, stored as one coefficient array."""
+
+    def __init__(self, n_groups: int, min_samples: int = 30, alpha: float = RIDGE_ALPHA):
+        self.n_groups = n_groups
+        self.min_samples = min_samples
+        self.alpha = alpha
+
+    def _solve(self, xs: np.ndarray, y: np.ndarray) -> np.ndarray:
+        a = np.c_[xs, np.ones(len(xs))]
+        penalty = np.eye(a.shape[1]) * self.alpha
+        penalty[-1, -1] = 0.0  # intercept is not penalised
+        return np.linalg.solve(a.T @ a + penalty, a.T @ y)
+
+    def fit(self, x: np.ndarray, y: np.ndarray, groups: np.ndarray) -> "RidgeGroupModel":
+        self.mean = x.mean(axis=0)
+        self.scale = x.std(axis=0)
+        self.scale[self.scale == 0] = 1.0
+        xs = (x - self.mean) / self.scale
+
+        fallback = self._solve(xs, y)
+        # row n_groups is the fallback; small groups point at it too
+        self.coef = np.tile(fallback, (self.n_groups + 1, 1))
+        order, offsets = group_slices(groups, self.n_groups)
+        for g in np.flatnonzero(np.diff(offsets) >= self.min_samples):
+            rows = order[offsets[g]:offsets[g + 1]]
+            self.coef[g] = self._solve(xs[rows], y[rows])
+        return self
+
+    def predict(self, x: np.ndarray, groups: np.ndarray) -> np.ndarray:
+        xs = (x - self.mean) / self.scale
+        coef = self.coef[groups]
+        return np.einsum("ij,ij->i", xs, coef[:, :-1]) + coef[:, -1]
+
+
+class EstimatorGroupModel:
+    """scikit-learn style estimator per group plus a sensor-level fallback."""
+
+    def __init__(self, name: str, n_groups: int, min_samples: int = 30):
+        self.name = name
+        self.n_groups = n_groups
+        self.min_samples = min_samples
+
+    def fit(self, x: np.ndarray, y: np.ndarray, groups: np.ndarray) -> "EstimatorGroupModel":
+        self.fallback = get_estimator(self.name).fit(x, y)
+        # index n_groups (and every small group) maps to the fallback
+        self.model_index = np.full(self.n_groups + 1, self.n_groups, dtype=np.int64)
+        self.models: Dict[int, object] = {}
+        order, offsets = group_slices(groups, self.n_groups)
+        for g in np.flatnonzero(np.diff(offsets) >= self.min_samples):
+            rows = order[offsets[g]:offsets[g + 1]]
+            self.models[int(g)] = get_estimator(self.name).fit(x[rows], y[rows])
+            self.model_index[g] = g
+        return self
+
+    def predict(self, x: np.ndarray, groups: np.ndarray) -> np.ndarray:
+        pred = np.empty(len(x))
+        model_of_row = self.model_index[groups]
+        order, offsets = group_slices(model_of_row, self.n_groups + 1)
+        for m in np.flatnonzero(np.diff(offsets) > 0):
+            rows = order[offsets[m]:offsets[m + 1]]
+            model = self.models.get(int(m), self.fallback)
+            pred[rows] = model.predict(x[rows])
+        return pred
+
+
+def build_group_model(model_name: str, n_groups: int, min_samples: int):
+    if model_name == "ridge":
+        return RidgeGroupModel(n_groups, min_samples)
+    return EstimatorGroupModel(model_name, n_groups, min_samples)
+
+
+class ModelRegistry:
+    """Pickled models under `root`, loaded lazily and kept in an LRU cache."""
+
+    def __init__(self, root: str | Path, max_in_memory: int = 64):
+        self.root = Path(root)
+        self.max_in_memory = max_in_memory
+        self._cache: "OrderedDict[ModelKey, dict]" = OrderedDict()
+
+    def path(self, key: ModelKey) -> Path:
+        intersection_id, sensor_id, feature_set, window_hash = key
+        return self.root / intersection_id / sensor_id / f"{feature_set}-{window_hash}.pkl"
+
+    def exists(self, key: ModelKey) -> bool:
+        return key in self._cache or self.path(key).exists()
+
+    def save(self, key: ModelKey, entry: dict) -> Path:
+        path = self.path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "wb") as f:
+            pickle.dump(entry, f)
+        return path
+
+    def get(self, key: ModelKey) -> dict:
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        path = self.path(key)
+        if not path.exists():
+            raise FileNotFoundError(f"Model not found: {path}")
+        with open(path, "rb") as f:
+            entry = pickle.load(f)
+        self._cache[key] = entry
+        while len(self._cache) > self.max_in_memory:
+            self._cache.popitem(last=False)
+        return entry
+
+
+def sensor_matrix(df: pd.DataFrame, column: str) -> Tuple[pd.DatetimeIndex, pd.Index, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Dense [minute, sensor] matrix of `column`. Returns (minutes, sensor ids,
+    matrix, row minute code, row sensor code).
+    """
+    ts = pd.to_datetime(df["timestamp"], errors="coerce", utc=True)
+    ts_codes, minutes = pd.factorize(ts)
+    sensor_codes, sensor_ids = pd.factorize(df["sensor_id"].astype(str))
+    matrix = np.full((len(minutes), len(sensor_ids)), np.nan)
+    valid = ts_codes >= 0
+    matrix[ts_codes[valid], sensor_codes[valid]] = df[column].to_numpy(dtype=np.float64)[valid]
+    return pd.DatetimeIndex(minutes), pd.Index(sensor_ids), matrix, ts_codes, sensor_codes
+
+
+def time_features(minutes: pd.DatetimeIndex, group_minutes: int) -> Tuple[np.ndarray, np.ndarray]:
+    """(tod_sin, tod_cos, weekday) per minute and its weekday x bucket group code."""
+    minute_of_day = np.asarray(minutes.hour * 60 + minutes.minute, dtype=np.float64)
+    weekday = np.asarray(minutes.weekday, dtype=np.int64)
+    feats = np.c_[
+        np.sin(2 * np.pi * minute_of_day / 1440),
+        np.cos(2 * np.pi * minute_of_day / 1440),
+        weekday.astype(np.float64),
+    ]
+    groups = weekday * buckets_per_day(group_minutes) + (minute_of_day // group_minutes).astype(np.int64)
+    return feats, groups
+
+
+def window_hash(model_name: str, predictors: List[str], train_start: str, train_end: str, group_minutes: int, min_samples: int) -> str:
+    payload = {
+        "version": MODEL_VERSION,
+        "model": model_name,
+        "predictors": predictors,
+        "train_start": train_start,
+        "train_end": train_end,
+        "group_minutes": group_minutes,
+        "min_samples": min_samples,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def fit_and_save(registry_root: str, key: ModelKey, entry: dict, x: np.ndarray, y: np.ndarray, groups: np.ndarray, min_samples: int) -> Tuple[ModelKey, int]:
+    """Worker: fit one sensor's group model and pickle it into the registry."""
+    model = build_group_model(entry["model_name"], entry["n_groups"], min_samples).fit(x, y, groups)
+    ModelRegistry(registry_root).save(key, dict(entry, model=model, n_train=len(y)))
+    return key, len(y)
+
+
+def train_sensor_models(
+    df: pd.DataFrame,
+    registry: ModelRegistry,
+    intersection_id: str,
+    targets: List[str] | None = None,
+    model_name: str = "ridge",
+    train_start=None,
+    train_end=None,
+    group_minutes: int = 60,
+    min_samples: int = 30,
+    workers: int = 1,
+) -> Dict[str, ModelKey]:
+    """
+    Train (or reuse) one model per target sensor, in parallel over sensors.
+    Predictors are all other sensors of the frame. Targets without
+    `min_samples` clean observations in the window get no model.
+    """
+    minutes, sensor_ids, matrix, ts_codes, sensor_codes = sensor_matrix(df, "count_imputed")
+    feats, groups = time_features(minutes, group_minutes)
+    n_groups = WEEKDAYS * buckets_per_day(group_minutes)
+
+    observed = df["count_clean"].notna().to_numpy() & (flag_values(df, "is_clean_observed") == 1)
+    target_matrix = np.full(matrix.shape, np.nan)
+    keep = observed & (ts_codes >= 0)
+    target_matrix[ts_codes[keep], sensor_codes[keep]] = df["count_clean"].to_numpy(dtype=np.float64)[keep]
+
+    start, end = training_window(df, train_start, train_end)
+    in_window = np.asarray((minutes >= utc_timestamp(start)) & (minutes < utc_timestamp(end)))
+
+    keys: Dict[str, ModelKey] = {}
+    tasks = []
+    for sid in (targets if targets is not None else list(sensor_ids)):
+        code = sensor_ids.get_loc(sid)
+        predictors = [s for s in sensor_ids if s != sid]
+        key = (intersection_id, sid, FEATURE_SET, window_hash(model_name, predictors, start, end, group_minutes, min_samples))
+        if registry.exists(key):
+            keys[sid] = key
+            continue
+
+        x = np.c_[matrix[:, [sensor_ids.get_loc(p) for p in predictors]], feats]
+        y = target_matrix[:, code]
+        rows = in_window & ~np.isnan(y) & ~np.isnan(x).any(axis=1)
+        if rows.sum() < min_samples:
+            continue
+        entry = {
+            "model_name": model_name,
+            "predictors": predictors,
+            "features": predictors + TIME_FEATURES,
+            "group_minutes": group_minutes,
+            "n_groups": n_groups,
+            "train_start": start,
+            "train_end": end,
+        }
+        tasks.append((str(registry.root), key, entry, x[rows], y[rows], groups[rows], min_samples))
+
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(fit_and_save, *zip(*tasks)))
+    else:
+        results = [fit_and_save(*task) for task in tasks]
+
+    for key, n_train in results:
+        keys[key[1]] = key
+    print(f"ML models: {len(results)} trained, {len(keys) - len(results)} reused from {registry.root}")
+    return keys
+
+
+def apply_ml_models(df: pd.DataFrame, registry: ModelRegistry, keys: Dict[str, ModelKey]) -> pd.DataFrame:
+    """
+    Fill imputable rows whose count_imputed is still missing with the
+    sensor's model prediction (clipped at 0). All masked minutes of a sensor
+    are predicted in one batch; rows lacking a predictor value stay missing.
+    Raises ValueError if a model's predictor sensor is not in `df`.
+    """
+    out = df.copy()
+    minutes, sensor_ids, matrix, ts_codes, sensor_codes = sensor_matrix(out, "count_imputed")
+    count = out["count_imputed"].to_numpy(dtype=np.float64, copy=True)
+    method = out["impute_method"].to_numpy(dtype=object, copy=True)
+    missing = np.isnan(count) & (ts_codes >= 0) & (flag_values(out, "imputable") == 1)
+
+    for sid, key in keys.items():
+        rows = np.flatnonzero(missing & (sensor_codes == sensor_ids.get_loc(sid)))
+        if len(rows) == 0:
+            continue
+        entry = registry.get(key)
+        predictors = sensor_ids.get_indexer(entry["predictors"])
+        if (predictors < 0).any():
+            absent = [p for p, i in zip(entry["predictors"], predictors) if i < 0]
+            raise ValueError(f"Model for sensor {sid} needs predictor sensors missing from the data: {absent}")
+        feats, groups = time_features(minutes[ts_codes[rows]], entry["group_minutes"])
+        x = np.c_[matrix[ts_codes[rows]][:, predictors], feats]
+        ok = ~np.isnan(x).any(axis=1)
+        if not ok.any():
+            continue
+        pred = np.clip(entry["model"].predict(x[ok], groups[ok]), 0, None)
+        count[rows[ok]] = pred
+        method[rows[ok]] = f"ML_{entry['model_name'].upper()}"
+
+    out["count_imputed"] = count
+    out["impute_method"] = method
+    return out
+
+
+def run_ml_imputation(
+    df: pd.DataFrame,
+    model_dir: str | Path,
+    intersection_id: str,
+    model_name: str = "ridge",
+    train_start=None,
+    train_end=None,
+    workers: int = 1,
+) -> pd.DataFrame:
+    """ML layer: train or reuse models for sensors with missing minutes, then fill them."""
+    registry = ModelRegistry(model_dir)
+    targets = sorted(df.loc[df["count_imputed"].isna() & (flag_values(df, "imputable") == 1), "sensor_id"].astype(str).unique())
+    if not targets:
+        return df
+    keys = train_sensor_models(
+        df, registry, intersection_id, targets, model_name,
+        train_start=train_start, train_end=train_end, workers=workers,
+    )
+    out = apply_ml_models(df, registry, keys)
+    filled = int((out["impute_method"] == f"ML_{model_name.upper()}").sum())
+    print(f"ML imputation ({model_name}): {filled} minutes filled for {len(keys)} sensors.")
+    return out
@@ -0,0 +1,68 @@
+"""
+Shared-memory arrays for process-pool workers.
+
+Flat NumPy arrays are copied once into multiprocessing.shared_memory
+blocks. Tasks receive only the block specs (name, dtype, length) and a
+row range, attach to the blocks and work on their slice in place, so no
+DataFrame or array is pickled between processes.
+"""
+
+from multiprocessing import shared_memory
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+
+# array name -> (shared memory block name, dtype, length)
+BlockSpecs = Dict[str, Tuple[str, str, int]]
+
+
+def share_arrays(arrays: Dict[str, np.ndarray]) -> Tuple[BlockSpecs, list]:
+    """Copy `arrays` into new shared memory blocks. Returns (specs, blocks to release)."""
+    specs: BlockSpecs = {}
+    blocks = []
+    try:
+        for name, values in arrays.items():
+            values = np.ascontiguousarray(values)
+            shm = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+            blocks.append(shm)
+            np.ndarray(values.shape, dtype=values.dtype, buffer=shm.buf)[:] = values
+            specs[name] = (shm.name, values.dtype.str, len(values))
+    except Exception:
+        release_blocks(blocks)
+        raise
+    return specs, blocks
+
+
+def attach_arrays(specs: BlockSpecs) -> Tuple[Dict[str, np.ndarray], list]:
+    """Array views on existing blocks. Returns (arrays, blocks to close)."""
+    arrays = {}
+    blocks = []
+    for name, (block_name, dtype, length) in specs.items():
+        shm = shared_memory.SharedMemory(name=block_name)
+        blocks.append(shm)
+        arrays[name] = np.ndarray((length,), dtype=np.dtype(dtype), buffer=shm.buf)
+    return arrays, blocks
+
+
+def release_blocks(blocks: list, unlink: bool = True) -> None:
+    """Close blocks; the owner also unlinks them. Drop array views first."""
+    for shm in blocks:
+        shm.close()
+        if unlink:
+            shm.unlink()
+
+
+def group_ranges(codes: np.ndarray, n_ranges: int) -> List[Tuple[int, int]]:
+    """
+    Split rows sorted by group code into at most `n_ranges` contiguous
+    (lo, hi) ranges of similar size. Cuts fall on group boundaries only.
+    """
+    n = len(codes)
+    if n == 0:
+        return []
+    group_starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    targets = np.arange(1, n_ranges) * n / n_ranges
+    cuts = group_starts[np.searchsorted(group_starts, targets).clip(max=len(group_starts) - 1)]
+    bounds = np.unique(np.r_[0, cuts, n])
+    return [(int(lo), int(hi)) for lo, hi in zip(bounds[:-1], bounds[1:])]
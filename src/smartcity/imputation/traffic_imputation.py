@@ -1,29 +1,116 @@
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from typing import List
 
 import numpy as np
 import pandas as pd
-
-
-def load_clean_traffic(input_path: str | Path) -> pd.DataFrame:
+import pyarrow.dataset as ds
+
+from smartcity.imputation.lane_fusion import run_lane_fusion
+from smartcity.imputation.models import run_ml_imputation
+from smartcity.imputation.shared import BlockSpecs, attach_arrays, group_ranges, release_blocks, share_arrays
+from smartcity.traffic.cleaning import time_filters
+from smartcity.traffic.profile_store import create_profile_store, frame_hash, open_profile_store
+from smartcity.traffic.profiles import WEEKDAYS, buckets_per_day, cell_index, cell_quantiles
+from smartcity.traffic.rolling import group_bounds, group_ends, interpolate_linear, rolling_median_centered
+from smartcity.traffic.schema import DERIVED_COLUMNS, FLAG_COLUMN, LABEL_COLUMNS, flag_values, is_compact, restore_derived
+
+
+PROFILE_MINUTES = 15
+ZERO_RUN_LIMIT = 5
+SPIKE_WINDOW = 7
+SPIKE_MIN_PERIODS = 3
+
+# layer order; reason/method codes used by impute_layers are index + 1
+LAYER_REASONS = ["ZERO_RUN_SHORT", "SPIKE", "PROFILE_SOFT"]
+IMPUTE_METHODS = ["NONE", "TEMPORAL_LINEAR", "ROLLING_MEDIAN", "PROFILE_MEDIAN"]
+
+# ranges per worker in parallel mode: smaller ranges even out sensors of different length
+RANGES_PER_WORKER = 4
+PROFILE_STATS = ["count_med", "dwell_med"]
+
+
+def parquet_projection(input_path: Path, columns: List[str] | None) -> List[str] | None:
+    """Columns to read; derived measures and labels of compact files are read as their inputs."""
+    if columns is None:
+        return None
+    names = ds.dataset(input_path, format="parquet", partitioning="hive").schema.names
+    wanted = list(columns)
+    if is_compact(names) and set(wanted) & set(DERIVED_COLUMNS):
+        wanted += ["count_raw", "dwell_raw", FLAG_COLUMN]
+    if is_compact(names) and set(wanted) & set(LABEL_COLUMNS):
+        wanted.append(FLAG_COLUMN)
+    return [c for c in dict.fromkeys(wanted) if c in names]
+
+
+def load_clean_traffic(
+    input_path: str | Path,
+    columns: List[str] | None = None,
+    start=None,
+    end=None,
+    sensor_ids: List[str] | None = None,
+) -> pd.DataFrame:
+    """
+    Load cleaned traffic in either output schema. Compact files (see
+    smartcity.traffic.schema) keep their flag bitmask, categoricals and
+    float32 measures; only the clean measures are restored.
+
+    Parquet input is read with column projection (`columns`) and the
+    timestamp range [start, end) and `sensor_ids` pushed down as row
+    filters. CSV input is filtered after parsing.
+    """
     input_path = Path(input_path)
 
     if not input_path.exists():
         raise FileNotFoundError(f"Input file not found: {input_path}")
 
-    if input_path.suffix == ".parquet":
-        return pd.read_parquet(input_path)
+    filters = time_filters("timestamp", start, end) or []
+    if sensor_ids is not None:
+        filters.append(("sensor_id", "in", list(sensor_ids)))
+
+    if input_path.suffix == ".parquet" or input_path.is_dir():
+        df = pd.read_parquet(
+            input_path,
+            columns=parquet_projection(input_path, columns),
+            filters=filters or None,
+        )
+        return restore_derived(df)
 
     if input_path.suffix == ".csv":
-        return pd.read_csv(input_path, parse_dates=["timestamp"])
+        df = pd.read_csv(input_path, parse_dates=["timestamp"])
+    elif input_path.suffixes[-2:] == [".csv", ".gz"]:
+        df = pd.read_csv(input_path, parse_dates=["timestamp"], compression="gzip")
+    else:
+        raise ValueError(f"Unsupported input format: {input_path}")
+
+    if filters:
+        ts = pd.to_datetime(df["timestamp"], utc=True)
+        keep = pd.Series(True, index=df.index)
+        for col, op, value in filters:
+            if col == "sensor_id":
+                keep &= df["sensor_id"].astype(str).isin(value)
+            else:
+                keep &= (ts >= value) if op == ">=" else (ts < value)
+        df = df[keep.to_numpy()]
+    if columns is not None:
+        df = df[[c for c in columns if c in df.columns]]
 
-    if input_path.suffixes[-2:] == [".csv", ".gz"]:
-        return pd.read_csv(input_path, parse_dates=["timestamp"], compression="gzip")
+    return restore_derived(df)
 
-    raise ValueError(f"Unsupported input format: {input_path}")
 
+def layer_rows(df: pd.DataFrame, reason: str) -> np.ndarray:
+    """
+    Rows labelled `reason` that cleaning marked imputable (all of them for
+    frames without the imputable flag).
+    """
+    rows = (df["missing_reason"] == reason).to_numpy()
+    if "imputable" in df.columns or is_compact(df.columns):
+        rows = rows & (flag_values(df, "imputable") == 1)
+    return rows
 
-def impute_zero_run_short(g: pd.DataFrame, limit: int = 5) -> pd.DataFrame:
-    mask = g["missing_reason"] == "ZERO_RUN_SHORT"
+
+def impute_zero_run_short(g: pd.DataFrame, limit: int = ZERO_RUN_LIMIT) -> pd.DataFrame:
+    mask = layer_rows(g, "ZERO_RUN_SHORT")
 
     g.loc[mask, "count_imputed"] = (
         g["count_imputed"]
@@ -39,8 +126,8 @@ def impute_zero_run_short(g: pd.DataFrame, limit: int = 5) -> pd.DataFrame:
     return g
 
 
-def impute_spike(g: pd.DataFrame, window: int = 7, min_periods: int = 3) -> pd.DataFrame:
-    mask = g["missing_reason"] == "SPIKE"
+def impute_spike(g: pd.DataFrame, window: int = SPIKE_WINDOW, min_periods: int = SPIKE_MIN_PERIODS) -> pd.DataFrame:
+    mask = layer_rows(g, "SPIKE")
 
     rolling_count_median = (
         g["count_imputed"]
@@ -61,7 +148,7 @@ def impute_spike(g: pd.DataFrame, window: int = 7, min_periods: int = 3) -> pd.D
     return g
 
 
-def add_time_profile_columns(df: pd.DataFrame, profile_minutes: int = 15) -> pd.DataFrame:
+def add_time_profile_columns(df: pd.DataFrame, profile_minutes: int = PROFILE_MINUTES) -> pd.DataFrame:
     df = df.copy()
 
     df["timestamp"] = pd.to_datetime(df["timestamp"], errors="coerce", utc=True)
@@ -75,7 +162,7 @@ def add_time_profile_columns(df: pd.DataFrame, profile_minutes: int = 15) -> pd.
 def build_profile_table(df: pd.DataFrame) -> pd.DataFrame:
     profile = (
         df[df["missing_reason"] == "NONE"]
-        .groupby(["sensor_id", "weekday", "bucket"])
+        .groupby(["sensor_id", "weekday", "bucket"], observed=True)
         .agg(
             count_med=("count_clean", "median"),
             dwell_med=("dwell_clean", "median"),
@@ -93,7 +180,7 @@ def impute_profile_soft(g: pd.DataFrame, profile: pd.DataFrame) -> pd.DataFrame:
         how="left",
     )
 
-    mask = g["missing_reason"] == "PROFILE_SOFT"
+    mask = layer_rows(g, "PROFILE_SOFT")
 
     g.loc[mask, "count_imputed"] = g.loc[mask, "count_med"]
     g.loc[mask, "dwell_imputed"] = g.loc[mask, "dwell_med"]
@@ -102,7 +189,63 @@ def impute_profile_soft(g: pd.DataFrame, profile: pd.DataFrame) -> pd.DataFrame:
     return g.drop(columns=["count_med", "dwell_med"])
 
 
-def run_layered_imputation(df: pd.DataFrame) -> pd.DataFrame:
+def dense_profile(profile: pd.DataFrame, sensor_ids: pd.Index, column: str) -> np.ndarray:
+    """Profile `column` scattered into a dense [sensor, weekday, bucket] array (NaN where absent)."""
+    dense = np.full(len(sensor_ids) * WEEKDAYS * buckets_per_day(PROFILE_MINUTES), np.nan)
+    codes = sensor_ids.get_indexer(profile["sensor_id"])
+    known = codes >= 0
+    cells = cell_index(
+        codes[known],
+        profile["weekday"].to_numpy(dtype=np.int64)[known],
+        profile["bucket"].to_numpy(dtype=np.int64)[known],
+        PROFILE_MINUTES,
+    )
+    dense[cells] = profile[column].to_numpy(dtype=np.float64)[known]
+    return dense
+
+
+def clean_profile_arrays(df: pd.DataFrame, n_sensors: int, cells: np.ndarray) -> dict:
+    """
+    Dense float32 [sensor, weekday, bucket] medians of count_clean and
+    dwell_clean over the rows with missing_reason NONE (NaN where absent),
+    the dense form of build_profile_table as the float32 profile store
+    keeps it.
+    """
+    n_cells = n_sensors * WEEKDAYS * buckets_per_day(PROFILE_MINUTES)
+    rows = (df["missing_reason"] == "NONE").to_numpy() & (cells >= 0)
+    return {
+        stat: cell_quantiles(cells[rows], df[column].to_numpy(dtype=np.float32)[rows], n_cells, [0.5])[0.5]
+        for stat, column in zip(PROFILE_STATS, ["count_clean", "dwell_clean"])
+    }
+
+
+def load_or_build_profiles(df: pd.DataFrame, sensor_ids: pd.Index, cells: np.ndarray, profile_store_dir: str | Path) -> dict:
+    """Profile medians from the imputation store under `profile_store_dir`, built first if it is not for this data."""
+    data_hash = frame_hash(df, ["timestamp", "sensor_id", "count_clean", "dwell_clean", "missing_reason"])
+    store = open_profile_store(profile_store_dir, "imputation", data_hash, PROFILE_MINUTES)
+    if store is None:
+        store = create_profile_store(profile_store_dir, "imputation", sensor_ids, PROFILE_STATS, PROFILE_MINUTES, data_hash)
+        store.write(sensor_ids, clean_profile_arrays(df, len(sensor_ids), cells))
+        store.finalize()
+        print(f"Profile store: built {store.root}")
+    else:
+        print(f"Profile store: reusing {store.root}")
+    return store.dense(sensor_ids)
+
+
+def prepare_layers(df: pd.DataFrame, profile_store_dir: str | Path | None = None) -> tuple[pd.DataFrame, dict]:
+    """
+    Sort `df` by (sensor_id, timestamp), add the profile keys and return it
+    with the flat arrays impute_layers works on:
+
+    - count, dwell: float64 values to impute (in place)
+    - reason: int8 index into LAYER_REASONS + 1 (0 = not imputed here)
+    - codes: sensor code per row (rows of a sensor are contiguous)
+    - cells: profile cell per row (-1 without timestamp)
+    - profile_count, profile_dwell: dense float64 profile medians per cell,
+      or the float32 medians of the profile store in `profile_store_dir`
+      when given (dwell rounded by up to ~5e-4)
+    """
     required_columns = {
         "timestamp",
         "sensor_id",
@@ -116,32 +259,158 @@ def run_layered_imputation(df: pd.DataFrame) -> pd.DataFrame:
         raise ValueError(f"Missing required columns: {missing_columns}")
 
     df = df.copy()
-    df = df.sort_values(["sensor_id", "timestamp"])
-
-    df["count_imputed"] = df["count_clean"]
-    df["dwell_imputed"] = df["dwell_clean"]
+    df = df.sort_values(["sensor_id", "timestamp"]).reset_index(drop=True)
+    # float64 even for compact (float32) input: interpolated and rolling
+    # values are written back into these columns
+    df["count_imputed"] = df["count_clean"].astype("float64")
+    df["dwell_imputed"] = df["dwell_clean"].astype("float64")
     df["impute_method"] = "NONE"
+    df = add_time_profile_columns(df, PROFILE_MINUTES)
+
+    codes, sensor_ids = pd.factorize(df["sensor_id"])
+    sensor_ids = pd.Index(sensor_ids)
+
+    has_key = df["timestamp"].notna().to_numpy()
+    cells = np.full(len(df), -1, dtype=np.int64)
+    cells[has_key] = cell_index(
+        codes[has_key],
+        df["weekday"].to_numpy()[has_key].astype(np.int64),
+        df["bucket"].to_numpy()[has_key].astype(np.int64),
+        PROFILE_MINUTES,
+    )
 
-    df = add_time_profile_columns(df)
-    profile = build_profile_table(df)
-
-    out = []
-
-    for _, g in df.groupby("sensor_id"):
-        g = g.sort_values("timestamp").copy()
-        g = impute_zero_run_short(g)
-        g = impute_spike(g)
-        g = impute_profile_soft(g, profile)
-        out.append(g)
-
-    df_imputed = pd.concat(out, ignore_index=True)
+    if profile_store_dir is None:
+        # float64 medians, as impute_profile_soft uses them
+        table = build_profile_table(df)
+        profile = {stat: dense_profile(table, sensor_ids, stat) for stat in PROFILE_STATS}
+    else:
+        profile = load_or_build_profiles(df, sensor_ids, cells, profile_store_dir)
+
+    reason = np.zeros(len(df), dtype=np.int8)
+    for i, name in enumerate(LAYER_REASONS, start=1):
+        reason[layer_rows(df, name)] = i
+
+    arrays = {
+        "count": df["count_imputed"].to_numpy(dtype=np.float64, copy=True),
+        "dwell": df["dwell_imputed"].to_numpy(dtype=np.float64, copy=True),
+        "reason": reason,
+        "codes": codes.astype(np.int64),
+        "cells": cells,
+        "profile_count": profile["count_med"].astype(np.float64),
+        "profile_dwell": profile["dwell_med"].astype(np.float64),
+    }
+    return df, arrays
+
+
+def impute_layers(
+    count: np.ndarray,
+    dwell: np.ndarray,
+    reason: np.ndarray,
+    codes: np.ndarray,
+    cells: np.ndarray,
+    profile_count: np.ndarray,
+    profile_dwell: np.ndarray,
+) -> np.ndarray:
+    """
+    Run the three layers over whole sensors, updating `count` and `dwell`
+    in place, and return the int8 IMPUTE_METHODS index per row. The arrays
+    may be any slice that starts and ends at sensor boundaries.
+    """
+    _, starts = group_bounds(codes)
+    ends = group_ends(codes)
+    method = np.zeros(len(count), dtype=np.int8)
+
+    # ZERO_RUN_SHORT -> TEMPORAL_LINEAR
+    mask = reason == 1
+    if mask.any():
+        count[mask] = interpolate_linear(count, ZERO_RUN_LIMIT, starts, ends)[mask]
+        dwell[mask] = interpolate_linear(dwell, ZERO_RUN_LIMIT, starts, ends)[mask]
+    method[mask & ~np.isnan(count)] = 1
+
+    # SPIKE -> ROLLING_MEDIAN (reads the zero-run fills)
+    mask = reason == 2
+    if mask.any():
+        count[mask] = rolling_median_centered(count, SPIKE_WINDOW, SPIKE_MIN_PERIODS, codes)[mask]
+        dwell[mask] = rolling_median_centered(dwell, SPIKE_WINDOW, SPIKE_MIN_PERIODS, codes)[mask]
+    method[mask & ~np.isnan(count)] = 2
+
+    # PROFILE_SOFT -> PROFILE_MEDIAN
+    mask = reason == 3
+    if mask.any():
+        rows = mask & (cells >= 0)
+        count[mask] = np.nan
+        dwell[mask] = np.nan
+        count[rows] = profile_count[cells[rows]]
+        dwell[rows] = profile_dwell[cells[rows]]
+    method[mask & ~np.isnan(count)] = 3
+
+    return method
+
+
+def finish_layers(df: pd.DataFrame, count: np.ndarray, dwell: np.ndarray, method: np.ndarray) -> pd.DataFrame:
+    df["count_imputed"] = count
+    df["dwell_imputed"] = dwell
+    df["impute_method"] = np.asarray(IMPUTE_METHODS, dtype=object)[method]
 
     helper_cols = ["weekday", "minute", "bucket"]
-    df_imputed = df_imputed.drop(
-        columns=[c for c in helper_cols if c in df_imputed.columns]
-    )
-
-    return df_imputed
+    return df.drop(columns=[c for c in helper_cols if c in df.columns])
+
+
+def impute_range(specs: BlockSpecs, lo: int, hi: int) -> None:
+    """Worker: run impute_layers on rows [lo, hi) of the shared arrays, in place."""
+    arrays, blocks = attach_arrays(specs)
+    try:
+        arrays["method"][lo:hi] = impute_layers(
+            arrays["count"][lo:hi],
+            arrays["dwell"][lo:hi],
+            arrays["reason"][lo:hi],
+            arrays["codes"][lo:hi],
+            arrays["cells"][lo:hi],
+            arrays["profile_count"],
+            arrays["profile_dwell"],
+        )
+        del arrays
+    finally:
+        release_blocks(blocks, unlink=False)
+
+
+def impute_layers_parallel(arrays: dict, workers: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    impute_layers over shared memory: each task gets a contiguous range of
+    whole sensors. Layers are per sensor, so the result does not depend on
+    `workers` or on the ranges.
+    """
+    arrays = dict(arrays, method=np.zeros(len(arrays["count"]), dtype=np.int8))
+    ranges = group_ranges(arrays["codes"], workers * RANGES_PER_WORKER)
+
+    specs, blocks = share_arrays(arrays)
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(impute_range, [specs] * len(ranges), [lo for lo, _ in ranges], [hi for _, hi in ranges]))
+        shared, views = attach_arrays({name: specs[name] for name in ["count", "dwell", "method"]})
+        count, dwell, method = (shared[name].copy() for name in ["count", "dwell", "method"])
+        del shared
+        release_blocks(views, unlink=False)
+    finally:
+        release_blocks(blocks)
+    return count, dwell, method
+
+
+def run_layered_imputation(df: pd.DataFrame, workers: int = 1, profile_store_dir: str | Path | None = None) -> pd.DataFrame:
+    """
+    ZERO_RUN_SHORT interpolation, SPIKE rolling median and PROFILE_SOFT
+    profile median, each run over all sensors at once with group-aware
+    kernels. Results equal applying impute_zero_run_short, impute_spike
+    and impute_profile_soft to every sensor in turn. With `workers` > 1,
+    ranges of sensors are imputed by a process pool over shared memory.
+    """
+    df, arrays = prepare_layers(df, profile_store_dir)
+    if workers > 1 and len(df):
+        count, dwell, method = impute_layers_parallel(arrays, workers)
+    else:
+        count, dwell = arrays["count"], arrays["dwell"]
+        method = impute_layers(**arrays)
+    return finish_layers(df, count, dwell, method)
 
 
 def save_imputed_traffic(df: pd.DataFrame, output_path: str | Path) -> Path:
@@ -163,9 +432,61 @@ def save_imputed_traffic(df: pd.DataFrame, output_path: str | Path) -> Path:
 def run_traffic_imputation(
     input_path: str | Path,
     output_path: str | Path,
+    start=None,
+    end=None,
+    sensor_ids: List[str] | None = None,
+    workers: int = 1,
+    lane_metadata: str | Path | None = None,
+    scale_cache_dir: str | Path | None = None,
+    scale_train_start=None,
+    scale_train_end=None,
+    ml_model: str | None = None,
+    ml_model_dir: str | Path | None = None,
+    intersection_id: str | None = None,
+    ml_train_start=None,
+    ml_train_end=None,
+    profile_store_dir: str | Path | None = None,
 ) -> Path:
-    df = load_clean_traffic(input_path)
-    df_imputed = run_layered_imputation(df)
+    """
+    Layered imputation, optionally followed by the loop <-> video lane
+    fusion layer when `lane_metadata` is given. Scales are cached in
+    `scale_cache_dir` (default: `lane_scales/` next to the output).
+
+    With `ml_model` ("ridge", "rf" or "xgb"), minutes still missing are
+    filled by per-sensor models from the registry in `ml_model_dir`
+    (default: `models/` next to the output), trained on first use.
+    `intersection_id` defaults to the input file name prefix.
+
+    With `profile_store_dir`, the PROFILE_SOFT medians come from the
+    imputation profile store under it, rebuilt only when the input data
+    changes.
+    """
+    df = load_clean_traffic(input_path, start=start, end=end, sensor_ids=sensor_ids)
+    df_imputed = run_layered_imputation(df, workers=workers, profile_store_dir=profile_store_dir)
+    if lane_metadata is not None:
+        if scale_cache_dir is None:
+            scale_cache_dir = Path(output_path).parent / "lane_scales"
+        df_imputed = run_lane_fusion(
+            df_imputed,
+            lane_metadata,
+            scale_cache_dir,
+            train_start=scale_train_start,
+            train_end=scale_train_end,
+        )
+    if ml_model is not None:
+        if ml_model_dir is None:
+            ml_model_dir = Path(output_path).parent / "models"
+        if intersection_id is None:
+            intersection_id = Path(input_path).name.split("_")[0]
+        df_imputed = run_ml_imputation(
+            df_imputed,
+            ml_model_dir,
+            intersection_id,
+            model_name=ml_model,
+            train_start=ml_train_start,
+            train_end=ml_train_end,
+            workers=workers,
+        )
     save_imputed_traffic(df_imputed, output_path)
 
     print("Traffic imputation finished.")
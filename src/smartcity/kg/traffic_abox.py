@@ -7,6 +7,8 @@ import datetime as dt
 
 import duckdb
 
+from smartcity.traffic.store import aggregate_table, traffic_source
+
 
 NS_EX = "http://example.org/traffic/"
 NS_SC = "http://example.org/smartcity/core#"
@@ -103,19 +105,25 @@ def is_valid_number(x) -> bool:
 
 
 def build_traffic_abox(
-    input_parquet: str | Path,
+    input_parquet: str | Path | None,
     output_nt_gz: str | Path,
     sensor_map_json: str | Path,
     sensor_to_lane_json: str | Path,
     batch_size: int = 100_000,
     threads: int = 8,
+    store_path: str | Path | None = None,
+    freq: str = "10min",
 ) -> Path:
-    input_parquet = Path(input_parquet)
+    """
+    Write traffic observations as N-Triples from the aggregated parquet
+    `input_parquet`, or with `store_path` from the `freq` aggregate table
+    of the DuckDB traffic store.
+    """
     output_nt_gz = Path(output_nt_gz)
     sensor_map_json = Path(sensor_map_json)
     sensor_to_lane_json = Path(sensor_to_lane_json)
 
-    if not input_parquet.exists():
+    if store_path is None and not Path(input_parquet).exists():
         raise FileNotFoundError(f"Input parquet not found: {input_parquet}")
 
     output_nt_gz.parent.mkdir(parents=True, exist_ok=True)
@@ -137,7 +145,7 @@ def build_traffic_abox(
     con.execute(f"PRAGMA threads={threads};")
     con.execute("SET preserve_insertion_order=false;")
 
-    input_sql = input_parquet.as_posix()
+    source, _ = traffic_source(con, input_parquet, store_path, aggregate_table(freq))
 
     total_obs = 0
     total_time_instants = 0
@@ -145,7 +153,7 @@ def build_traffic_abox(
     with gzip.open(output_nt_gz, "wt", encoding="utf-8") as fout:
         q_time = f"""
         SELECT DISTINCT timestamp
-        FROM read_parquet('{input_sql}')
+        FROM {source}
         WHERE timestamp IS NOT NULL
         """
 
@@ -186,7 +194,7 @@ def build_traffic_abox(
             imputed_rate,
             is_clean_observed_rate,
             freq
-        FROM read_parquet('{input_sql}')
+        FROM {source}
         WHERE sensor_id IS NOT NULL
           AND timestamp IS NOT NULL
           AND (count_agg IS NOT NULL OR occupancy_time_agg IS NOT NULL)
@@ -1,7 +1,16 @@
+import math
+from functools import reduce
 from pathlib import Path
+from typing import Dict, List
 
 import duckdb
 
+from smartcity.traffic.aggregation_validation import write_validation_reports
+from smartcity.traffic.hierarchy import load_sensor_hierarchy, rollup_sql
+from smartcity.traffic.io import INTERSECTION_ID_PAT
+from smartcity.traffic.schema import flag_sql
+from smartcity.traffic.store import traffic_source
+
 
 def frequency_to_seconds(freq: str) -> int:
     freq = freq.lower().strip()
@@ -12,8 +21,11 @@ def frequency_to_seconds(freq: str) -> int:
     if freq.endswith("h"):
         return int(freq.replace("h", "")) * 3600
 
+    if freq.endswith("d"):
+        return int(freq.replace("d", "")) * 86400
+
     raise ValueError(
-        f"Unsupported frequency: {freq}. Use examples like '10min', '30min', or '1h'."
+        f"Unsupported frequency: {freq}. Use examples like '10min', '30min', '1h' or '1d'."
     )
 
 
@@ -21,29 +33,41 @@ def frequency_to_label(freq: str) -> str:
     return freq.lower().strip().replace("min", "min").replace("h", "h")
 
 
-def run_traffic_aggregation(
-    input_path: str | Path,
-    output_path: str | Path,
-    freq: str = "10min",
-    threads: int = 8,
-) -> Path:
-    input_path = Path(input_path)
-    output_path = Path(output_path)
-
-    if not input_path.exists():
-        raise FileNotFoundError(f"Input file not found: {input_path}")
+def mode_sql(table: str, column: str, time_key: str, weight: str) -> str:
+    """
+    CTEs {column}_counts and {column}_mode: per (sensor_id, `time_key`) the
+    most frequent non-null `column` value (`weight` rows per value; ties go
+    to the smallest value) and the number of distinct values.
+    """
+    return f"""
+      {column}_counts AS (
+        SELECT sensor_id, {time_key}, {column}, {weight} AS n
+        FROM {table}
+        WHERE {column} IS NOT NULL
+        GROUP BY sensor_id, {time_key}, {column}
+      ),
+      {column}_mode AS (
+        SELECT
+          sensor_id,
+          {time_key},
+          FIRST({column} ORDER BY n DESC, {column}) AS {column}_mode,
+          COUNT(*) AS {column}_nunique
+        FROM {column}_counts
+        GROUP BY sensor_id, {time_key}
+      )"""
 
-    output_path.parent.mkdir(parents=True, exist_ok=True)
 
+def aggregation_sql(source: str, columns: List[str], freq: str) -> str:
+    """
+    Aggregation query over minute rows from `source` (any DuckDB table
+    expression: read_parquet(...), a registered Arrow table, a view).
+    `columns` are the source's column names (wide or compact schema).
+    """
     freq_seconds = frequency_to_seconds(freq)
     freq_ms = freq_seconds * 1000
     freq_label = frequency_to_label(freq)
 
-    con = duckdb.connect(database=":memory:")
-    con.execute(f"PRAGMA threads={threads};")
-
-    query = f"""
-    COPY (
+    return f"""
       WITH base AS (
         SELECT
           sensor_id,
@@ -55,17 +79,17 @@ def run_traffic_aggregation(
           TRY_CAST(count_imputed AS DOUBLE) AS count_imputed,
           TRY_CAST(dwell_imputed AS DOUBLE) AS dwell_imputed,
 
-          CASE WHEN COALESCE(soft_flag, 0) IN (1, TRUE) THEN 1 ELSE 0 END AS soft_flag,
-          CASE WHEN COALESCE(profile_flag_hard, 0) IN (1, TRUE) THEN 1 ELSE 0 END AS profile_flag_hard,
-          CASE WHEN COALESCE(spike_flag, 0) IN (1, TRUE) THEN 1 ELSE 0 END AS spike_flag,
+          {flag_sql('soft_flag', columns)} AS soft_flag,
+          {flag_sql('profile_flag_hard', columns)} AS profile_flag_hard,
+          {flag_sql('spike_flag', columns)} AS spike_flag,
 
-          CASE WHEN COALESCE(is_clean_observed, 0) IN (1, TRUE) THEN 1 ELSE 0 END AS is_clean_observed,
-          CASE WHEN COALESCE(imputable, 0) IN (1, TRUE) THEN 1 ELSE 0 END AS imputable,
+          {flag_sql('is_clean_observed', columns)} AS is_clean_observed,
+          {flag_sql('imputable', columns)} AS imputable,
 
           NULLIF(TRIM(CAST(impute_method AS VARCHAR)), '') AS impute_method,
           NULLIF(TRIM(CAST(missing_reason AS VARCHAR)), '') AS missing_reason
 
-        FROM read_parquet('{input_path.as_posix()}')
+        FROM {source}
         WHERE timestamp IS NOT NULL AND sensor_id IS NOT NULL
       ),
 
@@ -93,14 +117,6 @@ def run_traffic_aggregation(
           MAX(spike_flag) AS spike_flag_any,
           AVG(spike_flag) AS spike_flag_rate,
 
-          MODE(impute_method) AS impute_method_mode,
-          COUNT(DISTINCT impute_method) FILTER (WHERE impute_method IS NOT NULL)
-            AS impute_method_nunique,
-
-          MODE(missing_reason) AS missing_reason_mode,
-          COUNT(DISTINCT missing_reason) FILTER (WHERE missing_reason IS NOT NULL)
-            AS missing_reason_nunique,
-
           COUNT(*) AS minute_rows,
           SUM(CASE WHEN count_imputed IS NOT NULL THEN 1 ELSE 0 END) AS available_count_minutes,
           SUM(CASE WHEN dwell_imputed IS NOT NULL THEN 1 ELSE 0 END) AS available_dwell_minutes,
@@ -111,7 +127,9 @@ def run_traffic_aggregation(
 
         FROM base
         GROUP BY sensor_id, timestamp
-      )
+      ),
+      {mode_sql("base", "impute_method", "timestamp", "COUNT(*)")},
+      {mode_sql("base", "missing_reason", "timestamp", "COUNT(*)")}
 
       SELECT
         sensor_id,
@@ -142,10 +160,10 @@ def run_traffic_aggregation(
         spike_flag_rate,
 
         impute_method_mode,
-        impute_method_nunique,
+        COALESCE(impute_method_nunique, 0) AS impute_method_nunique,
 
         missing_reason_mode,
-        missing_reason_nunique,
+        COALESCE(missing_reason_nunique, 0) AS missing_reason_nunique,
 
         minute_rows,
         available_count_minutes,
@@ -171,17 +189,355 @@ def run_traffic_aggregation(
         '{freq_label}' AS freq
 
       FROM agg
+      LEFT JOIN impute_method_mode USING (sensor_id, timestamp)
+      LEFT JOIN missing_reason_mode USING (sensor_id, timestamp)
       ORDER BY sensor_id, timestamp
-    ) TO '{output_path.as_posix()}' (FORMAT PARQUET);
     """
 
-    con.execute(query)
+
+def run_traffic_aggregation(
+    input_path: str | Path | None,
+    output_path: str | Path,
+    freq: str = "10min",
+    threads: int = 8,
+    summary_output: str | Path | None = None,
+    sensor_output: str | Path | None = None,
+    store_path: str | Path | None = None,
+    rollup_output: str | Path | None = None,
+    sensor_to_lane_json: str | Path | List[str | Path] | None = None,
+    lane_map_json: str | Path | List[str | Path] | None = None,
+    intersection_id: str | None = None,
+) -> Path:
+    """
+    Aggregate minute traffic to `freq`, from the parquet `input_path` or
+    with `store_path` from the minute table of the DuckDB traffic store.
+    With `summary_output` and/or `sensor_output`, the validation reports
+    are computed from the same scan: the aggregate is kept as a DuckDB
+    table, written to Parquet and its summary and per-sensor statistics
+    taken from one GROUPING SETS query over it. With `rollup_output` and
+    the intersection maps, lane, street and intersection rollups
+    (hierarchy.py) are written from that table as well; its sensors belong
+    to `intersection_id` (default: the input file name prefix).
+    """
+    output_path = Path(output_path)
+
+    if store_path is None and not Path(input_path).exists():
+        raise FileNotFoundError(f"Input file not found: {input_path}")
+    if rollup_output is not None and (sensor_to_lane_json is None or lane_map_json is None):
+        raise ValueError("Rollups need the sensor to lane and lane maps of build_intersection_abox.")
+    if rollup_output is not None and intersection_id is None:
+        m = INTERSECTION_ID_PAT.match(Path(input_path).name) if input_path is not None else None
+        if m is None:
+            raise ValueError("Rollups need intersection_id when the input name does not start with it.")
+        intersection_id = m.group("iid")
+
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+
+    freq_seconds = frequency_to_seconds(freq)
+
+    con = duckdb.connect(database=":memory:")
+    con.execute(f"PRAGMA threads={threads};")
+
+    # wide (one column per flag) or compact (uint16 `flags` bitmask) schema
+    source, columns = traffic_source(con, input_path, store_path)
+    validate = summary_output is not None or sensor_output is not None
+    if validate or rollup_output is not None:
+        con.execute(f"CREATE TEMP TABLE traffic_agg AS {aggregation_sql(source, columns, freq)}")
+        con.execute(f"COPY traffic_agg TO '{output_path.as_posix()}' (FORMAT PARQUET);")
+        if validate:
+            write_validation_reports(con, "traffic_agg", summary_output, sensor_output, frequency_to_label(freq))
+        if rollup_output is not None:
+            Path(rollup_output).parent.mkdir(parents=True, exist_ok=True)
+            con.register("sensor_hierarchy", load_sensor_hierarchy(sensor_to_lane_json, lane_map_json))
+            con.execute(f"CREATE TEMP VIEW traffic_agg_sensors AS SELECT '{intersection_id}' AS intersection_id, * FROM traffic_agg")
+            con.execute(f"COPY ({rollup_sql('traffic_agg_sensors', 'sensor_hierarchy', freq_seconds)}) TO '{Path(rollup_output).as_posix()}' (FORMAT PARQUET);")
+    else:
+        query = f"""
+        COPY (
+          {aggregation_sql(source, columns, freq)}
+        ) TO '{output_path.as_posix()}' (FORMAT PARQUET);
+        """
+        con.execute(query)
     con.close()
 
     print("Traffic aggregation finished.")
-    print(f"Input: {input_path}")
+    print(f"Input: {store_path or input_path}")
     print(f"Output: {output_path}")
     print(f"Frequency: {freq}")
     print(f"Frequency seconds: {freq_seconds}")
+    for name, path in (("summary", summary_output), ("sensor report", sensor_output), ("rollups", rollup_output)):
+        if path is not None:
+            print(f"Saved {name}: {path}")
+
+    return output_path
+
+
+# per-(sensor, bucket, impute_method, missing_reason) sums; every output
+# column of run_traffic_aggregation is a function of these, and they add up
+# from finer to coarser buckets
+CASCADE_SUMS = [
+    "minute_rows",
+    "available_count_minutes",
+    "available_dwell_minutes",
+    "imputed_minutes",
+    "missing_minutes",
+    "count_agg",
+    "occupancy_time_agg",
+    "soft_flag_sum",
+    "profile_flag_hard_sum",
+    "spike_flag_sum",
+    "is_clean_observed_sum",
+    "imputable_sum",
+]
+
+
+def cascade_plan(freqs: List[str]) -> tuple[int, Dict[int, int]]:
+    """
+    Base bucket (gcd of all frequencies, in seconds) and, per frequency in
+    seconds, the bucket it is rolled up from: the coarsest finer level that
+    divides it.
+    """
+    seconds = sorted({frequency_to_seconds(f) for f in freqs})
+    base = reduce(math.gcd, seconds)
+    levels = [base] + [s for s in seconds if s != base]
+    plan = {}
+    for i, level in enumerate(levels[1:], start=1):
+        plan[level] = max(src for src in levels[:i] if level % src == 0)
+    return base, plan
+
+
+def cascade_output_sql(cells: str, freq_seconds: int, freq_label: str) -> str:
+    """Final aggregation columns of one level from its cells table."""
+    sums = ",\n          ".join(f"SUM({c}) AS {c}" for c in CASCADE_SUMS)
+    return f"""
+      WITH agg AS (
+        SELECT
+          sensor_id,
+          ts,
+          {sums}
+        FROM {cells}
+        GROUP BY sensor_id, ts
+      ),
+      {mode_sql(cells, "impute_method", "ts", "SUM(minute_rows)")},
+      {mode_sql(cells, "missing_reason", "ts", "SUM(minute_rows)")}
+
+      SELECT
+        agg.sensor_id,
+        to_timestamp(agg.ts) AS timestamp,
+
+        available_count_minutes::DOUBLE / minute_rows AS coverage_count,
+        available_dwell_minutes::DOUBLE / minute_rows AS coverage_dwell,
+
+        count_agg,
+        occupancy_time_agg,
+
+        CASE
+          WHEN count_agg IS NOT NULL AND count_agg > 0
+          THEN occupancy_time_agg / count_agg
+          ELSE NULL
+        END AS avg_dwell_agg,
+
+        is_clean_observed_sum::DOUBLE / minute_rows AS is_clean_observed_rate,
+        imputable_sum::DOUBLE / minute_rows AS imputable_rate,
+
+        (soft_flag_sum > 0)::INTEGER AS soft_flag_any,
+        soft_flag_sum::DOUBLE / minute_rows AS soft_flag_rate,
+
+        (profile_flag_hard_sum > 0)::INTEGER AS profile_flag_hard_any,
+        profile_flag_hard_sum::DOUBLE / minute_rows AS profile_flag_hard_rate,
+
+        (spike_flag_sum > 0)::INTEGER AS spike_flag_any,
+        spike_flag_sum::DOUBLE / minute_rows AS spike_flag_rate,
+
+        impute_method_mode,
+        COALESCE(impute_method_nunique, 0) AS impute_method_nunique,
+
+        missing_reason_mode,
+        COALESCE(missing_reason_nunique, 0) AS missing_reason_nunique,
+
+        minute_rows::BIGINT AS minute_rows,
+        available_count_minutes,
+        available_dwell_minutes,
+        imputed_minutes,
+        missing_minutes,
+
+        CASE
+          WHEN minute_rows > 0
+          THEN imputed_minutes::DOUBLE / minute_rows
+          ELSE NULL
+        END AS imputed_rate,
+
+        CASE
+          WHEN occupancy_time_agg IS NOT NULL
+          THEN occupancy_time_agg / {freq_seconds * 1000}.0
+          ELSE NULL
+        END AS occupancy_ratio,
+
+        EXTRACT(dow FROM to_timestamp(agg.ts)) AS weekday,
+        (EXTRACT(hour FROM to_timestamp(agg.ts)) * 60 + EXTRACT(minute FROM to_timestamp(agg.ts)))::INTEGER AS minute,
+
+        '{freq_label}' AS freq
+
+      FROM agg
+      LEFT JOIN impute_method_mode USING (sensor_id, ts)
+      LEFT JOIN missing_reason_mode USING (sensor_id, ts)
+    """
+
+
+def cascade_cells_sql(source: str, columns: List[str], base: int, where: str = "") -> str:
+    """
+    Query of the composable cells (see CASCADE_SUMS) of minute rows from
+    `source`, in `base`-second buckets. `where` adds row conditions
+    (starting with AND).
+    """
+    return f"""
+    WITH base AS (
+      SELECT
+        sensor_id,
+        (FLOOR(EXTRACT(EPOCH FROM CAST(timestamp AS TIMESTAMPTZ)) / {base}) * {base})::BIGINT AS ts,
+
+        TRY_CAST(count_imputed AS DOUBLE) AS count_imputed,
+        TRY_CAST(dwell_imputed AS DOUBLE) AS dwell_imputed,
+
+        {flag_sql('soft_flag', columns)} AS soft_flag,
+        {flag_sql('profile_flag_hard', columns)} AS profile_flag_hard,
+        {flag_sql('spike_flag', columns)} AS spike_flag,
+
+        {flag_sql('is_clean_observed', columns)} AS is_clean_observed,
+        {flag_sql('imputable', columns)} AS imputable,
+
+        NULLIF(TRIM(CAST(impute_method AS VARCHAR)), '') AS impute_method,
+        NULLIF(TRIM(CAST(missing_reason AS VARCHAR)), '') AS missing_reason
+
+      FROM {source}
+      WHERE timestamp IS NOT NULL AND sensor_id IS NOT NULL{where}
+    )
+    SELECT
+      sensor_id,
+      ts,
+      impute_method,
+      missing_reason,
+      COUNT(*) AS minute_rows,
+      COUNT(count_imputed) AS available_count_minutes,
+      COUNT(dwell_imputed) AS available_dwell_minutes,
+      SUM(CASE WHEN impute_method IS NOT NULL AND impute_method <> 'NONE' THEN 1 ELSE 0 END) AS imputed_minutes,
+      SUM(CASE WHEN count_imputed IS NULL OR dwell_imputed IS NULL THEN 1 ELSE 0 END) AS missing_minutes,
+      SUM(count_imputed) AS count_agg,
+      SUM(dwell_imputed) AS occupancy_time_agg,
+      SUM(soft_flag) AS soft_flag_sum,
+      SUM(profile_flag_hard) AS profile_flag_hard_sum,
+      SUM(spike_flag) AS spike_flag_sum,
+      SUM(is_clean_observed) AS is_clean_observed_sum,
+      SUM(imputable) AS imputable_sum
+    FROM base
+    GROUP BY sensor_id, ts, impute_method, missing_reason
+    """
+
+
+def create_cascade_tables(
+    con: duckdb.DuckDBPyConnection,
+    source: str,
+    columns: List[str],
+    freqs: List[str],
+    where: str = "",
+) -> None:
+    """
+    Temp tables `cells_{seconds}` for the base bucket and every frequency in
+    `freqs`: one scan of `source` into base cells, then each level rolled up
+    from the level cascade_plan assigns it.
+    """
+    base, plan = cascade_plan(freqs)
+    con.execute(f"CREATE OR REPLACE TEMP TABLE cells_{base} AS {cascade_cells_sql(source, columns, base, where)}")
+
+    sums = ", ".join(f"SUM({c}) AS {c}" for c in CASCADE_SUMS)
+    for level, finer in plan.items():
+        con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE cells_{level} AS
+        SELECT
+          sensor_id,
+          (ts // {level}) * {level} AS ts,
+          impute_method,
+          missing_reason,
+          {sums}
+        FROM cells_{finer}
+        GROUP BY 1, 2, 3, 4
+        """)
+
+
+def run_traffic_aggregation_cascade(
+    input_path: str | Path | None,
+    output_path: str | Path,
+    freqs: List[str],
+    threads: int = 8,
+    partition_by_freq: bool = False,
+    store_path: str | Path | None = None,
+) -> Dict[str, Path]:
+    """
+    Aggregate to every frequency in `freqs` from one scan of the minute data.
+
+    The scan groups minutes into composable sums per (sensor, base bucket,
+    impute_method, missing_reason), with the base bucket the gcd of all
+    frequencies. Each coarser level is rolled up from the coarsest finer
+    level that divides it; modes come from the carried per-value minute
+    counts (ties go to the smallest value). Output columns match
+    run_traffic_aggregation.
+
+    Writes `{output_path}/traffic_agg_{freq}.parquet` per frequency, or with
+    `partition_by_freq` one hive dataset at `output_path` partitioned by
+    `freq`. With `store_path` the minute data is read from the DuckDB
+    traffic store instead of `input_path`.
+    """
+    output_path = Path(output_path)
+
+    if store_path is None and not Path(input_path).exists():
+        raise FileNotFoundError(f"Input file not found: {input_path}")
+    if not freqs:
+        raise ValueError("No aggregation frequencies given.")
+
+    labels = {frequency_to_seconds(f): frequency_to_label(f) for f in freqs}
+    if len(labels) != len(freqs):
+        raise ValueError(f"Duplicate aggregation frequencies: {freqs}")
+    base, plan = cascade_plan(freqs)
+
+    con = duckdb.connect(database=":memory:")
+    con.execute(f"PRAGMA threads={threads};")
+
+    source, columns = traffic_source(con, input_path, store_path)
+    create_cascade_tables(con, source, columns, freqs)
+
+    outputs = {}
+    if partition_by_freq:
+        output_path.mkdir(parents=True, exist_ok=True)
+        union = "\nUNION ALL\n".join(
+            f"SELECT * FROM ({cascade_output_sql(f'cells_{level}', level, label)})"
+            for level, label in labels.items()
+        )
+        con.execute(f"""
+        COPY (
+          SELECT * FROM ({union})
+          ORDER BY freq, sensor_id, timestamp
+        ) TO '{output_path.as_posix()}' (FORMAT PARQUET, PARTITION_BY (freq), OVERWRITE_OR_IGNORE)
+        """)
+        outputs = {label: output_path / f"freq={label}" for label in labels.values()}
+    else:
+        output_path.mkdir(parents=True, exist_ok=True)
+        for level, label in labels.items():
+            path = output_path / f"traffic_agg_{label}.parquet"
+            con.execute(f"""
+            COPY (
+              {cascade_output_sql(f'cells_{level}', level, label)}
+              ORDER BY sensor_id, timestamp
+            ) TO '{path.as_posix()}' (FORMAT PARQUET)
+            """)
+            outputs[label] = path
+    con.close()
+
+    print("Traffic aggregation cascade finished.")
+    print(f"Input: {store_path or input_path}")
+    print(f"Output: {output_path}")
+    print(f"Base bucket seconds: {base}")
+    for level, label in labels.items():
+        source = f"{plan[level]} s buckets" if level in plan else "minute rows"
+        print(f"  {label}: from {source}")
 
-    return output_path
\ No newline at end of file
+    return outputs
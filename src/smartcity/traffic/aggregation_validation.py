@@ -1,121 +1,138 @@
 from pathlib import Path
 
 import duckdb
+import pandas as pd
+
+from smartcity.traffic.store import aggregate_table, traffic_source
+
+
+# (column, expression) of every validation statistic; the summary and the
+# per-sensor report are the same statistics over all rows and per sensor
+VALIDATION_STATS = [
+    ("rows_total", "COUNT(*)"),
+    ("sensor_count", "COUNT(DISTINCT sensor_id)"),
+    ("start_timestamp", "MIN(timestamp)"),
+    ("end_timestamp", "MAX(timestamp)"),
+    ("coverage_count_mean", "AVG(coverage_count)"),
+    ("coverage_count_min", "MIN(coverage_count)"),
+    ("coverage_dwell_mean", "AVG(coverage_dwell)"),
+    ("coverage_dwell_min", "MIN(coverage_dwell)"),
+    ("imputed_rate_mean", "AVG(imputed_rate)"),
+    ("imputed_rate_max", "MAX(imputed_rate)"),
+    ("count_null_rate", "AVG(CASE WHEN count_agg IS NULL THEN 1 ELSE 0 END)"),
+    ("occupancy_null_rate", "AVG(CASE WHEN occupancy_time_agg IS NULL THEN 1 ELSE 0 END)"),
+    ("count_min", "MIN(count_agg)"),
+    ("count_max", "MAX(count_agg)"),
+    ("count_mean", "AVG(count_agg)"),
+    ("occupancy_time_min", "MIN(occupancy_time_agg)"),
+    ("occupancy_time_max", "MAX(occupancy_time_agg)"),
+    ("occupancy_time_mean", "AVG(occupancy_time_agg)"),
+    ("occupancy_ratio_min", "MIN(occupancy_ratio)"),
+    ("occupancy_ratio_max", "MAX(occupancy_ratio)"),
+    ("occupancy_ratio_mean", "AVG(occupancy_ratio)"),
+    ("soft_flag_rate_mean", "AVG(soft_flag_rate)"),
+    ("profile_flag_hard_rate_mean", "AVG(profile_flag_hard_rate)"),
+    ("spike_flag_rate_mean", "AVG(spike_flag_rate)"),
+    ("expected_freq_rate", "AVG(CASE WHEN freq = '{expected_freq}' THEN 1 ELSE 0 END)"),
+]
+
+SUMMARY_COLUMNS = [name for name, _ in VALIDATION_STATS]
+SENSOR_COLUMNS = ["sensor_id"] + [
+    name for name in SUMMARY_COLUMNS
+    if name not in ("sensor_count", "occupancy_time_min", "occupancy_time_max", "occupancy_time_mean")
+]
+
+
+def validation_stats_sql(source: str, expected_freq: str = "10min") -> str:
+    """
+    Summary and per-sensor statistics of the aggregate in `source` (any
+    DuckDB table expression) in one pass: GROUPING SETS ((sensor_id), ()),
+    with is_total = 1 on the summary row.
+    """
+    stats = ",\n            ".join(f"{expr.format(expected_freq=expected_freq)} AS {name}" for name, expr in VALIDATION_STATS)
+    return f"""
+        SELECT
+            sensor_id,
+            GROUPING(sensor_id) AS is_total,
+            {stats}
+        FROM {source}
+        GROUP BY GROUPING SETS ((sensor_id), ())
+    """
+
+
+def create_validation_stats(con: duckdb.DuckDBPyConnection, source: str, expected_freq: str = "10min") -> str:
+    """Materialise validation_stats_sql as the temp table `validation_stats` and return its name."""
+    con.execute(f"CREATE OR REPLACE TEMP TABLE validation_stats AS {validation_stats_sql(source, expected_freq)}")
+    return "validation_stats"
+
+
+def summary_select(stats_table: str) -> str:
+    return f"SELECT {', '.join(SUMMARY_COLUMNS)} FROM {stats_table} WHERE is_total = 1"
+
+
+def sensor_select(stats_table: str) -> str:
+    return f"SELECT {', '.join(SENSOR_COLUMNS)} FROM {stats_table} WHERE is_total = 0 ORDER BY sensor_id"
+
+
+def write_validation_reports(
+    con: duckdb.DuckDBPyConnection,
+    source: str,
+    summary_output: str | Path | None,
+    sensor_output: str | Path | None,
+    expected_freq: str = "10min",
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Compute the validation statistics of `source` in one pass, write the
+    reports that have a path (CSV) and return (summary, per-sensor) frames.
+    """
+    stats_table = create_validation_stats(con, source, expected_freq)
+    for select, output in ((summary_select, summary_output), (sensor_select, sensor_output)):
+        if output is not None:
+            Path(output).parent.mkdir(parents=True, exist_ok=True)
+            con.execute(f"COPY ({select(stats_table)}) TO '{Path(output).as_posix()}' (HEADER, DELIMITER ',');")
+    summary = con.execute(summary_select(stats_table)).fetch_df()
+    sensors = con.execute(sensor_select(stats_table)).fetch_df()
+    return summary, sensors
+
+
+def validate_aggregation_relation(
+    con: duckdb.DuckDBPyConnection,
+    source: str,
+    expected_freq: str = "10min",
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """(summary, per-sensor) validation frames of an aggregate already visible to `con`."""
+    return write_validation_reports(con, source, None, None, expected_freq)
 
 
 def validate_traffic_aggregation(
-    input_path: str | Path,
+    input_path: str | Path | None,
     summary_output: str | Path,
     sensor_output: str | Path,
     expected_freq: str = "10min",
     threads: int = 8,
+    store_path: str | Path | None = None,
 ) -> tuple[Path, Path]:
-    input_path = Path(input_path)
+    """
+    Validate an aggregate: the parquet `input_path`, or with `store_path`
+    the `expected_freq` aggregate table of the DuckDB traffic store.
+    """
     summary_output = Path(summary_output)
     sensor_output = Path(sensor_output)
 
-    if not input_path.exists():
+    if store_path is None and not Path(input_path).exists():
         raise FileNotFoundError(f"Input file not found: {input_path}")
 
-    summary_output.parent.mkdir(parents=True, exist_ok=True)
-    sensor_output.parent.mkdir(parents=True, exist_ok=True)
-
     con = duckdb.connect(database=":memory:")
     con.execute(f"PRAGMA threads={threads};")
     con.execute("SET preserve_insertion_order=false;")
 
-    input_sql = input_path.as_posix()
-    summary_sql = summary_output.as_posix()
-    sensor_sql = sensor_output.as_posix()
-
-    summary_query = f"""
-    COPY (
-        SELECT
-            COUNT(*) AS rows_total,
-            COUNT(DISTINCT sensor_id) AS sensor_count,
-
-            MIN(timestamp) AS start_timestamp,
-            MAX(timestamp) AS end_timestamp,
-
-            AVG(coverage_count) AS coverage_count_mean,
-            MIN(coverage_count) AS coverage_count_min,
-            AVG(coverage_dwell) AS coverage_dwell_mean,
-            MIN(coverage_dwell) AS coverage_dwell_min,
-
-            AVG(imputed_rate) AS imputed_rate_mean,
-            MAX(imputed_rate) AS imputed_rate_max,
-
-            AVG(CASE WHEN count_agg IS NULL THEN 1 ELSE 0 END) AS count_null_rate,
-            AVG(CASE WHEN occupancy_time_agg IS NULL THEN 1 ELSE 0 END) AS occupancy_null_rate,
-
-            MIN(count_agg) AS count_min,
-            MAX(count_agg) AS count_max,
-            AVG(count_agg) AS count_mean,
-
-            MIN(occupancy_time_agg) AS occupancy_time_min,
-            MAX(occupancy_time_agg) AS occupancy_time_max,
-            AVG(occupancy_time_agg) AS occupancy_time_mean,
-
-            MIN(occupancy_ratio) AS occupancy_ratio_min,
-            MAX(occupancy_ratio) AS occupancy_ratio_max,
-            AVG(occupancy_ratio) AS occupancy_ratio_mean,
-
-            AVG(soft_flag_rate) AS soft_flag_rate_mean,
-            AVG(profile_flag_hard_rate) AS profile_flag_hard_rate_mean,
-            AVG(spike_flag_rate) AS spike_flag_rate_mean,
-
-            AVG(CASE WHEN freq = '{expected_freq}' THEN 1 ELSE 0 END) AS expected_freq_rate
-
-        FROM read_parquet('{input_sql}')
-    ) TO '{summary_sql}' (HEADER, DELIMITER ',');
-    """
-
-    sensor_query = f"""
-    COPY (
-        SELECT
-            sensor_id,
-
-            COUNT(*) AS rows_total,
-            MIN(timestamp) AS start_timestamp,
-            MAX(timestamp) AS end_timestamp,
-
-            AVG(coverage_count) AS coverage_count_mean,
-            MIN(coverage_count) AS coverage_count_min,
-            AVG(coverage_dwell) AS coverage_dwell_mean,
-            MIN(coverage_dwell) AS coverage_dwell_min,
-
-            AVG(imputed_rate) AS imputed_rate_mean,
-            MAX(imputed_rate) AS imputed_rate_max,
-
-            AVG(CASE WHEN count_agg IS NULL THEN 1 ELSE 0 END) AS count_null_rate,
-            AVG(CASE WHEN occupancy_time_agg IS NULL THEN 1 ELSE 0 END) AS occupancy_null_rate,
-
-            MIN(count_agg) AS count_min,
-            MAX(count_agg) AS count_max,
-            AVG(count_agg) AS count_mean,
-
-            MIN(occupancy_ratio) AS occupancy_ratio_min,
-            MAX(occupancy_ratio) AS occupancy_ratio_max,
-            AVG(occupancy_ratio) AS occupancy_ratio_mean,
-
-            AVG(soft_flag_rate) AS soft_flag_rate_mean,
-            AVG(profile_flag_hard_rate) AS profile_flag_hard_rate_mean,
-            AVG(spike_flag_rate) AS spike_flag_rate_mean,
-
-            AVG(CASE WHEN freq = '{expected_freq}' THEN 1 ELSE 0 END) AS expected_freq_rate
-
-        FROM read_parquet('{input_sql}')
-        GROUP BY sensor_id
-        ORDER BY sensor_id
-    ) TO '{sensor_sql}' (HEADER, DELIMITER ',');
-    """
-
-    con.execute(summary_query)
-    con.execute(sensor_query)
+    # one scan of the aggregate for both reports
+    source, _ = traffic_source(con, input_path, store_path, aggregate_table(expected_freq))
+    write_validation_reports(con, source, summary_output, sensor_output, expected_freq)
     con.close()
 
     print("Traffic aggregation validation finished.")
-    print(f"Input: {input_path}")
+    print(f"Input: {store_path or input_path}")
     print(f"Summary output: {summary_output}")
     print(f"Sensor output: {sensor_output}")
 
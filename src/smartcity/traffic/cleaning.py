@@ -1,15 +1,45 @@
 import os
 import json
-from typing import Dict, List, Tuple
+from typing import Dict, Iterator, List
 import numpy as np
 import pandas as pd
+import pyarrow.dataset as ds
 
 from smartcity.traffic.config import (
     CONFIG,
+    CONFIDENCE_LEVELS,
+    HARD_FLAGS,
     IMPUTABLE_REASONS,
+    MISSING_REASON_PRIORITY,
+    REASON_FLAGS,
     COUNT_PAT,
     DWELL_PAT,
 )
+from smartcity.traffic.profile_store import ProfileStore, create_profile_store, frame_hash, open_profile_store
+from smartcity.traffic.profiles import (
+    PROFILE_COLUMNS,
+    WEEKDAYS,
+    build_profile_arrays,
+    buckets_per_day,
+    cell_index,
+    cell_quantiles,
+    dense_from_table,
+    profile_keys,
+    profile_table,
+)
+from smartcity.traffic.rolling import (
+    group_bounds,
+    rolling_mad,
+    rolling_mean_std,
+    rolling_quantiles,
+    run_length,
+)
+from smartcity.traffic.schema import REASON_CONFIDENCE, compact_parquet_options, reason_codes, to_compact
+
+# lookup tables indexed by missing_reason code (position in MISSING_REASON_PRIORITY)
+REASON_CODE = {reason: code for code, reason in enumerate(MISSING_REASON_PRIORITY)}
+REASON_IMPUTABLE = np.array([reason in IMPUTABLE_REASONS for reason in MISSING_REASON_PRIORITY], dtype="int8")
+
 
 def find_timestamp_column(df: pd.DataFrame) -> str:
     """Return the timestamp column name for Darmstadt traffic data."""
@@ -34,25 +64,89 @@ def extract_sensor_map(columns: List[str]) -> Dict[str, Dict[str, str]]:
     return sensors
 
 
-def build_time_profiles(ts: pd.Series, values: pd.Series, profile_minutes: int = 15) -> pd.DataFrame:
-    dt = ts.dt
-    minutes = dt.hour * 60 + dt.minute
-    bucket = (minutes // profile_minutes) * profile_minutes
-    weekday = dt.weekday
-    dfp = pd.DataFrame({"weekday": weekday, "bucket": bucket, "v": values})
-    grp = dfp.groupby(["weekday", "bucket"])
-    prof = grp["v"].agg(median=lambda s: np.nanmedian(s), q25=lambda s: np.nanpercentile(s, 25), q75=lambda s: np.nanpercentile(s, 75))
-    prof["iqr"] = prof["q75"] - prof["q25"]
-    prof = prof.drop(columns=["q25", "q75"])
+def build_time_profiles(ts: pd.Series, values: pd.Series, profile_minutes: int = 15, groups: np.ndarray | None = None) -> pd.DataFrame:
+    codes = np.zeros(len(ts), dtype=np.int64) if groups is None else np.asarray(groups, dtype=np.int64)
+    n_groups = int(codes.max()) + 1 if len(codes) else 0
+    weekday, bucket = profile_keys(ts, profile_minutes)
+    cells = cell_index(codes, weekday, bucket, profile_minutes)
+    q = cell_quantiles(cells, values, n_groups * WEEKDAYS * buckets_per_day(profile_minutes), [0.25, 0.5, 0.75])
+
+    observed = np.unique(cells)
+    n_buckets = buckets_per_day(profile_minutes)
+    index = {
+        "group": observed // (WEEKDAYS * n_buckets),
+        "weekday": (observed // n_buckets) % WEEKDAYS,
+        "bucket": (observed % n_buckets) * profile_minutes,
+    }
+    if groups is None:
+        del index["group"]
+    prof = pd.DataFrame({"median": q[0.5][observed], "iqr": (q[0.75] - q[0.25])[observed]}, index=pd.MultiIndex.from_arrays(list(index.values()), names=list(index)))
     return prof
 
 
-def compute_flags_for_sensor(df_sensor: pd.DataFrame) -> pd.DataFrame:
+def build_sensor_profiles(df_long: pd.DataFrame, profile_minutes: int = 15) -> pd.DataFrame:
     """
-    HYBRID: Old behavior for count_clean/dwell_clean (soft flags remain valid)
-            NEW behavior for missing_reason, is_clean_observed, imputable, confidence
+    Weekday x bucket median/IQR profiles of count_raw and dwell_raw for every
+    sensor, in one vectorized pass. Returns columns sensor_id, weekday,
+    bucket, c_med, c_iqr, d_med, d_iqr for every cell that has rows.
+    """
+    sensor_ids, arrays = sensor_profile_arrays(df_long, profile_minutes)
+    return profile_table(arrays, sensor_ids, profile_minutes)
+
+
+def sensor_profile_arrays(df_long: pd.DataFrame, profile_minutes: int = 15) -> tuple[pd.Index, Dict[str, np.ndarray]]:
+    """(sensor ids, dense profile arrays) of a long frame, sensors in order of appearance."""
+    codes, sensor_ids = pd.factorize(df_long["sensor_id"])
+    arrays = build_profile_arrays(
+        codes,
+        len(sensor_ids),
+        df_long["timestamp"],
+        df_long["count_raw"].to_numpy(dtype=np.float32),
+        df_long["dwell_raw"].to_numpy(dtype=np.float32),
+        profile_minutes,
+    )
+    return pd.Index(sensor_ids), arrays
+
+
+def window_halo_rows() -> int:
+    """
+    Rows of per-sensor history a row's window flags can depend on. The spike
+    MAD is the deepest: a rolling median of deviations from a rolling median
+    of diffs reaches back 2 * spike_window_minutes rows.
+    """
+    return max(
+        2 * CONFIG["spike_window_minutes"],
+        60,
+        CONFIG["stuck_on_minutes"],
+        CONFIG["stuck_off_minutes"],
+        CONFIG["zero_run_soft_minutes"],
+    )
+
+
+def compute_flags(df_long: pd.DataFrame, profiles: pd.DataFrame | ProfileStore | None = None) -> pd.DataFrame:
+    """
+    Compute S2-S7 flags for every sensor of a long frame in one pass.
+
+    `profiles` (a build_sensor_profiles table or a ProfileStore) replaces
+    the S6 profiles that are otherwise built from `df_long` itself.
+
+    Rows are ordered by (sensor_id in order of first appearance, timestamp),
+    i.e. the same order process_file got from concatenating per-sensor
+    results, and every rolling window, diff and shift stays inside its sensor.
     """
-    out = df_sensor.copy().sort_values("timestamp").reset_index(drop=True)
+    codes, _ = pd.factorize(df_long["sensor_id"])
+    ts_key = df_long["timestamp"].values.astype("datetime64[ns]").astype(np.int64)
+    same_sensor = codes[1:] == codes[:-1]
+    presorted = bool(np.all((codes[1:] > codes[:-1]) | (same_sensor & (ts_key[1:] >= ts_key[:-1]))))
+
+    if presorted:
+        # e.g. wide_to_long(..., sort=True): skip the lexsort and the row gather
+        out = df_long.reset_index(drop=True)
+    else:
+        order = np.lexsort((ts_key, codes))
+        out = df_long.iloc[order].reset_index(drop=True)
+        codes = codes[order]
+    first, starts = group_bounds(codes)
 
     # Type conversion
     out["count_raw"] = pd.to_numeric(out["count_raw"], errors="coerce").astype("float32")
@@ -77,58 +171,55 @@ def compute_flags_for_sensor(df_sensor: pd.DataFrame) -> pd.DataFrame:
     out["cap_flag"] = (out["count_raw"] > gl_cap).astype("int8")
     out["cap_suspicious"] = ((out["count_raw"] > susp_low) & (out["count_raw"] <= gl_cap)).astype("int8")
 
-    # S4 classic failures & spikes
-    zero_mask = (out["count_raw"] == 0) & (out["dwell_raw"] == 0)
+    # S4 classic failures & spikes (windowed kernels from smartcity.traffic.rolling)
+    count_values = out["count_raw"].to_numpy()
+    zero_mask = ((out["count_raw"] == 0) & (out["dwell_raw"] == 0)).to_numpy()
+    zero_run = run_length(zero_mask, starts)
 
     # Soft (5 minutes)
     window_soft = CONFIG["zero_run_soft_minutes"]
-    out["zero_run_soft"] = zero_mask.rolling(window=window_soft, min_periods=window_soft).sum().fillna(0).ge(window_soft).astype("int8")
+    out["zero_run_soft"] = (zero_run >= window_soft).astype("int8")
 
     # Hard (20 minutes)
     window_off = CONFIG["stuck_off_minutes"]
-    out["stuck_off"] = zero_mask.rolling(window=window_off, min_periods=window_off).sum().fillna(0).ge(window_off).astype("int8")
+    out["stuck_off"] = (zero_run >= window_off).astype("int8")
 
-    # stuck_on using rolling std & mean
+    # stuck_on using rolling std & mean (window-local, so the result does not
+    # depend on how much history precedes the window: pandas' streaming std
+    # reads exactly constant windows as ~1e-6 after a long history, which
+    # missed them and made incremental runs disagree with a full reclean)
     window_on = CONFIG["stuck_on_minutes"]
-    rolling_std = out["count_raw"].rolling(window=window_on, min_periods=window_on).std()
-    rolling_mean = out["count_raw"].rolling(window=window_on, min_periods=window_on).mean()
-    out["stuck_on"] = ((rolling_std.fillna(np.inf) < CONFIG["stuck_on_std"]) & (rolling_mean.fillna(0) > CONFIG["stuck_on_mean"])).astype("int8")
+    rolling_mean, rolling_std = rolling_mean_std(count_values, window_on, window_on, starts)
+    out["stuck_on"] = ((np.nan_to_num(rolling_std, nan=np.inf) < CONFIG["stuck_on_std"]) & (np.nan_to_num(rolling_mean, nan=0.0) > CONFIG["stuck_on_mean"])).astype("int8")
 
-    # Spike MAD (vectorized)
+    # Spike MAD; diff/shift must not cross sensor boundaries
     N = CONFIG["spike_window_minutes"]
     thr_mult = CONFIG["spike_mad_multiplier"]
-    diffs = out["count_raw"].diff()
-    rolling_med = diffs.rolling(window=N, min_periods=5).median()
-    mad_series = (diffs - rolling_med).abs().rolling(window=N, min_periods=5).median()
+    diffs = out["count_raw"].diff().to_numpy(copy=True)
+    diffs[first] = np.nan
+    _, mad_series = rolling_mad(diffs, N, 5, starts)
     with np.errstate(invalid='ignore'):
-        out["spike_flag"] = (diffs.abs() > thr_mult * mad_series).astype("int8").fillna(0).astype("int8")
+        out["spike_flag"] = (np.abs(diffs) > thr_mult * mad_series).astype("int8")
 
     # Cliff flag
-    q75 = out["count_raw"].rolling(window=60, min_periods=20).quantile(0.75)
-    q10 = out["count_raw"].rolling(window=60, min_periods=20).quantile(0.10)
-    out["cliff_flag"] = ((out["count_raw"].shift(1) > q75) & (out["count_raw"] < q10)).astype("int8")
-
-    # S6 - build time profiles
-    dt = out["timestamp"].dt
-    minutes = dt.hour * 60 + dt.minute
-    bucket = (minutes // CONFIG["profile_group_minutes"]) * CONFIG["profile_group_minutes"]
-    weekday = dt.weekday
-
-    prof_c = build_time_profiles(out["timestamp"], out["count_raw"], profile_minutes=CONFIG["profile_group_minutes"]).reset_index().rename(columns={"median": "c_med", "iqr": "c_iqr"})
-    prof_d = build_time_profiles(out["timestamp"], out["dwell_raw"], profile_minutes=CONFIG["profile_group_minutes"]).reset_index().rename(columns={"median": "d_med", "iqr": "d_iqr"})
-
-    out = out.assign(weekday=weekday.values, bucket=bucket.values)
-    out["weekday"] = out["weekday"].astype("int64")
-    out["bucket"] = out["bucket"].astype("int64")
-
-    prof_c["weekday"] = prof_c["weekday"].astype("int64")
-    prof_c["bucket"] = prof_c["bucket"].astype("int64")
-
-    prof_d["weekday"] = prof_d["weekday"].astype("int64")
-    prof_d["bucket"] = prof_d["bucket"].astype("int64")
+    q75, q10 = rolling_quantiles(count_values, (0.75, 0.10), 60, 20, starts)
+    prev_count = out["count_raw"].shift(1).to_numpy(copy=True)
+    prev_count[first] = np.nan
+    with np.errstate(invalid='ignore'):
+        out["cliff_flag"] = ((prev_count > q75) & (count_values < q10)).astype("int8")
+
+    # S6 - time profiles: dense [sensor, weekday, bucket] arrays, one lookup per row
+    profile_minutes = CONFIG["profile_group_minutes"]
+    sensor_ids = pd.unique(out["sensor_id"])
+    if profiles is None:
+        prof = build_profile_arrays(codes, len(sensor_ids), out["timestamp"], out["count_raw"].to_numpy(), out["dwell_raw"].to_numpy(), profile_minutes)
+    elif isinstance(profiles, ProfileStore):
+        prof = profiles.dense(sensor_ids)
+    else:
+        prof = dense_from_table(profiles, sensor_ids, profile_minutes)
 
-    out = out.merge(prof_c[["weekday", "bucket", "c_med", "c_iqr"]], how="left", on=["weekday", "bucket"])
-    out = out.merge(prof_d[["weekday", "bucket", "d_med", "d_iqr"]], how="left", on=["weekday", "bucket"])
+    weekday, bucket = profile_keys(out["timestamp"], profile_minutes)
+    cells = cell_index(codes, weekday, bucket, profile_minutes)
 
     # robust z
     def robust_z_vec(x, med, iqr):
@@ -136,8 +227,8 @@ def compute_flags_for_sensor(df_sensor: pd.DataFrame) -> pd.DataFrame:
         with np.errstate(divide='ignore', invalid='ignore'):
             return (x - med) / denom
 
-    zc = robust_z_vec(out["count_raw"].values.astype(float), out["c_med"].values.astype(float), out["c_iqr"].values.astype(float))
-    zd = robust_z_vec(out["dwell_raw"].values.astype(float), out["d_med"].values.astype(float), out["d_iqr"].values.astype(float))
+    zc = robust_z_vec(out["count_raw"].values.astype(float), prof["c_med"][cells].astype(float), prof["c_iqr"][cells].astype(float))
+    zd = robust_z_vec(out["dwell_raw"].values.astype(float), prof["d_med"][cells].astype(float), prof["d_iqr"][cells].astype(float))
 
     out["profile_z_count"] = zc
     out["profile_z_dwell"] = zd
@@ -155,15 +246,7 @@ def compute_flags_for_sensor(df_sensor: pd.DataFrame) -> pd.DataFrame:
     # ============================================================
     # ⭐ HYBRID KEY POINT: ONLY hard_flags set to NaN (OLD behavior)
     # ============================================================
-    hard_flags = (
-        (out["phys_flag"] == 1) |
-        (out["cap_flag"] == 1) |
-        (out["stuck_off"] == 1) |
-        (out["stuck_on"] == 1) |
-        (out["spike_flag"] == 1) |
-        (out["cliff_flag"] == 1) |
-        (out["profile_flag_hard"] == 1)
-    )
+    hard_flags = (out[HARD_FLAGS] == 1).any(axis=1)
 
     out["count_clean"] = out["count_raw"].astype(float).copy()
     out["dwell_clean"] = out["dwell_raw"].astype(float).copy()
@@ -177,61 +260,32 @@ def compute_flags_for_sensor(df_sensor: pd.DataFrame) -> pd.DataFrame:
     # ============================================================
     # ⭐ NEW: semantic missing_reason labeling (regardless of NaN)
     # ============================================================
-    out["missing_reason"] = "NONE"
-
-    # Priority-based assignment (first match wins)
-    out.loc[out["phys_flag"] == 1, "missing_reason"] = "PHYS_INVALID"
-    out.loc[out["cap_flag"] == 1, "missing_reason"] = "CAP_EXCEEDED"
-    out.loc[out["stuck_off"] == 1, "missing_reason"] = "STUCK_OFF"
-    out.loc[out["stuck_on"] == 1, "missing_reason"] = "STUCK_ON"
-    out.loc[out["spike_flag"] == 1, "missing_reason"] = "SPIKE"
-    out.loc[out["cliff_flag"] == 1, "missing_reason"] = "CLIFF"
-    out.loc[out["profile_flag_hard"] == 1, "missing_reason"] = "PROFILE_HARD"
-
-    # zero-run distinction
-    out.loc[(out["zero_run_soft"] == 1) & (out["stuck_off"] == 0), "missing_reason"] = "ZERO_RUN_SHORT"
-
-    # soft profile (only if no hard reason already set)
-    mask_soft_profile = (
-        (out["profile_flag_soft"] == 1) &
-        (~out["missing_reason"].isin([
-            "PHYS_INVALID", "CAP_EXCEEDED", "STUCK_OFF",
-            "STUCK_ON", "PROFILE_HARD"
-        ]))
-    )
-    out.loc[mask_soft_profile, "missing_reason"] = "PROFILE_SOFT"
-
-    # logic invalid (only if NONE)
-    out.loc[(out["logic_flag"] == 1) & (out["missing_reason"] == "NONE"), "missing_reason"] = "LOGIC_INVALID"
+    # Priority-based assignment (first match wins), order from MISSING_REASON_PRIORITY,
+    # flag per reason from REASON_FLAGS
+    reason_code = reason_codes({name: out[name].to_numpy() for name in REASON_FLAGS.values()})
+    out["missing_reason"] = pd.Categorical.from_codes(reason_code, categories=MISSING_REASON_PRIORITY)
 
     # ⭐ Observation mask: is_clean_observed
     # در نسخه قدیم فقط hard_flags به NaN میشد، پس is_clean_observed = نه hard و نه soft
-    out["is_clean_observed"] = (~hard_flags & (out["missing_reason"] == "NONE")).astype("int8")
-
-    # ⭐ Imputable decision
-    out["imputable"] = out["missing_reason"].isin(IMPUTABLE_REASONS).astype("int8")
-
-    # ⭐ Confidence mapping
-    CONFIDENCE_MAP = {
-        "ZERO_RUN_SHORT": "high",
-        "SPIKE": "medium",
-        "PROFILE_SOFT": "medium",
-        "PROFILE_HARD": "low",
-        "STUCK_OFF": "low",
-        "STUCK_ON": "low",
-        "PHYS_INVALID": "none",
-        "CAP_EXCEEDED": "none",
-        "LOGIC_INVALID": "none",
-        "NONE": "high"
-    }
-    out["confidence"] = out["missing_reason"].map(CONFIDENCE_MAP)
+    out["is_clean_observed"] = (~hard_flags.to_numpy() & (reason_code == REASON_CODE["NONE"])).astype("int8")
 
-    # Drop helper columns
-    out = out.drop(columns=[c for c in ["weekday", "bucket", "c_med", "c_iqr", "d_med", "d_iqr"] if c in out.columns])
+    # ⭐ Imputable decision and confidence: lookup by reason code
+    out["imputable"] = REASON_IMPUTABLE[reason_code]
+    out["confidence"] = pd.Categorical.from_codes(REASON_CONFIDENCE[reason_code], categories=CONFIDENCE_LEVELS)
 
     return out
 
 
+def compute_flags_for_sensor(df_sensor: pd.DataFrame) -> pd.DataFrame:
+    """
+    HYBRID: Old behavior for count_clean/dwell_clean (soft flags remain valid)
+            NEW behavior for missing_reason, is_clean_observed, imputable, confidence
+
+    Single-sensor entry point; the flag engine itself is compute_flags.
+    """
+    return compute_flags(df_sensor)
+
+
 def summarize_sensor(df: pd.DataFrame) -> Dict[str, float]:
     total = len(df)
     # ⭐ HYBRID: valid = rows که hard_flags ندارند (قدیمی رو دنبال کنیم)
@@ -255,40 +309,154 @@ def summarize_sensor(df: pd.DataFrame) -> Dict[str, float]:
     }
 
 
-def load_input(path: str) -> pd.DataFrame:
+def sniff_csv_separator(path: str) -> str:
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        header = f.readline()
+    return ";" if header.count(";") > header.count(",") else ","
+
+
+def input_columns(names: List[str]) -> List[str]:
+    """Timestamp plus the count/dwell column of every sensor: all that cleaning reads."""
+    ts_col = find_timestamp_column(pd.DataFrame(columns=names))
+    sensors = extract_sensor_map(names)
+    return [ts_col] + [col for cols in sensors.values() for col in (cols["count_col"], cols["dwell_col"])]
+
+
+def utc_timestamp(value) -> pd.Timestamp:
+    ts = pd.Timestamp(value)
+    return ts.tz_localize("UTC") if ts.tzinfo is None else ts.tz_convert("UTC")
+
+
+def time_filters(ts_col: str, start=None, end=None) -> List[tuple] | None:
+    """Parquet predicate on the timestamp column: start <= ts < end (naive bounds are UTC)."""
+    filters = []
+    if start is not None:
+        filters.append((ts_col, ">=", utc_timestamp(start)))
+    if end is not None:
+        filters.append((ts_col, "<", utc_timestamp(end)))
+    return filters or None
+
+
+def load_input(path: str, start=None, end=None) -> pd.DataFrame:
+    """
+    Load a combined wide table. Parquet files and datasets (the default
+    combine output) are read with column projection and, given `start` /
+    `end`, a timestamp predicate pushed down to the reader. CSV / Excel are
+    read in full (the time range is applied after parsing).
+    """
     ext = os.path.splitext(path)[1].lower()
+    if ext == ".parquet" or os.path.isdir(path):
+        names = ds.dataset(path, format="parquet", partitioning="hive").schema.names
+        columns = input_columns(names)
+        return pd.read_parquet(path, columns=columns, filters=time_filters(columns[0], start, end))
+
     if ext in [".xlsx", ".xls"]:
         df = pd.read_excel(path)
     elif ext in [".csv"]:
-        try:
-            df = pd.read_csv(path)
-        except Exception:
-            df = pd.read_csv(path, sep=";")
+        df = pd.read_csv(path, sep=sniff_csv_separator(path))
     else:
         raise ValueError(f"Unsupported file extension: {ext}")
+
+    if start is not None or end is not None:
+        ts_col = find_timestamp_column(df)
+        ts = pd.to_datetime(df[ts_col], errors="coerce", utc=True)
+        keep = pd.Series(True, index=df.index)
+        for _, op, bound in time_filters(ts_col, start, end):
+            keep &= (ts >= bound) if op == ">=" else (ts < bound)
+        df = df[keep.to_numpy()]
     return df
 
 
-def wide_to_long(df: pd.DataFrame, ts_col: str, sensors: Dict[str, Dict[str, str]]) -> pd.DataFrame:
-    rows = []
-    base_cols = [ts_col]
-    for sid, cols in sensors.items():
-        cnt_col = cols["count_col"]
-        dwl_col = cols["dwell_col"]
-        sub = df[base_cols + [cnt_col, dwl_col]].copy()
-        sub.columns = [ts_col, "count_raw", "dwell_raw"]
-        sub["sensor_id"] = sid
-        rows.append(sub)
-    long_df = pd.concat(rows, axis=0, ignore_index=True)
-    long_df[ts_col] = pd.to_datetime(long_df[ts_col], errors="coerce", utc=True)
-    long_df = long_df.rename(columns={ts_col: "timestamp"})
-    long_df = long_df[~long_df["timestamp"].isna()].copy()
-    long_df["count_raw"] = pd.to_numeric(long_df["count_raw"], errors="coerce").astype(float)
-    long_df["dwell_raw"] = pd.to_numeric(long_df["dwell_raw"], errors="coerce").astype(float)
-    return long_df
-
-
-def process_file(input_path: str, outdir: str, intersection_id: str):
+def sensor_blocks(df: pd.DataFrame, sensors: Dict[str, Dict[str, str]], field: str) -> np.ndarray:
+    """[sensor, row] float64 block of one measure; unparsable values become NaN."""
+    block = np.empty((len(sensors), len(df)), dtype=np.float64)
+    for i, cols in enumerate(sensors.values()):
+        block[i] = pd.to_numeric(df[cols[field]], errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)
+    return block
+
+
+def wide_to_long(
+    df: pd.DataFrame,
+    ts_col: str,
+    sensors: Dict[str, Dict[str, str]],
+    sort: bool = False,
+) -> pd.DataFrame:
+    """
+    Reshape the wide table to one row per (sensor, minute).
+
+    The timestamp is parsed once on the wide frame; rows without a valid
+    timestamp are dropped. Measures are stacked as [sensor, row] NumPy
+    blocks and flattened sensor-major, so rows come out grouped by sensor
+    in the order of `sensors`. sensor_id is a categorical with sorted
+    categories, so sorting by it matches sorting the plain IDs. With
+    `sort=True` the wide rows are ordered by timestamp first, so every
+    sensor's rows are in time order, the row order compute_flags works in.
+    """
+    ts = pd.to_datetime(df[ts_col], errors="coerce", utc=True)
+    valid = ts.notna().to_numpy()
+    if not valid.all():
+        df, ts = df[valid], ts[valid]
+    if sort:
+        order = np.argsort(ts.to_numpy(), kind="stable")
+        df, ts = df.iloc[order], ts.iloc[order]
+
+    n_rows = len(df)
+    n_sensors = len(sensors)
+    categories = sorted(sensors)
+    codes = pd.Index(categories).get_indexer(list(sensors)).astype(np.int32)
+    return pd.DataFrame({
+        "timestamp": np.tile(ts.to_numpy(), n_sensors),
+        "count_raw": sensor_blocks(df, sensors, "count_col").ravel(),
+        "dwell_raw": sensor_blocks(df, sensors, "dwell_col").ravel(),
+        "sensor_id": pd.Categorical.from_codes(np.repeat(codes, n_rows), categories=categories),
+    })
+
+
+def iter_long_batches(
+    df: pd.DataFrame,
+    ts_col: str,
+    sensors: Dict[str, Dict[str, str]],
+    batch_sensors: int,
+) -> Iterator[pd.DataFrame]:
+    """
+    Yield the long table `batch_sensors` sensors at a time, each batch
+    grouped by sensor and in time order. sensor_id keeps the categories
+    of all sensors, so batches concatenate without recoding.
+    """
+    if batch_sensors < 1:
+        raise ValueError(f"batch_sensors must be >= 1, got {batch_sensors}")
+
+    ts = pd.to_datetime(df[ts_col], errors="coerce", utc=True)
+    order = np.argsort(ts.to_numpy(), kind="stable")
+    order = order[ts.notna().to_numpy()[order]]
+    frame = df.iloc[order].assign(**{ts_col: ts.iloc[order]})
+
+    sensor_ids = list(sensors)
+    categories = sorted(sensor_ids)
+    for lo in range(0, len(sensor_ids), batch_sensors):
+        batch = {sid: sensors[sid] for sid in sensor_ids[lo:lo + batch_sensors]}
+        long_df = wide_to_long(frame, ts_col, batch)
+        long_df["sensor_id"] = pd.Categorical(long_df["sensor_id"], categories=categories)
+        yield long_df
+
+
+def process_file(
+    input_path: str,
+    outdir: str,
+    intersection_id: str,
+    compact: bool = False,
+    sensor_batch: int | None = None,
+    profile_store_dir: str | None = None,
+):
+    """
+    Clean one combined intersection file. With `sensor_batch`, the long
+    table is built and flagged that many sensors at a time (flags are
+    per-sensor, so the result is the same).
+
+    With `profile_store_dir`, the S6 profiles are read from the cleaning
+    profile store under it, which is (re)built first when it does not match
+    the input data hash and profile_group_minutes.
+    """
     os.makedirs(outdir, exist_ok=True)
     df = load_input(input_path)
     ts_col = find_timestamp_column(df)
@@ -297,24 +465,48 @@ def process_file(input_path: str, outdir: str, intersection_id: str):
         raise ValueError("No sensor pairs found. Ensure expected column names exist.")
     print(f"Found {len(sensors)} sensors.")
 
-    df_long = wide_to_long(df, ts_col, sensors)
+    store = None
+    build_store = False
+    if profile_store_dir is not None:
+        profile_minutes = CONFIG["profile_group_minutes"]
+        data_hash = frame_hash(df, input_columns(list(df.columns)))
+        store = open_profile_store(profile_store_dir, "cleaning", data_hash, profile_minutes)
+        build_store = store is None
+        if build_store:
+            store = create_profile_store(profile_store_dir, "cleaning", sorted(sensors), PROFILE_COLUMNS, profile_minutes, data_hash)
+        print(f"Profile store: {'building' if build_store else 'reusing'} {store.root}")
+
+    def flag(long_df: pd.DataFrame) -> pd.DataFrame:
+        if build_store:
+            store.write(*sensor_profile_arrays(long_df, profile_minutes))
+        return compute_flags(long_df, profiles=store)
+
+    if sensor_batch is None:
+        result = flag(wide_to_long(df, ts_col, sensors, sort=True))
+    else:
+        result = pd.concat(
+            [flag(batch) for batch in iter_long_batches(df, ts_col, sensors, sensor_batch)],
+            ignore_index=True,
+        )
+    if build_store:
+        store.finalize()
+    del df
 
-    out_frames = []
     summaries = []
-    for sid in sensors.keys():
-        sub = df_long[df_long["sensor_id"] == sid].copy()
-        cleaned = compute_flags_for_sensor(sub)
-        out_frames.append(cleaned)
+    for sid, cleaned in result.groupby("sensor_id", sort=False, observed=True):
         summ = summarize_sensor(cleaned)
         summ["sensor_id"] = sid
         summ["intersection_id"] = intersection_id
         summaries.append(summ)
 
-    result = pd.concat(out_frames, axis=0, ignore_index=True)
+    write_options = {}
+    if compact:
+        result = to_compact(result)
+        write_options = compact_parquet_options(result)
 
     parquet_path = os.path.join(outdir, f"{intersection_id}_clean_pre_fusion.parquet")
     try:
-        result.to_parquet(parquet_path, index=False)
+        result.to_parquet(parquet_path, index=False, **write_options)
     except Exception:
         parquet_path = None
         csv_fallback = os.path.join(outdir, f"{intersection_id}_clean_pre_fusion.csv.gz")
@@ -329,3 +521,4 @@ def process_file(input_path: str, outdir: str, intersection_id: str):
         json.dump(CONFIG, f, indent=2)
 
     print(f"Saved summary: {summary_csv}")
+    return summary_csv
@@ -0,0 +1,112 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Dict
+
+import pandas as pd
+
+from smartcity.traffic.cleaning import process_file
+from smartcity.traffic.io import input_bytes
+from smartcity.utils.logging import setup_logger
+
+
+def clean_intersection(input_path: str | Path, outdir: str | Path, intersection_id: str, log_dir: str | Path, compact: bool = False) -> dict:
+    """Worker: clean one intersection with its own log file and return a run record."""
+    logger = setup_logger(
+        name=f"traffic_cleaning.{intersection_id}",
+        log_file=Path(log_dir) / f"{intersection_id}_traffic_cleaning.log",
+    )
+
+    logger.info("Starting traffic cleaning pipeline")
+    logger.info(f"Input file: {input_path}")
+    logger.info(f"Output directory: {outdir}")
+    logger.info(f"Intersection ID: {intersection_id}")
+
+    record = {
+        "intersection_id": intersection_id,
+        "input_path": str(input_path),
+        "input_bytes": input_bytes(input_path),
+        "worker_pid": os.getpid(),
+        "status": "ok",
+        "error": None,
+        "sensors": 0,
+        "minutes_total": 0,
+    }
+
+    start = time.perf_counter()
+    try:
+        summary_csv = process_file(
+            input_path=str(input_path),
+            outdir=str(outdir),
+            intersection_id=intersection_id,
+            compact=compact,
+        )
+        summary = pd.read_csv(summary_csv)
+        record["summary_csv"] = summary_csv
+        record["sensors"] = len(summary)
+        record["minutes_total"] = int(summary["minutes_total"].sum())
+        logger.info("Traffic cleaning pipeline finished successfully")
+    except Exception as error:
+        record["status"] = "failed"
+        record["error"] = f"{type(error).__name__}: {error}"
+        logger.exception("Traffic cleaning pipeline failed")
+
+    record["seconds"] = round(time.perf_counter() - start, 3)
+    return record
+
+
+def clean_intersections(
+    inputs: Dict[str, Path],
+    outdir: str | Path,
+    workers: int = 4,
+    log_dir: str | Path = "outputs/logs",
+    report_prefix: str = "traffic_cleaning_run",
+    compact: bool = False,
+) -> tuple[Path, Path]:
+    """
+    Clean many intersections in a process pool.
+
+    Every intersection keeps its own outputs (parquet, `_sensor_summary.csv`,
+    `_config.json`) and log file. Largest inputs are submitted first so the
+    run ends close to the duration of the slowest intersection. Writes a
+    run report (one row per intersection) and a combined sensor summary.
+    """
+    outdir = Path(outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+
+    jobs = sorted(inputs.items(), key=lambda item: input_bytes(item[1]), reverse=True)
+    workers = max(1, min(workers, len(jobs)))
+
+    print(f"Cleaning {len(jobs)} intersections with {workers} workers.")
+
+    records = []
+    # One task per child process returns each intersection's memory to the OS.
+    with ProcessPoolExecutor(max_workers=workers, max_tasks_per_child=1) as pool:
+        futures = {
+            pool.submit(clean_intersection, path, outdir, iid, log_dir, compact): iid
+            for iid, path in jobs
+        }
+        for future in as_completed(futures):
+            record = future.result()
+            records.append(record)
+            print(f"[{len(records)}/{len(jobs)}] {record['intersection_id']}: {record['status']} in {record['seconds']}s")
+
+    report = pd.DataFrame(records).sort_values("intersection_id").reset_index(drop=True)
+    report_csv = outdir / f"{report_prefix}_report.csv"
+    report.to_csv(report_csv, index=False)
+
+    summaries = [pd.read_csv(p) for p in report.get("summary_csv", pd.Series(dtype=object)).dropna()]
+    sensor_summary_csv = outdir / f"{report_prefix}_sensor_summary.csv"
+    if summaries:
+        pd.concat(summaries, ignore_index=True).to_csv(sensor_summary_csv, index=False)
+    else:
+        pd.DataFrame().to_csv(sensor_summary_csv, index=False)
+
+    failed = report[report["status"] != "ok"]
+    print("Traffic cleaning batch finished.")
+    print(f"Intersections: {len(report)} (failed: {len(failed)})")
+    print(f"Run report: {report_csv}")
+    print(f"Combined sensor summary: {sensor_summary_csv}")
+
+    return report_csv, sensor_summary_csv
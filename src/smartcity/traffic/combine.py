@@ -1,9 +1,17 @@
+import hashlib
+import io
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from pathlib import Path
 from glob import glob
-from typing import List
+from typing import Dict, List
 
 import pandas as pd
 
+from smartcity.traffic.io import discover_intersection_inputs
+
 
 def load_sensor_ids(metadata_file: str | Path, sensor_column: str = "sensor_id") -> List[str]:
     metadata_file = Path(metadata_file)
@@ -47,21 +55,88 @@ def build_expected_traffic_columns(sensor_ids: List[str]) -> List[str]:
     return base_columns + sensor_columns
 
 
-def read_traffic_csv(csv_path: str | Path) -> pd.DataFrame:
-    csv_path = Path(csv_path)
+def read_traffic_csv(csv_path: str | Path | bytes, columns: List[str] | None = None) -> pd.DataFrame:
+    """
+    Read one raw export (a path, or the file's bytes) with the C parser.
+    `columns` projects the read onto the listed columns (missing ones are
+    ignored). Malformed lines are skipped with a warning; non-UTF-8 files
+    fall back to latin1.
+    """
+    def source():
+        return io.BytesIO(csv_path) if isinstance(csv_path, bytes) else Path(csv_path)
 
     read_kwargs = {
         "sep": ";",
         "encoding": "utf-8",
-        "engine": "python",
+        "engine": "c",
         "on_bad_lines": "warn",
+        "low_memory": False,
     }
+    if columns is not None:
+        wanted = set(columns)
+        read_kwargs["usecols"] = lambda col: col in wanted
 
     try:
-        return pd.read_csv(csv_path, **read_kwargs)
+        return pd.read_csv(source(), **read_kwargs)
     except UnicodeDecodeError:
         read_kwargs["encoding"] = "latin1"
-        return pd.read_csv(csv_path, **read_kwargs)
+        return pd.read_csv(source(), **read_kwargs)
+
+
+def typed_traffic_columns(traffic_all: pd.DataFrame) -> pd.DataFrame:
+    """Columnar output types: string Anlage, UTC timestamp, float32 sensor columns."""
+    traffic_all = traffic_all.copy()
+    for col in traffic_all.columns:
+        if col == "Anlage":
+            traffic_all[col] = traffic_all[col].astype(str)
+        elif col != "Intervallbeginn (UTC)":
+            traffic_all[col] = pd.to_numeric(traffic_all[col], errors="coerce").astype("float32")
+    return traffic_all
+
+
+def check_output_format(output_path: Path, output_format: str) -> None:
+    if output_format not in ["parquet", "csv"]:
+        raise ValueError(f"Unsupported output format: {output_format}. Use 'parquet' or 'csv'.")
+    if output_path.suffix.lower() != f".{output_format}":
+        raise ValueError(f"Output path {output_path} does not match output format '{output_format}'; use a .{output_format} file.")
+
+
+def write_combined_traffic(traffic_all: pd.DataFrame, output_path: Path, output_format: str = "parquet") -> Path:
+    """
+    Write the combined wide table as typed Parquet (default) or, as an
+    explicit export, CSV. The suffix of `output_path` must match the format.
+    """
+    check_output_format(output_path, output_format)
+    if output_format == "parquet":
+        typed_traffic_columns(traffic_all).to_parquet(output_path, index=False)
+    else:
+        traffic_all.to_csv(output_path, index=False)
+    return output_path
+
+
+def read_intersection_rows(csv_path: str | Path, columns_to_keep: List[str], intersection_id: str) -> pd.DataFrame | None:
+    """Worker: projected rows of one intersection from one raw file (None if nothing to keep)."""
+    df = read_traffic_csv(csv_path, columns=columns_to_keep)
+
+    existing_cols = [col for col in columns_to_keep if col in df.columns]
+
+    if not existing_cols:
+        return None
+
+    df = df[existing_cols].copy()
+
+    if "Anlage" in df.columns:
+        df = df[df["Anlage"].astype(str) == str(intersection_id)]
+
+    return None if df.empty else df
+
+
+def _read_or_report(csv_path: str, columns_to_keep: List[str], intersection_id: str) -> tuple:
+    try:
+        return read_intersection_rows(csv_path, columns_to_keep, intersection_id), None
+    except Exception as error:
+        return None, f"Error reading {csv_path}: {error}"
+
 
 def combine_traffic_files(
     traffic_root: str | Path,
@@ -70,12 +145,15 @@ def combine_traffic_files(
     output_path: str | Path,
     sensor_column: str = "sensor_id",
     drop_missing_rows: bool = True,
+    workers: int = 4,
+    output_format: str = "parquet",
 ) -> Path:
     traffic_root = Path(traffic_root)
     output_path = Path(output_path)
 
     if not traffic_root.exists():
         raise FileNotFoundError(f"Traffic root not found: {traffic_root}")
+    check_output_format(output_path, output_format)
 
     output_path.parent.mkdir(parents=True, exist_ok=True)
 
@@ -89,26 +167,20 @@ def combine_traffic_files(
 
     frames = []
 
-    for csv_path in csv_paths:
-        try:
-            df = read_traffic_csv(csv_path)
-
-            existing_cols = [col for col in columns_to_keep if col in df.columns]
-
-            if not existing_cols:
-                continue
-
-            df = df[existing_cols].copy()
-
-            if "Anlage" in df.columns:
-                df = df[df["Anlage"].astype(str) == str(intersection_id)]
-
-            if not df.empty:
+    # parsing is CPU-bound; results come back in file order
+    with ProcessPoolExecutor(max_workers=max(1, workers)) as pool:
+        results = pool.map(
+            _read_or_report,
+            csv_paths,
+            repeat(columns_to_keep),
+            repeat(intersection_id),
+        )
+        for df, error in results:
+            if error is not None:
+                print(error)
+            elif df is not None:
                 frames.append(df)
 
-        except Exception as error:
-            print(f"Error reading {csv_path}: {error}")
-
     if not frames:
         raise RuntimeError(
             f"No valid traffic data found for intersection {intersection_id}."
@@ -132,7 +204,7 @@ def combine_traffic_files(
     if drop_missing_rows:
         traffic_all = traffic_all.dropna(how="any")
 
-    traffic_all.to_csv(output_path, index=False)
+    output_path = write_combined_traffic(traffic_all, output_path, output_format)
 
     print("Traffic combine finished.")
     print(f"Intersection: {intersection_id}")
@@ -141,4 +213,356 @@ def combine_traffic_files(
     print(f"Output rows: {len(traffic_all)}")
     print(f"Output: {output_path}")
 
-    return output_path
\ No newline at end of file
+    return output_path
+
+
+MANIFEST_NAME = "_combine_manifest.csv"
+DEDUP_KEYS = ["Anlage", "Intervallbeginn (UTC)"]
+
+
+def partition_path(output_dir: Path, intersection_id: str, year: int, month: int) -> Path:
+    return output_dir / f"intersection={intersection_id}" / f"year={year}" / f"month={month:02d}"
+
+
+def load_intersection_columns(
+    metadata_glob: str,
+    intersection_ids: List[str] | None = None,
+    sensor_column: str = "sensor_id",
+) -> Dict[str, List[str]]:
+    metadata_files = discover_intersection_inputs(input_glob=metadata_glob, intersection_ids=intersection_ids)
+    return {
+        iid: build_expected_traffic_columns(load_sensor_ids(path, sensor_column=sensor_column))
+        for iid, path in metadata_files.items()
+    }
+
+
+def file_fingerprint(csv_path: str | Path, traffic_root: Path, stat: os.stat_result, data: bytes) -> dict:
+    """
+    Manifest entry of `csv_path` from its stat and the bytes that were
+    ingested. The stat is taken before the read, so a file changed while it
+    was read shows a newer mtime next run and is hashed again.
+    """
+    return {
+        "path": Path(csv_path).relative_to(traffic_root).as_posix(),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha256": hashlib.sha256(data).hexdigest(),
+    }
+
+
+def load_manifest(output_dir: Path) -> pd.DataFrame:
+    manifest_path = output_dir / MANIFEST_NAME
+    if not manifest_path.exists():
+        return pd.DataFrame(columns=["path", "size", "mtime_ns", "sha256"])
+    return pd.read_csv(manifest_path, dtype={"path": str, "sha256": str})
+
+
+def save_manifest(output_dir: Path, fingerprints: List[dict]) -> Path:
+    manifest_path = output_dir / MANIFEST_NAME
+    pd.DataFrame(fingerprints, columns=["path", "size", "mtime_ns", "sha256"]).sort_values("path").to_csv(manifest_path, index=False)
+    return manifest_path
+
+
+def route_traffic_csv(
+    file_idx: int,
+    csv_path: str,
+    traffic_root: Path,
+    all_columns: List[str],
+    columns_by_intersection: Dict[str, List[str]],
+    staging: Path,
+) -> tuple[str | None, dict | None]:
+    """
+    Worker: read one raw file (projected onto `all_columns`) and stage the
+    rows of every known intersection as `staging/{id}/{file_idx}.parquet`.
+    Returns (a message when the file could not be used, the manifest
+    fingerprint of the bytes that were read, or None if none were).
+    """
+    try:
+        stat = os.stat(csv_path)
+        with open(csv_path, "rb") as f:
+            data = f.read()
+    except OSError as error:
+        return f"Error reading {csv_path}: {error}", None
+    fingerprint = file_fingerprint(csv_path, traffic_root, stat, data)
+
+    try:
+        df = read_traffic_csv(data, columns=all_columns)
+    except Exception as error:
+        return f"Error reading {csv_path}: {error}", fingerprint
+    del data
+
+    if "Anlage" not in df.columns:
+        return f"Skipping {csv_path}: no 'Anlage' column to route rows by.", fingerprint
+
+    anlage = df["Anlage"].astype(str)
+    for iid in anlage.unique():
+        if iid not in columns_by_intersection:
+            continue
+
+        existing_cols = [col for col in columns_by_intersection[iid] if col in df.columns]
+        sub = df.loc[(anlage == iid).to_numpy(), existing_cols]
+        if sub.empty:
+            continue
+
+        sub = sub.assign(Anlage=iid)
+        if "Intervallbeginn (UTC)" in sub.columns:
+            sub["Intervallbeginn (UTC)"] = sub["Intervallbeginn (UTC)"].astype(str)
+        for col in existing_cols:
+            if col not in ["Anlage", "Intervallbeginn (UTC)"] and sub[col].dtype == object:
+                sub[col] = pd.to_numeric(sub[col], errors="coerce")
+
+        iid_staging = staging / iid
+        iid_staging.mkdir(parents=True, exist_ok=True)
+        sub.to_parquet(iid_staging / f"{file_idx:06d}.parquet", index=False)
+
+    return None, fingerprint
+
+
+def stage_traffic_csvs(
+    csv_paths: List[str],
+    traffic_root: Path,
+    columns_by_intersection: Dict[str, List[str]],
+    staging: Path,
+    workers: int,
+) -> List[dict | None]:
+    """
+    Route `csv_paths` into `staging/{id}/` with a process pool (one read per
+    file). Returns the files' fingerprints in `csv_paths` order.
+    """
+    all_columns = sorted({col for columns in columns_by_intersection.values() for col in columns})
+    fingerprints = []
+    with ProcessPoolExecutor(max_workers=max(1, workers)) as pool:
+        results = pool.map(
+            route_traffic_csv,
+            range(len(csv_paths)),
+            csv_paths,
+            repeat(traffic_root),
+            repeat(all_columns),
+            repeat(columns_by_intersection),
+            repeat(staging),
+        )
+        for message, fingerprint in results:
+            if message is not None:
+                print(message)
+            fingerprints.append(fingerprint)
+    return fingerprints
+
+
+def finish_staged_rows(iid_staging: Path, columns: List[str], drop_missing_rows: bool) -> pd.DataFrame | None:
+    """Concatenate an intersection's staged slices and clean them like combine_traffic_files."""
+    staged = sorted(iid_staging.glob("*.parquet"))
+    if not staged:
+        return None
+
+    traffic_all = pd.concat([pd.read_parquet(path) for path in staged], ignore_index=True)
+    traffic_all = traffic_all[[col for col in columns if col in traffic_all.columns]]
+
+    if "Intervallbeginn (UTC)" not in traffic_all.columns:
+        print(f"Expected timestamp column 'Intervallbeginn (UTC)' not found for {iid_staging.name}.")
+        return None
+
+    traffic_all["Intervallbeginn (UTC)"] = pd.to_datetime(
+        traffic_all["Intervallbeginn (UTC)"],
+        errors="coerce",
+        utc=True,
+        dayfirst=True,
+    )
+
+    traffic_all = traffic_all.dropna(subset=["Intervallbeginn (UTC)"])
+    traffic_all = traffic_all.sort_values("Intervallbeginn (UTC)")
+
+    if drop_missing_rows:
+        traffic_all = traffic_all.dropna(how="any")
+
+    return typed_traffic_columns(traffic_all)
+
+
+def write_partitions(traffic_all: pd.DataFrame, output_dir: Path, intersection_id: str, merge: bool = False) -> List[Path]:
+    """
+    Write one part file per year/month. With `merge`, rows are merged into
+    existing partitions, deduplicated on (Anlage, Intervallbeginn) with the
+    new row winning. Only the touched partitions are rewritten.
+    """
+    written = []
+    ts = traffic_all["Intervallbeginn (UTC)"].dt
+    for (year, month), part in traffic_all.groupby([ts.year, ts.month], sort=True):
+        part_dir = partition_path(output_dir, intersection_id, int(year), int(month))
+        part_dir.mkdir(parents=True, exist_ok=True)
+        part_file = part_dir / "part-0.parquet"
+
+        if merge:
+            if part_file.exists():
+                part = pd.concat([pd.read_parquet(part_file), part], ignore_index=True)
+            part = (
+                part.drop_duplicates(subset=DEDUP_KEYS, keep="last")
+                .sort_values("Intervallbeginn (UTC)", kind="stable")
+            )
+
+        part.to_parquet(part_file, index=False)
+        written.append(part_dir)
+
+    return written
+
+
+def combine_city_traffic(
+    traffic_root: str | Path,
+    metadata_glob: str,
+    output_dir: str | Path,
+    intersection_ids: List[str] | None = None,
+    sensor_column: str = "sensor_id",
+    drop_missing_rows: bool = True,
+    workers: int = 4,
+) -> Path:
+    """
+    Combine many intersections with one read of the raw archive.
+
+    Every raw CSV is parsed once, in a pool of `workers` processes and
+    reading only columns some intersection needs. Its rows are routed by
+    `Anlage` to the intersections found by `metadata_glob` (ID = file name
+    prefix, e.g. data/metadata/intersections/A142_L5_..._complete.xlsx),
+    keeping each intersection's own sensor columns. Routed slices are
+    staged as Parquet; each intersection is then finished like
+    combine_traffic_files (timestamp parsing, sorting, dropping incomplete
+    rows) and written to
+    `{output_dir}/intersection={id}/year={yyyy}/month={mm}/part-0.parquet`.
+    A manifest of the ingested files is written for
+    combine_city_traffic_incremental.
+
+    Non-numeric sensor values are stored as NaN (cleaning coerces them the
+    same way).
+    """
+    traffic_root = Path(traffic_root)
+    output_dir = Path(output_dir)
+
+    if not traffic_root.exists():
+        raise FileNotFoundError(f"Traffic root not found: {traffic_root}")
+
+    columns_by_intersection = load_intersection_columns(metadata_glob, intersection_ids, sensor_column)
+
+    csv_paths = sorted(glob(str(traffic_root / "**" / "*.csv"), recursive=True))
+
+    if not csv_paths:
+        raise RuntimeError(f"No CSV files found under: {traffic_root}")
+
+    staging = output_dir / "_staging"
+    if staging.exists():
+        shutil.rmtree(staging)
+
+    try:
+        fingerprints = stage_traffic_csvs(csv_paths, traffic_root, columns_by_intersection, staging, workers)
+
+        written = 0
+        for iid, columns in columns_by_intersection.items():
+            traffic_all = finish_staged_rows(staging / iid, columns, drop_missing_rows)
+            if traffic_all is None:
+                print(f"No valid traffic data found for intersection {iid}.")
+                continue
+
+            iid_dir = output_dir / f"intersection={iid}"
+            if iid_dir.exists():
+                shutil.rmtree(iid_dir)
+
+            write_partitions(traffic_all, output_dir, iid)
+            written += 1
+            print(f"{iid}: {len(traffic_all)} rows")
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+    manifest_path = save_manifest(output_dir, [fp for fp in fingerprints if fp is not None])
+
+    print("City traffic combine finished.")
+    print(f"Intersections with metadata: {len(columns_by_intersection)}")
+    print(f"Intersections written: {written}")
+    print(f"CSV files scanned: {len(csv_paths)}")
+    print(f"Manifest: {manifest_path}")
+    print(f"Output: {output_dir}")
+
+    return output_dir
+
+
+def combine_city_traffic_incremental(
+    traffic_root: str | Path,
+    metadata_glob: str,
+    output_dir: str | Path,
+    intersection_ids: List[str] | None = None,
+    sensor_column: str = "sensor_id",
+    drop_missing_rows: bool = True,
+    workers: int = 4,
+) -> Path:
+    """
+    Ingest only raw files that are new or changed since the manifest in
+    `output_dir` and merge their rows into the partitioned output.
+
+    A file is unchanged when size and mtime match the manifest; otherwise
+    it is routed and its content hash, taken from the same read, decides
+    whether its rows are kept. Rows are deduplicated on (Anlage,
+    Intervallbeginn), the most recent ingest wins, and only partitions that
+    receive rows are rewritten. Incomplete rows are dropped per batch (over
+    the columns present in the new files). Rows that disappear from a
+    changed file are not removed from the output.
+    """
+    traffic_root = Path(traffic_root)
+    output_dir = Path(output_dir)
+
+    if not traffic_root.exists():
+        raise FileNotFoundError(f"Traffic root not found: {traffic_root}")
+
+    columns_by_intersection = load_intersection_columns(metadata_glob, intersection_ids, sensor_column)
+
+    csv_paths = sorted(glob(str(traffic_root / "**" / "*.csv"), recursive=True))
+
+    if not csv_paths:
+        raise RuntimeError(f"No CSV files found under: {traffic_root}")
+
+    manifest = load_manifest(output_dir).set_index("path")
+    fingerprints = {}
+    candidates = []
+    for csv_path in csv_paths:
+        rel = Path(csv_path).relative_to(traffic_root).as_posix()
+        stat = Path(csv_path).stat()
+        if rel in manifest.index and (
+            int(manifest.at[rel, "size"]) == stat.st_size and int(manifest.at[rel, "mtime_ns"]) == stat.st_mtime_ns
+        ):
+            fingerprints[rel] = {"path": rel, **manifest.loc[rel].to_dict()}
+        else:
+            candidates.append(csv_path)
+
+    changed = []
+    touched = []
+    if candidates:
+        staging = output_dir / "_staging"
+        if staging.exists():
+            shutil.rmtree(staging)
+
+        try:
+            candidate_prints = stage_traffic_csvs(candidates, traffic_root, columns_by_intersection, staging, workers)
+            for file_idx, (csv_path, fp) in enumerate(zip(candidates, candidate_prints)):
+                if fp is None:
+                    continue
+                fingerprints[fp["path"]] = fp
+                if fp["path"] in manifest.index and manifest.at[fp["path"], "sha256"] == fp["sha256"]:
+                    for staged in staging.glob(f"*/{file_idx:06d}.parquet"):
+                        staged.unlink()
+                else:
+                    changed.append(csv_path)
+
+            for iid, columns in columns_by_intersection.items():
+                traffic_new = finish_staged_rows(staging / iid, columns, drop_missing_rows)
+                if traffic_new is None:
+                    continue
+                parts = write_partitions(traffic_new, output_dir, iid, merge=True)
+                touched.extend(parts)
+                print(f"{iid}: {len(traffic_new)} new rows into {len(parts)} partitions")
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+    manifest_path = save_manifest(output_dir, list(fingerprints.values()))
+
+    print("Incremental city traffic combine finished.")
+    print(f"CSV files found: {len(csv_paths)}")
+    print(f"New or changed files: {len(changed)}")
+    print(f"Partitions rewritten: {len(touched)}")
+    print(f"Manifest: {manifest_path}")
+    print(f"Output: {output_dir}")
+
+    return output_dir
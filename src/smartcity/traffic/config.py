@@ -1,13 +1,16 @@
 import re
 
+# missing_reason labels, highest priority first (first match wins). SPIKE,
+# the only imputable hard reason, ranks below every other hard reason, so a
+# row is labelled SPIKE (and imputable) only when no other hard flag is set
 MISSING_REASON_PRIORITY = [
     "PHYS_INVALID",
     "CAP_EXCEEDED",
     "STUCK_OFF",
     "STUCK_ON",
-    "SPIKE",
     "CLIFF",
     "PROFILE_HARD",
+    "SPIKE",
     "ZERO_RUN_LONG",
     "ZERO_RUN_SHORT",
     "PROFILE_SOFT",
@@ -15,12 +18,55 @@ MISSING_REASON_PRIORITY = [
     "NONE",
 ]
 
+# flag that assigns each missing_reason (ZERO_RUN_LONG is never assigned and
+# NONE is the default); STUCK_OFF outranks ZERO_RUN_SHORT, so zero_run_soft
+# rows inside a stuck-off run are labelled STUCK_OFF
+REASON_FLAGS = {
+    "PHYS_INVALID": "phys_flag",
+    "CAP_EXCEEDED": "cap_flag",
+    "STUCK_OFF": "stuck_off",
+    "STUCK_ON": "stuck_on",
+    "CLIFF": "cliff_flag",
+    "PROFILE_HARD": "profile_flag_hard",
+    "SPIKE": "spike_flag",
+    "ZERO_RUN_SHORT": "zero_run_soft",
+    "PROFILE_SOFT": "profile_flag_soft",
+    "LOGIC_INVALID": "logic_flag",
+}
+
+# flags whose rows are set to NaN in count_clean / dwell_clean
+HARD_FLAGS = [
+    "phys_flag",
+    "cap_flag",
+    "stuck_off",
+    "stuck_on",
+    "spike_flag",
+    "cliff_flag",
+    "profile_flag_hard",
+]
+
 IMPUTABLE_REASONS = {
     "ZERO_RUN_SHORT",
     "PROFILE_SOFT",
     "SPIKE",
 }
 
+CONFIDENCE_LEVELS = ["high", "medium", "low", "none"]
+
+# reasons missing here (CLIFF, ZERO_RUN_LONG) get no confidence (NaN)
+CONFIDENCE_MAP = {
+    "ZERO_RUN_SHORT": "high",
+    "SPIKE": "medium",
+    "PROFILE_SOFT": "medium",
+    "PROFILE_HARD": "low",
+    "STUCK_OFF": "low",
+    "STUCK_ON": "low",
+    "PHYS_INVALID": "none",
+    "CAP_EXCEEDED": "none",
+    "LOGIC_INVALID": "none",
+    "NONE": "high",
+}
+
 CONFIG = {
     "timestamp_candidates": [
         "Intervallbeginn (UTC)",
@@ -45,6 +91,7 @@ CONFIG = {
     "profile_hard_z": 7.5,
     "stuck_on_mean": 3,
     "stuck_on_std": 1e-6,
+    "incremental_dwell_bin_ms": 10,
 }
 
 COUNT_PAT = re.compile(r"^(?P<sid>[DV]\d+)\s*\(Belegungen/Intervall\)\s*$")
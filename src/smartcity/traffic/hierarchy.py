@@ -0,0 +1,243 @@
+"""
+Lane-, street- and intersection-level rollups of the per-sensor aggregate.
+
+The sensor -> lane -> street (OSM way) -> intersection hierarchy comes from
+the maps written by build_intersection_abox: `sensor_to_lane_map.json`
+(sensor id -> lane URI) and the lane map (`{intersection}:{way}:{lane}` ->
+lane URI). Several intersections' maps can be combined; sensor IDs are
+local to an intersection, so sensors are keyed by (intersection_id,
+sensor_id) and the aggregate needs an intersection_id column.
+
+Each level is one grouping set of a single query over the aggregate, so
+all levels come from one pass. Loop (D*) and video (V*) sensors on the
+same lane count the same vehicles, so a lane's volume is the mean over its
+mapped sensors, not their sum; sensors on a lane of unknown index ("na")
+are taken as lanes of their own. Combination rules per group and bucket:
+
+- count_agg, occupancy_time_agg, available_count_minutes,
+  available_dwell_minutes: each sensor's value over its lane's sensor
+  count, summed, i.e. the sum over lanes of the lane means
+- coverage_count / coverage_dwell: available lane-minutes over the
+  lane-minutes of every mapped lane in the group (lanes_mapped), so
+  sensors without a row count as uncovered
+- count_agg_scaled: count_agg / coverage_count, the group volume with the
+  uncovered lane-minutes filled at the covered rate; for one lane, the
+  coverage-weighted mean of its sensors' rates
+- occupancy_ratio: occupied time over covered lane-minutes, i.e. the
+  coverage-weighted mean of the lanes' occupancy
+- minute_rows, imputed and missing minutes, flag counts: sums over sensors
+- rates (imputed, clean observed, flags): weighted by minute rows
+"""
+
+import json
+from pathlib import Path
+from typing import List
+
+import pandas as pd
+
+
+ROLLUP_LEVELS = {
+    "lane": ["intersection_id", "way_id", "lane_index"],
+    "street": ["intersection_id", "way_id"],
+    "intersection": ["intersection_id"],
+}
+
+HIERARCHY_COLUMNS = ["sensor_id", "lane_uri", "intersection_id", "way_id", "lane_index"]
+
+# per-sensor volume columns that are shared by the sensors of a lane
+LANE_SHARED_COLUMNS = ["count_agg", "occupancy_time_agg", "available_count_minutes", "available_dwell_minutes"]
+
+# per-sensor columns that add up across the sensors of a group as they are
+ROLLUP_SOURCE_COLUMNS = [
+    "timestamp",
+    "minute_rows",
+    "imputed_minutes",
+    "missing_minutes",
+    "is_clean_observed_rate",
+    "imputable_rate",
+    "soft_flag_rate",
+    "profile_flag_hard_rate",
+    "spike_flag_rate",
+    "soft_flag_any",
+    "profile_flag_hard_any",
+    "spike_flag_any",
+    "freq",
+]
+
+
+def load_sensor_hierarchy(
+    sensor_to_lane_json: str | Path | List[str | Path],
+    lane_map_json: str | Path | List[str | Path],
+) -> pd.DataFrame:
+    """
+    One row per mapped (intersection_id, sensor_id): sensor_id, lane_uri,
+    intersection_id, way_id, lane_index (as in the lane URI, "na" if
+    unknown). The intersection is the lane's. Takes one map file or a list
+    (one per intersection) of each kind.
+    """
+    sensor_files = [sensor_to_lane_json] if isinstance(sensor_to_lane_json, (str, Path)) else list(sensor_to_lane_json)
+    lane_files = [lane_map_json] if isinstance(lane_map_json, (str, Path)) else list(lane_map_json)
+
+    lanes = {}
+    for path in lane_files:
+        with open(path, "r", encoding="utf-8") as f:
+            for key, lane_uri in json.load(f).items():
+                lanes[lane_uri] = key.rsplit(":", 2)
+
+    rows = {}
+    for path in sensor_files:
+        with open(path, "r", encoding="utf-8") as f:
+            for sid, lane_uri in json.load(f).items():
+                sid = str(sid).strip()
+                if lane_uri not in lanes:
+                    raise ValueError(f"Lane {lane_uri} of sensor {sid} not found in the lane maps.")
+                key = (lanes[lane_uri][0], sid)
+                if key in rows and rows[key][1] != lane_uri:
+                    raise ValueError(f"Sensor {sid} of intersection {key[0]} is mapped to two lanes: {rows[key][1]} and {lane_uri}")
+                rows[key] = [sid, lane_uri, *lanes[lane_uri]]
+
+    if not rows:
+        raise ValueError("No sensors found in the sensor to lane maps.")
+    return pd.DataFrame(list(rows.values()), columns=HIERARCHY_COLUMNS)
+
+
+def rollup_sql(source: str, hierarchy: str, freq_seconds: int) -> str:
+    """
+    Lane, street and intersection rollups of the per-sensor aggregate in
+    `source` (columns of run_traffic_aggregation plus intersection_id) with
+    the sensor hierarchy table `hierarchy`, as one GROUPING SETS query. Rows
+    are tagged with `level`; keys below the level are NULL.
+    """
+    freq_minutes = freq_seconds / 60
+    sets = ", ".join(f"({', '.join(keys)}, timestamp)" for keys in ROLLUP_LEVELS.values())
+    expected_sets = ", ".join(f"({', '.join(keys)})" for keys in ROLLUP_LEVELS.values())
+    level = "CASE GROUPING(way_id, lane_index) WHEN 0 THEN 'lane' WHEN 1 THEN 'street' ELSE 'intersection' END"
+    weighted = ", ".join(
+        f"SUM({c} * minute_rows) AS {c}_minutes"
+        for c in ["is_clean_observed_rate", "imputable_rate", "soft_flag_rate", "profile_flag_hard_rate", "spike_flag_rate"]
+    )
+
+    shared = ",\n        ".join(f"a.{c} / h.lane_sensors AS {c}" for c in LANE_SHARED_COLUMNS)
+    kept = ", ".join(f"a.{c}" for c in ROLLUP_SOURCE_COLUMNS)
+
+    return f"""
+    WITH lanes AS (
+      SELECT
+        *,
+        CASE
+          WHEN lane_index = 'na' THEN 1
+          ELSE COUNT(*) OVER (PARTITION BY intersection_id, way_id, lane_index)
+        END AS lane_sensors
+      FROM {hierarchy}
+    ),
+
+    mapped AS (
+      SELECT
+        h.intersection_id, h.way_id, h.lane_index,
+        {kept},
+        {shared}
+      FROM {source} a
+      JOIN lanes h
+        ON CAST(a.intersection_id AS VARCHAR) = h.intersection_id
+       AND CAST(a.sensor_id AS VARCHAR) = h.sensor_id
+    ),
+
+    grouped AS (
+      SELECT
+        {level} AS level,
+        intersection_id,
+        way_id,
+        lane_index,
+        timestamp,
+        COUNT(*) AS sensors_reporting,
+        SUM(count_agg) AS count_agg,
+        SUM(occupancy_time_agg) AS occupancy_time_agg,
+        SUM(minute_rows) AS minute_rows,
+        SUM(available_count_minutes) AS available_count_minutes,
+        SUM(available_dwell_minutes) AS available_dwell_minutes,
+        SUM(imputed_minutes) AS imputed_minutes,
+        SUM(missing_minutes) AS missing_minutes,
+        {weighted},
+        MAX(soft_flag_any) AS soft_flag_any,
+        MAX(profile_flag_hard_any) AS profile_flag_hard_any,
+        MAX(spike_flag_any) AS spike_flag_any,
+        ANY_VALUE(freq) AS freq
+      FROM mapped
+      GROUP BY GROUPING SETS ({sets})
+    ),
+
+    expected AS (
+      SELECT
+        {level} AS level,
+        intersection_id,
+        way_id,
+        lane_index,
+        COUNT(*) AS sensors_mapped,
+        ROUND(SUM(1.0 / lane_sensors))::BIGINT AS lanes_mapped
+      FROM lanes
+      GROUP BY GROUPING SETS ({expected_sets})
+    )
+
+    SELECT
+      g.level,
+      g.intersection_id,
+      g.way_id,
+      g.lane_index,
+      g.timestamp,
+
+      e.sensors_mapped,
+      e.lanes_mapped,
+      g.sensors_reporting,
+
+      g.available_count_minutes / (e.lanes_mapped * {freq_minutes}) AS coverage_count,
+      g.available_dwell_minutes / (e.lanes_mapped * {freq_minutes}) AS coverage_dwell,
+
+      g.count_agg,
+      CASE
+        WHEN g.available_count_minutes > 0
+        THEN g.count_agg * (e.lanes_mapped * {freq_minutes}) / g.available_count_minutes
+        ELSE NULL
+      END AS count_agg_scaled,
+      g.occupancy_time_agg,
+
+      CASE
+        WHEN g.count_agg IS NOT NULL AND g.count_agg > 0
+        THEN g.occupancy_time_agg / g.count_agg
+        ELSE NULL
+      END AS avg_dwell_agg,
+
+      CASE
+        WHEN g.available_dwell_minutes > 0
+        THEN g.occupancy_time_agg / (g.available_dwell_minutes * 60000.0)
+        ELSE NULL
+      END AS occupancy_ratio,
+
+      g.is_clean_observed_rate_minutes / g.minute_rows AS is_clean_observed_rate,
+      g.imputable_rate_minutes / g.minute_rows AS imputable_rate,
+      g.imputed_minutes::DOUBLE / g.minute_rows AS imputed_rate,
+
+      g.soft_flag_any,
+      g.soft_flag_rate_minutes / g.minute_rows AS soft_flag_rate,
+      g.profile_flag_hard_any,
+      g.profile_flag_hard_rate_minutes / g.minute_rows AS profile_flag_hard_rate,
+      g.spike_flag_any,
+      g.spike_flag_rate_minutes / g.minute_rows AS spike_flag_rate,
+
+      g.minute_rows::BIGINT AS minute_rows,
+      g.available_count_minutes,
+      g.available_dwell_minutes,
+      g.imputed_minutes,
+      g.missing_minutes,
+
+      EXTRACT(dow FROM g.timestamp) AS weekday,
+      (EXTRACT(hour FROM g.timestamp) * 60 + EXTRACT(minute FROM g.timestamp))::INTEGER AS minute,
+      g.freq
+
+    FROM grouped g
+    JOIN expected e
+      ON e.level = g.level
+     AND e.intersection_id = g.intersection_id
+     AND e.way_id IS NOT DISTINCT FROM g.way_id
+     AND e.lane_index IS NOT DISTINCT FROM g.lane_index
+    ORDER BY g.level, g.intersection_id, g.way_id, g.lane_index, g.timestamp
+    """
@@ -0,0 +1,218 @@
+"""
+Incremental re-aggregation of appended or modified minute data.
+
+The aggregate is a dataset partitioned by UTC day of the bucket
+(`{output_dir}/date=YYYY-MM-DD/part-0.parquet`, rows ordered by sensor_id,
+timestamp). A state file `{output_dir}/_aggregation_state.json` records the
+frequency and, per input parquet file, its size, mtime and extent (first
+and last timestamp, sensors).
+
+Each run compares the input files with the state. Files that are new,
+modified or removed give the affected buckets: their old and new extents,
+widened to whole buckets, for the sensors they contain. Only those
+sensor x bucket cells are recomputed, reading only the input files whose
+extent overlaps them, and merged into the day partitions they fall in.
+Without state, everything is affected, which is the full rebuild.
+
+Buckets are computed with the cascade cells of aggregation.py, whose
+modes break ties deterministically, so merged partitions equal a full
+rebuild.
+"""
+
+import json
+import os
+from datetime import date, datetime, timedelta, timezone
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import duckdb
+
+from smartcity.traffic.aggregation import (
+    cascade_cells_sql,
+    cascade_output_sql,
+    frequency_to_label,
+    frequency_to_seconds,
+)
+
+
+STATE_FILE = "_aggregation_state.json"
+DAY_SECONDS = 86400
+
+
+def input_files(input_path: Path) -> Dict[str, Path]:
+    """Parquet files of a file or dataset folder, keyed by path relative to it."""
+    if input_path.is_dir():
+        return {p.relative_to(input_path).as_posix(): p for p in sorted(input_path.rglob("*.parquet"))}
+    return {input_path.name: input_path}
+
+
+def file_signature(path: Path) -> dict:
+    stat = path.stat()
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def file_extent(con: duckdb.DuckDBPyConnection, path: Path) -> dict:
+    """First/last epoch second and sensor ids of the rows of one input file."""
+    first, last, sensors = con.execute(f"""
+        SELECT
+          MIN(EXTRACT(EPOCH FROM CAST(timestamp AS TIMESTAMPTZ)))::BIGINT,
+          MAX(EXTRACT(EPOCH FROM CAST(timestamp AS TIMESTAMPTZ)))::BIGINT,
+          LIST(DISTINCT CAST(sensor_id AS VARCHAR) ORDER BY CAST(sensor_id AS VARCHAR))
+        FROM read_parquet('{path.as_posix()}', hive_partitioning = false)
+        WHERE timestamp IS NOT NULL AND sensor_id IS NOT NULL
+    """).fetchone()
+    return {"first": first, "last": last, "sensors": sensors or []}
+
+
+def bucket_intervals(extents: List[dict], freq_seconds: int) -> List[Tuple[int, int]]:
+    """Merged [start, end) epoch-second ranges of whole buckets covering `extents`."""
+    spans = sorted(
+        ((e["first"] // freq_seconds) * freq_seconds, (e["last"] // freq_seconds + 1) * freq_seconds)
+        for e in extents
+        if e["first"] is not None
+    )
+    merged: List[Tuple[int, int]] = []
+    for lo, hi in spans:
+        if merged and lo <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], hi))
+        else:
+            merged.append((lo, hi))
+    return merged
+
+
+def in_intervals_sql(column: str, intervals: List[Tuple[int, int]]) -> str:
+    return "(" + " OR ".join(f"({column} >= to_timestamp({lo}) AND {column} < to_timestamp({hi}))" for lo, hi in intervals) + ")"
+
+
+def in_sensors_sql(column: str, sensors: List[str]) -> str:
+    quoted = ", ".join("'" + s.replace("'", "''") + "'" for s in sensors)
+    return f"CAST({column} AS VARCHAR) IN ({quoted})"
+
+
+def partition_path(output_dir: Path, day: str) -> Path:
+    return output_dir / f"date={day}" / "part-0.parquet"
+
+
+def load_aggregation_state(output_dir: Path, freq_label: str) -> Dict[str, dict]:
+    path = output_dir / STATE_FILE
+    if not path.exists():
+        return {}
+    with open(path, "r") as f:
+        state = json.load(f)
+    if state.get("freq") != freq_label:
+        raise RuntimeError(
+            f"Aggregate at {output_dir} was built with freq {state.get('freq')}, not {freq_label}. "
+            "Use another output folder or remove it to rebuild."
+        )
+    return state["files"]
+
+
+def save_aggregation_state(output_dir: Path, freq_label: str, files: Dict[str, dict]) -> None:
+    with open(output_dir / STATE_FILE, "w") as f:
+        json.dump({"freq": freq_label, "files": files}, f, indent=2)
+
+
+def run_traffic_aggregation_incremental(
+    input_path: str | Path,
+    output_dir: str | Path,
+    freq: str = "10min",
+    threads: int = 8,
+) -> Path:
+    """
+    Bring the day-partitioned aggregate in `output_dir` up to date with the
+    minute data in `input_path` (a parquet file or dataset folder),
+    recomputing only the sensor x bucket cells touched by changed files.
+    """
+    input_path = Path(input_path)
+    output_dir = Path(output_dir)
+
+    if not input_path.exists():
+        raise FileNotFoundError(f"Input file not found: {input_path}")
+
+    freq_seconds = frequency_to_seconds(freq)
+    freq_label = frequency_to_label(freq)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    old_files = load_aggregation_state(output_dir, freq_label)
+
+    con = duckdb.connect(database=":memory:")
+    con.execute(f"PRAGMA threads={threads};")
+
+    files = input_files(input_path)
+    new_files: Dict[str, dict] = {}
+    touched: List[dict] = []
+    n_changed = 0
+    for rel, path in files.items():
+        signature = file_signature(path)
+        old = old_files.get(rel)
+        if old is not None and all(old[k] == signature[k] for k in signature):
+            new_files[rel] = old
+            continue
+        new_files[rel] = dict(signature, **file_extent(con, path))
+        touched.append(new_files[rel])
+        n_changed += 1
+        if old is not None:
+            touched.append(old)
+    removed = [old for rel, old in old_files.items() if rel not in files]
+    touched += removed
+
+    intervals = bucket_intervals(touched, freq_seconds)
+    sensors = sorted({s for e in touched for s in e["sensors"]})
+    if not intervals or not sensors:
+        save_aggregation_state(output_dir, freq_label, new_files)
+        con.close()
+        print(f"Traffic aggregation up to date: {output_dir}")
+        return output_dir
+
+    # only files whose extent overlaps an affected interval are read
+    sources = [
+        files[rel].as_posix()
+        for rel, e in new_files.items()
+        if e["first"] is not None and any(e["first"] < hi and e["last"] >= lo for lo, hi in intervals)
+    ]
+    if sources:
+        source = "read_parquet([" + ", ".join(f"'{p}'" for p in sources) + "], union_by_name = true)"
+        columns = [row[0] for row in con.execute(f"DESCRIBE SELECT * FROM {source}").fetchall()]
+        where = f" AND {in_sensors_sql('sensor_id', sensors)} AND {in_intervals_sql('CAST(timestamp AS TIMESTAMPTZ)', intervals)}"
+        con.execute(f"CREATE TEMP TABLE cells AS {cascade_cells_sql(source, columns, freq_seconds, where)}")
+        con.execute(f"CREATE TEMP TABLE fresh AS SELECT * FROM ({cascade_output_sql('cells', freq_seconds, freq_label)})")
+
+    days = sorted({d for lo, hi in intervals for d in range(lo // DAY_SECONDS, (hi - 1) // DAY_SECONDS + 1)})
+
+    stale = f"{in_sensors_sql('sensor_id', sensors)} AND {in_intervals_sql('timestamp', intervals)}"
+    written = 0
+    for day in days:
+        path = partition_path(output_dir, (date(1970, 1, 1) + timedelta(days=day)).isoformat())
+        day_rows = in_intervals_sql("timestamp", [(day * DAY_SECONDS, (day + 1) * DAY_SECONDS)])
+        parts = [f"SELECT * FROM fresh WHERE {day_rows}"] if sources else []
+        if path.exists():
+            parts.insert(0, f"SELECT * FROM read_parquet('{path.as_posix()}', hive_partitioning = false) WHERE NOT ({stale})")
+
+        n_rows = 0
+        if parts:
+            con.execute(f"CREATE OR REPLACE TEMP TABLE merged AS {' UNION ALL BY NAME '.join(parts)}")
+            n_rows = con.execute("SELECT COUNT(*) FROM merged").fetchone()[0]
+        if n_rows == 0:
+            if path.exists():
+                path.unlink()
+                path.parent.rmdir()
+            continue
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp")
+        con.execute(f"COPY (SELECT * FROM merged ORDER BY sensor_id, timestamp) TO '{tmp_path.as_posix()}' (FORMAT PARQUET)")
+        os.replace(tmp_path, path)
+        written += 1
+
+    con.close()
+    save_aggregation_state(output_dir, freq_label, new_files)
+
+    print("Incremental traffic aggregation finished.")
+    print(f"Input: {input_path}")
+    print(f"Output: {output_dir}")
+    print(f"Frequency: {freq}")
+    print(f"New or modified input files: {n_changed}, removed: {len(removed)}, affected sensors: {len(sensors)}")
+    for lo, hi in intervals:
+        print(f"Recomputed: {datetime.fromtimestamp(lo, timezone.utc)} to {datetime.fromtimestamp(hi, timezone.utc)}")
+    print(f"Rewritten day partitions: {written}")
+
+    return output_dir
@@ -0,0 +1,65 @@
+"""
+Locating traffic inputs shared by the combine and cleaning stages.
+"""
+
+import re
+from glob import glob
+from pathlib import Path
+from typing import Dict, List
+
+
+# file name prefix (A142_traffic_1min.parquet) or hive partition directory (intersection=A142)
+INTERSECTION_ID_PAT = re.compile(r"^(?:intersection=)?(?P<iid>A\d+)")
+
+
+def input_bytes(path: str | Path) -> int:
+    """Size of an input file, or the summed size of the files of a dataset directory."""
+    path = Path(path)
+    if path.is_dir():
+        return sum(p.stat().st_size for p in path.rglob("*") if p.is_file())
+    return path.stat().st_size
+
+
+def discover_intersection_inputs(
+    input_glob: str | None = None,
+    input_template: str | None = None,
+    intersection_ids: List[str] | None = None,
+) -> Dict[str, Path]:
+    """
+    Map intersection IDs to combined input files.
+
+    Either expand `input_glob` (the ID is taken from the file name prefix,
+    e.g. A142_traffic_1min.parquet, or a partition directory name,
+    e.g. intersection=A142) or fill `input_template` with every ID,
+    e.g. "data/interim/traffic/{intersection_id}_traffic_1min.parquet".
+    `intersection_ids` restricts the glob result to the listed IDs.
+    """
+    inputs: Dict[str, Path] = {}
+
+    if input_template is not None:
+        if not intersection_ids:
+            raise ValueError("input_template requires at least one intersection ID.")
+        for iid in intersection_ids:
+            inputs[iid] = Path(input_template.format(intersection_id=iid))
+    elif input_glob is not None:
+        for path in sorted(glob(input_glob, recursive=True)):
+            m = INTERSECTION_ID_PAT.match(Path(path).name)
+            if not m:
+                continue
+            iid = m.group("iid")
+            if intersection_ids and iid not in intersection_ids:
+                continue
+            if iid in inputs:
+                raise ValueError(f"Multiple input files for intersection {iid}: {inputs[iid]}, {path}")
+            inputs[iid] = Path(path)
+    else:
+        raise ValueError("Provide either input_glob or input_template.")
+
+    missing = [str(p) for p in inputs.values() if not p.exists()]
+    if missing:
+        raise FileNotFoundError(f"Input files not found: {missing}")
+
+    if not inputs:
+        raise RuntimeError("No intersection input files found.")
+
+    return inputs
@@ -0,0 +1,222 @@
+"""
+Out-of-core cleaning in time partitions.
+
+Pass 1 streams the wide input in row chunks, converts each chunk to long
+format and spills it into per-partition staging files. What the weekday x
+bucket profiles need (cell id, count, dwell: 12 bytes per row) is spilled
+per sensor, and the profiles are then built one sensor at a time, so they
+are exactly those of process_file.
+
+Pass 2 cleans one partition at a time. Each partition is prefixed with the
+last window_halo_rows() raw rows of every sensor (the halo), so rolling,
+diff and zero-run flags continue exactly across partition borders. Flagged
+rows are written straight to `{outdir}/{intersection_id}_clean_pre_fusion/`
+as one part file per partition.
+
+Peak memory is bounded by the largest of one input chunk (`chunk_rows`),
+one partition plus its halo (`partition_freq`) and the profile values of
+one sensor (12 bytes per row of that sensor over the whole input; the
+profile medians are exact quantiles, so they need all of a cell's values).
+"""
+
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+
+from smartcity.traffic.cleaning import (
+    compute_flags,
+    extract_sensor_map,
+    find_timestamp_column,
+    input_columns,
+    sniff_csv_separator,
+    summarize_sensor,
+    wide_to_long,
+)
+from smartcity.traffic.config import CONFIG
+from smartcity.traffic.incremental import RAW_COLUMNS, dataset_dir, window_tails
+from smartcity.traffic.profiles import (
+    WEEKDAYS,
+    buckets_per_day,
+    cell_index,
+    profile_arrays_from_cells,
+    profile_keys,
+    profile_table,
+)
+from smartcity.traffic.schema import compact_parquet_options, to_compact
+
+
+# staging subfolder of the per-sensor profile spill (partition labels are dates)
+PROFILE_SPILL = "_profile"
+
+
+def iter_input_chunks(path: str | Path, chunk_rows: int) -> Iterator[pd.DataFrame]:
+    """Yield the wide input in chunks of `chunk_rows` rows (Excel is read at once, Parquet is projected)."""
+    ext = os.path.splitext(str(path))[1].lower()
+    if ext in [".xlsx", ".xls"]:
+        df = pd.read_excel(path)
+        for lo in range(0, len(df), chunk_rows):
+            yield df.iloc[lo:lo + chunk_rows]
+    elif ext in [".csv"]:
+        yield from pd.read_csv(path, sep=sniff_csv_separator(str(path)), chunksize=chunk_rows)
+    elif ext == ".parquet" or os.path.isdir(path):
+        dataset = ds.dataset(str(path), format="parquet", partitioning="hive")
+        columns = input_columns(dataset.schema.names)
+        for batch in dataset.to_batches(columns=columns, batch_size=chunk_rows):
+            yield batch.to_pandas()
+    else:
+        raise ValueError(f"Unsupported file extension: {ext}")
+
+
+def partition_keys(ts: pd.Series, partition_freq: str) -> np.ndarray:
+    """Partition label per row: start date (YYYYMMDD) of its period, sortable as text."""
+    codes, periods = pd.factorize(ts.dt.tz_convert(None).dt.to_period(partition_freq))
+    labels = np.asarray(periods.start_time.strftime("%Y%m%d"), dtype=object)
+    return labels[codes]
+
+
+def stage_partitions(
+    input_path: str | Path,
+    staging: Path,
+    partition_freq: str,
+    chunk_rows: int,
+) -> tuple[list, pd.DataFrame]:
+    """
+    Pass 1: spill long rows into `staging/{partition}/chunk-*.parquet` and
+    profile values into `staging/_profile/{sensor code}/chunk-*.parquet`,
+    then build the sensor profiles. Returns (sorted partition labels,
+    profiles).
+    """
+    profile_minutes = CONFIG["profile_group_minutes"]
+    sensor_ids: list = []
+    partitions = set()
+
+    for i, chunk in enumerate(iter_input_chunks(input_path, chunk_rows)):
+        if not sensor_ids:
+            ts_col = find_timestamp_column(chunk)
+            sensors = extract_sensor_map(list(chunk.columns))
+            if not sensors:
+                raise ValueError("No sensor pairs found. Ensure expected column names exist.")
+            sensor_ids = list(sensors)
+            print(f"Found {len(sensors)} sensors.")
+
+        df_long = wide_to_long(chunk, ts_col, sensors, sort=True)
+        if df_long.empty:
+            continue
+
+        codes = pd.Index(sensor_ids).get_indexer(df_long["sensor_id"])
+        weekday, bucket = profile_keys(df_long["timestamp"], profile_minutes)
+        values = pd.DataFrame({
+            "cell": cell_index(np.zeros_like(codes), weekday, bucket, profile_minutes).astype(np.int32),
+            "count": df_long["count_raw"].to_numpy(dtype=np.float32),
+            "dwell": df_long["dwell_raw"].to_numpy(dtype=np.float32),
+        })
+        for code, rows in values.groupby(codes, sort=False):
+            spill_dir = staging / PROFILE_SPILL / f"{code:05d}"
+            spill_dir.mkdir(parents=True, exist_ok=True)
+            rows.to_parquet(spill_dir / f"chunk-{i:06d}.parquet", index=False)
+
+        keys = partition_keys(df_long["timestamp"], partition_freq)
+        for key, rows in df_long.groupby(keys, sort=False):
+            part_dir = staging / key
+            part_dir.mkdir(parents=True, exist_ok=True)
+            rows[RAW_COLUMNS].to_parquet(part_dir / f"chunk-{i:06d}.parquet", index=False)
+            partitions.add(key)
+
+    if not sensor_ids:
+        raise ValueError(f"Input is empty: {input_path}")
+
+    return sorted(partitions), spilled_profiles(staging / PROFILE_SPILL, sensor_ids, profile_minutes)
+
+
+def spilled_profiles(spill: Path, sensor_ids: list, profile_minutes: int) -> pd.DataFrame:
+    """Profiles of the per-sensor spill in `spill`, built one sensor at a time."""
+    n_cells = WEEKDAYS * buckets_per_day(profile_minutes)
+    per_sensor = []
+    for code in range(len(sensor_ids)):
+        spill_dir = spill / f"{code:05d}"
+        values = pd.read_parquet(spill_dir) if spill_dir.exists() else pd.DataFrame({"cell": [], "count": [], "dwell": []})
+        per_sensor.append(profile_arrays_from_cells(
+            values["cell"].to_numpy(dtype=np.int64),
+            n_cells,
+            values["count"].to_numpy(dtype=np.float32),
+            values["dwell"].to_numpy(dtype=np.float32),
+        ))
+    arrays = {key: np.concatenate([a[key] for a in per_sensor]) for key in per_sensor[0]}
+    return profile_table(arrays, sensor_ids, profile_minutes)
+
+
+def process_file_partitioned(
+    input_path: str | Path,
+    outdir: str | Path,
+    intersection_id: str,
+    partition_freq: str = "M",
+    chunk_rows: int = 200_000,
+    compact: bool = False,
+) -> Path:
+    """
+    Clean `input_path` partition by partition (`partition_freq` is a pandas
+    period alias, e.g. "M" for months) and write one part file per
+    partition. Flags equal those of process_file. The sensor summary has
+    one row per sensor and partition.
+    """
+    outdir = Path(outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+    ds_dir = dataset_dir(outdir, intersection_id)
+    if ds_dir.exists():
+        shutil.rmtree(ds_dir)
+    ds_dir.mkdir(parents=True)
+
+    staging = outdir / f"{intersection_id}_partition_staging"
+    if staging.exists():
+        shutil.rmtree(staging)
+
+    try:
+        partitions, profiles = stage_partitions(input_path, staging, partition_freq, chunk_rows)
+        print(f"Staged {len(partitions)} partitions ({partition_freq}).")
+
+        halo = None
+        summaries = []
+        for key in partitions:
+            rows = pd.concat(
+                [pd.read_parquet(path) for path in sorted((staging / key).glob("*.parquet"))],
+                ignore_index=True,
+            )
+            combined = rows.assign(_is_new=True)
+            if halo is not None:
+                combined = pd.concat([halo.assign(_is_new=False), combined], ignore_index=True)
+            flagged = compute_flags(combined, profiles=profiles)
+            result = flagged[flagged["_is_new"].to_numpy()].drop(columns=["_is_new"]).reset_index(drop=True)
+            halo = window_tails(combined.drop(columns=["_is_new"]))
+
+            for sid, cleaned in result.groupby("sensor_id", sort=False, observed=True):
+                summ = summarize_sensor(cleaned)
+                summ["sensor_id"] = sid
+                summ["intersection_id"] = intersection_id
+                summ["partition"] = key
+                summaries.append(summ)
+
+            part_path = ds_dir / f"part-{key}.parquet"
+            if compact:
+                result = to_compact(result)
+                result.to_parquet(part_path, index=False, **compact_parquet_options(result))
+            else:
+                result.to_parquet(part_path, index=False)
+            print(f"Partition {key}: {len(result)} rows")
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+    summary_csv = outdir / f"{intersection_id}_sensor_summary.csv"
+    pd.DataFrame(summaries).to_csv(summary_csv, index=False)
+
+    with open(outdir / f"{intersection_id}_config.json", "w") as f:
+        json.dump(CONFIG, f, indent=2)
+
+    print(f"Saved dataset: {ds_dir}")
+    print(f"Saved summary: {summary_csv}")
+    return ds_dir
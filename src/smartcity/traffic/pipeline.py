@@ -0,0 +1,84 @@
+"""
+In-process traffic pipeline: layered imputation -> aggregation -> validation.
+
+The imputed frame is converted once to an Arrow table and registered in a
+DuckDB connection, which scans it in place. The aggregation query reads it
+there and is materialised as the DuckDB table `traffic_agg`; the summary
+and per-sensor validation statistics come from one GROUPING SETS scan of
+it. Files are only written for the outputs that are given a path.
+"""
+
+from pathlib import Path
+from typing import List
+
+import duckdb
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from smartcity.imputation.traffic_imputation import load_clean_traffic, run_layered_imputation
+from smartcity.traffic.aggregation import aggregation_sql, frequency_to_label
+from smartcity.traffic.aggregation_validation import write_validation_reports
+
+
+def run_traffic_pipeline(
+    input_path: str | Path,
+    freq: str = "10min",
+    start=None,
+    end=None,
+    sensor_ids: List[str] | None = None,
+    workers: int = 1,
+    threads: int = 8,
+    profile_store_dir: str | Path | None = None,
+    imputed_output: str | Path | None = None,
+    aggregate_output: str | Path | None = None,
+    summary_output: str | Path | None = None,
+    sensor_output: str | Path | None = None,
+) -> dict:
+    """
+    Impute, aggregate and validate cleaned traffic without intermediate
+    files. Returns {"imputed": Arrow table, "aggregate": Arrow table,
+    "summary": DataFrame, "sensors": DataFrame}; each `*_output` path
+    additionally writes that result (Parquet, or CSV for the validation
+    tables) in the same format as the file-based scripts.
+    """
+    df = load_clean_traffic(input_path, start=start, end=end, sensor_ids=sensor_ids)
+    imputed = pa.Table.from_pandas(run_layered_imputation(df, workers=workers, profile_store_dir=profile_store_dir), preserve_index=False)
+    del df
+
+    con = duckdb.connect(database=":memory:")
+    con.execute(f"PRAGMA threads={threads};")
+    con.register("traffic_imputed", imputed)
+
+    con.execute(f"CREATE TEMP TABLE traffic_agg AS {aggregation_sql('traffic_imputed', imputed.column_names, freq)}")
+    outputs = {
+        "imputed": imputed_output,
+        "aggregate": aggregate_output,
+        "summary": summary_output,
+        "sensors": sensor_output,
+    }
+    for path in outputs.values():
+        if path is not None:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+
+    if imputed_output is not None:
+        pq.write_table(imputed, Path(imputed_output))
+    if aggregate_output is not None:
+        con.execute(f"COPY traffic_agg TO '{Path(aggregate_output).as_posix()}' (FORMAT PARQUET);")
+    summary, sensors = write_validation_reports(con, "traffic_agg", summary_output, sensor_output, frequency_to_label(freq))
+
+    # HUGEINT sums are DOUBLE in the Parquet output; return them the same way
+    hugeint = [name for name, dtype, *_ in con.execute("DESCRIBE traffic_agg").fetchall() if dtype == "HUGEINT"]
+    replace = f" REPLACE ({', '.join(f'{c}::DOUBLE AS {c}' for c in hugeint)})" if hugeint else ""
+    aggregate = con.execute(f"SELECT *{replace} FROM traffic_agg").fetch_arrow_table()
+    con.close()
+
+    print("Traffic pipeline finished.")
+    print(f"Input: {input_path}")
+    print(f"Imputed rows: {imputed.num_rows}")
+    print(f"Aggregated rows ({freq}): {aggregate.num_rows}")
+    for name, path in outputs.items():
+        if path is not None:
+            print(f"Saved {name}: {path}")
+    print(summary.T.to_string(header=False))
+
+    return {"imputed": imputed, "aggregate": aggregate, "summary": summary, "sensors": sensors}
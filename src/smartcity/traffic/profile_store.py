@@ -0,0 +1,129 @@
+"""
+Persistent dense profile store.
+
+Weekday x bucket profile statistics of every sensor are kept in one
+float32 array [sensor, weekday, bucket, stat], saved as a raw
+memory-mapped file `profiles.f32` next to a small JSON sidecar
+`profiles.json` (format version, stage, data hash, profile_minutes, stat
+names and the sensor index). Cleaning and imputation keep their stores in
+their own `{root}/{stage}/` subfolder (PROFILE_STAGES), so one store root
+serves both stages. Lookups read whole sensors by integer index, and
+cell_index of (sensor position, weekday, bucket) addresses a cell of the
+flattened per-stat view.
+
+A store is reused only when the sidecar matches the stage, data hash and
+profile_minutes it is opened with; the sidecar is written last, so an
+interrupted build is never reused.
+"""
+
+import hashlib
+import json
+from pathlib import Path
+from typing import Dict, List, Sequence
+
+import numpy as np
+import pandas as pd
+
+from smartcity.traffic.profiles import WEEKDAYS, buckets_per_day
+
+
+PROFILE_STORE_VERSION = 1
+DATA_FILE = "profiles.f32"
+META_FILE = "profiles.json"
+PROFILE_STAGES = ("cleaning", "imputation")
+
+
+def frame_hash(df: pd.DataFrame, columns: List[str]) -> str:
+    """Content hash of `columns` of `df` (values and order, not the index)."""
+    digest = hashlib.sha256()
+    for col in columns:
+        digest.update(col.encode())
+        digest.update(pd.util.hash_pandas_object(df[col], index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+class ProfileStore:
+    """Dense [sensor, weekday, bucket, stat] float32 profiles backed by a memmap."""
+
+    def __init__(self, root: str | Path, stage: str, values: np.ndarray, sensor_ids: Sequence[str], stats: List[str], profile_minutes: int, data_hash: str):
+        self.root = Path(root)
+        self.stage = stage
+        self.values = values
+        self.sensor_ids = pd.Index(sensor_ids)
+        self.stats = list(stats)
+        self.profile_minutes = profile_minutes
+        self.data_hash = data_hash
+
+    def write(self, sensor_ids: Sequence[str], arrays: Dict[str, np.ndarray]) -> None:
+        """Store flat per-stat arrays laid out like cell_index over `sensor_ids`."""
+        idx = self.sensor_ids.get_indexer(sensor_ids)
+        if (idx < 0).any():
+            raise ValueError("Sensors not in the profile store: " + ", ".join(np.asarray(sensor_ids, dtype=str)[idx < 0]))
+        for k, stat in enumerate(self.stats):
+            self.values[idx, ..., k] = np.asarray(arrays[stat], dtype=np.float32).reshape(len(idx), *self.values.shape[1:3])
+
+    def finalize(self) -> "ProfileStore":
+        """Flush the array and write the sidecar, marking the store complete."""
+        if isinstance(self.values, np.memmap):
+            self.values.flush()
+        meta = {
+            "version": PROFILE_STORE_VERSION,
+            "stage": self.stage,
+            "data_hash": self.data_hash,
+            "profile_minutes": self.profile_minutes,
+            "stats": self.stats,
+            "sensor_ids": [str(s) for s in self.sensor_ids],
+        }
+        (self.root / META_FILE).write_text(json.dumps(meta, indent=2))
+        return self
+
+    def dense(self, sensor_ids: Sequence[str]) -> Dict[str, np.ndarray]:
+        """
+        Flat per-stat arrays for `sensor_ids` in that order, indexable with
+        cell_index(codes into `sensor_ids`, ...). Unknown sensors are NaN.
+        """
+        idx = self.sensor_ids.get_indexer(sensor_ids)
+        block = np.array(self.values[np.maximum(idx, 0)])
+        block[idx < 0] = np.nan
+        return {stat: block[..., k].reshape(-1) for k, stat in enumerate(self.stats)}
+
+
+def stage_root(root: str | Path, stage: str) -> Path:
+    """Folder of `stage`'s store under the store root `root`."""
+    if stage not in PROFILE_STAGES:
+        raise ValueError(f"Unknown profile store stage: {stage}. Use one of {PROFILE_STAGES}.")
+    return Path(root) / stage
+
+
+def create_profile_store(root: str | Path, stage: str, sensor_ids: Sequence[str], stats: List[str], profile_minutes: int, data_hash: str) -> ProfileStore:
+    """New all-NaN `stage` store under `root`; fill it with write() and complete it with finalize()."""
+    root = stage_root(root, stage)
+    root.mkdir(parents=True, exist_ok=True)
+    meta_path = root / META_FILE
+    if meta_path.exists():
+        meta_path.unlink()
+    shape = (len(sensor_ids), WEEKDAYS, buckets_per_day(profile_minutes), len(stats))
+    values = np.memmap(root / DATA_FILE, dtype=np.float32, mode="w+", shape=shape)
+    values[:] = np.nan
+    return ProfileStore(root, stage, values, sensor_ids, stats, profile_minutes, data_hash)
+
+
+def open_profile_store(root: str | Path, stage: str, data_hash: str, profile_minutes: int) -> ProfileStore | None:
+    """The completed `stage` store under `root` if it was built from this data and bucket size, else None."""
+    root = stage_root(root, stage)
+    meta_path = root / META_FILE
+    if not meta_path.exists() or not (root / DATA_FILE).exists():
+        return None
+
+    meta = json.loads(meta_path.read_text())
+    if (
+        meta.get("version") != PROFILE_STORE_VERSION
+        or meta.get("stage") != stage
+        or meta.get("data_hash") != data_hash
+        or meta.get("profile_minutes") != profile_minutes
+    ):
+        return None
+
+    shape = (len(meta["sensor_ids"]), WEEKDAYS, buckets_per_day(profile_minutes), len(meta["stats"]))
+    values = np.memmap(root / DATA_FILE, dtype=np.float32, mode="r", shape=shape)
+    return ProfileStore(root, stage, values, meta["sensor_ids"], meta["stats"], profile_minutes, data_hash)
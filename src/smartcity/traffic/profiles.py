@@ -0,0 +1,137 @@
+from typing import Dict, Sequence
+
+import numpy as np
+import pandas as pd
+
+
+WEEKDAYS = 7
+MINUTES_PER_DAY = 1440
+PROFILE_COLUMNS = ["c_med", "c_iqr", "d_med", "d_iqr"]
+
+
+def buckets_per_day(profile_minutes: int) -> int:
+    return -(-MINUTES_PER_DAY // profile_minutes)
+
+
+def profile_keys(ts: pd.Series, profile_minutes: int) -> tuple[np.ndarray, np.ndarray]:
+    """Return (weekday, bucket) arrays; bucket is the start minute of the profile slot."""
+    dt = ts.dt
+    minutes = (dt.hour * 60 + dt.minute).to_numpy(dtype=np.int64)
+    return dt.weekday.to_numpy(dtype=np.int64), (minutes // profile_minutes) * profile_minutes
+
+
+def cell_index(codes: np.ndarray, weekday: np.ndarray, bucket: np.ndarray, profile_minutes: int) -> np.ndarray:
+    """Dense cell id of (sensor code, weekday, bucket)."""
+    n_buckets = buckets_per_day(profile_minutes)
+    return (np.asarray(codes, dtype=np.int64) * WEEKDAYS + weekday) * n_buckets + bucket // profile_minutes
+
+
+def _order_preserving_bits(values: np.ndarray) -> np.ndarray:
+    """Map float32 to uint32 so that unsigned order equals float order."""
+    bits = np.ascontiguousarray(values, dtype=np.float32).view(np.uint32)
+    return np.where(bits & np.uint32(0x80000000), ~bits, bits | np.uint32(0x80000000))
+
+
+def _bits_to_float(keys: np.ndarray) -> np.ndarray:
+    keys = keys.astype(np.uint32)
+    bits = np.where(keys & np.uint32(0x80000000), keys & np.uint32(0x7FFFFFFF), ~keys)
+    return bits.astype(np.uint32).view(np.float32)
+
+
+def _lerp(a: np.ndarray, b: np.ndarray, t: np.ndarray) -> np.ndarray:
+    """numpy's percentile interpolation (`_lerp`), evaluated the same way for float32 inputs."""
+    diff = (b - a).astype(np.float64)
+    return np.where(t < 0.5, a + diff * t, b - diff * (1 - t)).astype(np.float32)
+
+
+def cell_quantiles(cells: np.ndarray, values, n_cells: int, quantiles: Sequence[float]) -> Dict[float, np.ndarray]:
+    """
+    Per-cell NaN-ignoring quantiles of float32 values in one sort.
+
+    Values are sorted once by a composite uint64 key (cell, value). q=0.5
+    follows np.nanmedian (mean of the middle pair), other quantiles follow
+    np.nanpercentile with linear interpolation, both in float32, so results
+    equal the per-group numpy calls bit for bit. Empty cells are NaN.
+    """
+    values = np.asarray(values, dtype=np.float32)
+    valid = ~np.isnan(values)
+    cells = np.asarray(cells, dtype=np.uint64)[valid]
+
+    keys = (cells << np.uint64(32)) | _order_preserving_bits(values[valid]).astype(np.uint64)
+    keys.sort()
+    sorted_values = _bits_to_float(keys & np.uint64(0xFFFFFFFF))
+
+    counts = np.bincount((keys >> np.uint64(32)).astype(np.int64), minlength=n_cells)
+    offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    has = counts > 0
+    n = np.maximum(counts, 1)
+    # empty cells read a harmless slot and are masked to NaN below
+    padded = np.append(sorted_values, np.float32(np.nan))
+
+    def at(rank):
+        return padded[np.where(has, offsets + rank, len(sorted_values))]
+
+    out = {}
+    for q in quantiles:
+        if q == 0.5:
+            lower = at((n - 1) // 2)
+            upper = at(n // 2)
+            res = (lower + upper) / np.float32(2)
+        else:
+            pos = q * (n - 1)
+            lo = np.floor(pos).astype(np.int64)
+            res = _lerp(at(lo), at(np.minimum(lo + 1, n - 1)), pos - lo)
+        out[q] = np.where(has, res, np.float32(np.nan)).astype(np.float32)
+
+    return out
+
+
+def build_profile_arrays(codes: np.ndarray, n_sensors: int, ts: pd.Series, count_values, dwell_values, profile_minutes: int) -> Dict[str, np.ndarray]:
+    """Dense [sensor, weekday, bucket] profile arrays (flattened) for both signals."""
+    weekday, bucket = profile_keys(ts, profile_minutes)
+    cells = cell_index(codes, weekday, bucket, profile_minutes)
+    n_cells = n_sensors * WEEKDAYS * buckets_per_day(profile_minutes)
+    return profile_arrays_from_cells(cells, n_cells, count_values, dwell_values)
+
+
+def profile_arrays_from_cells(cells: np.ndarray, n_cells: int, count_values, dwell_values) -> Dict[str, np.ndarray]:
+    arrays = {}
+    for prefix, values in [("c", count_values), ("d", dwell_values)]:
+        q = cell_quantiles(cells, values, n_cells, [0.25, 0.5, 0.75])
+        arrays[f"{prefix}_med"] = q[0.5]
+        arrays[f"{prefix}_iqr"] = q[0.75] - q[0.25]
+    arrays["observed"] = np.bincount(cells, minlength=n_cells) > 0
+    return arrays
+
+
+def profile_table(arrays: Dict[str, np.ndarray], sensor_ids: Sequence[str], profile_minutes: int) -> pd.DataFrame:
+    """Compact (sensor_id, weekday, bucket) table of the cells that had rows."""
+    n_buckets = buckets_per_day(profile_minutes)
+    cells = np.flatnonzero(arrays["observed"])
+    sensor = cells // (WEEKDAYS * n_buckets)
+    weekday = (cells // n_buckets) % WEEKDAYS
+    bucket = (cells % n_buckets) * profile_minutes
+
+    table = pd.DataFrame({
+        "sensor_id": np.asarray(sensor_ids, dtype=object)[sensor],
+        "weekday": weekday.astype("int64"),
+        "bucket": bucket.astype("int64"),
+    })
+    for col in PROFILE_COLUMNS:
+        table[col] = arrays[col][cells]
+    return table
+
+
+def dense_from_table(profiles: pd.DataFrame, sensor_ids: Sequence[str], profile_minutes: int) -> Dict[str, np.ndarray]:
+    """Scatter a profile table into dense arrays indexed like cell_index for `sensor_ids`."""
+    n_cells = len(sensor_ids) * WEEKDAYS * buckets_per_day(profile_minutes)
+    codes = pd.Index(sensor_ids).get_indexer(profiles["sensor_id"])
+    known = codes >= 0
+    cells = cell_index(codes[known], profiles["weekday"].to_numpy()[known], profiles["bucket"].to_numpy()[known], profile_minutes)
+
+    arrays = {}
+    for col in PROFILE_COLUMNS:
+        dense = np.full(n_cells, np.nan, dtype=profiles[col].to_numpy().dtype if profiles[col].dtype.kind == "f" else np.float64)
+        dense[cells] = profiles[col].to_numpy()[known]
+        arrays[col] = dense
+    return arrays
@@ -0,0 +1,321 @@
+"""
+Group-aware rolling kernels for the cleaning detectors and imputation.
+
+Rolling medians and quantiles sort every trailing window in chunks
+(np.sort on compact int16 keys where possible, which NumPy runs with SIMD
+sorting networks). On one year of one-minute counts this is about 4x
+faster than pandas rolling with identical flags
+(scripts/benchmark_traffic_rolling.py), about 60 ms per median or
+quantile pass, of which the sort takes ~40 ms and the window copy ~20 ms.
+
+Open item: the 10x target needs an incremental sorted window (one insert
+and one delete per step, as pandas' skiplist does) in compiled code. In
+plain NumPy, stepping thousands of sorted windows in parallel with one
+vectorised insert/delete per step measured ~1 s per pass, 15x slower than
+the block sort, so it is not used. The missing ~2.5x is left for a
+numba or Cython kernel.
+"""
+
+from typing import Iterator, Sequence, Tuple
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+DEFAULT_CHUNK_ROWS = 1 << 16
+INT16_NAN_KEY = np.iinfo(np.int16).max
+
+
+def group_bounds(codes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Return (is_group_first_row, group_start_index) for rows sorted by group code."""
+    n = len(codes)
+    first = np.ones(n, dtype=bool)
+    if n > 1:
+        first[1:] = codes[1:] != codes[:-1]
+    starts = np.maximum.accumulate(np.where(first, np.arange(n), 0))
+    return first, starts
+
+
+def _as_values(values) -> np.ndarray:
+    values = np.asarray(values)
+    if values.dtype not in (np.float32, np.float64):
+        values = values.astype(np.float64)
+    return np.ascontiguousarray(values)
+
+
+def _sort_keys(values: np.ndarray) -> Tuple[np.ndarray, float, object]:
+    """
+    Order-preserving compact encoding used for sorting windows.
+
+    Returns (keys, scale, pad). Values that are multiples of 0.5 inside the
+    int16 range (counts, count diffs and their deviations from a median) are
+    encoded as int16 of 2 * value, with NaN mapped to the largest key so it
+    sorts last. Other data are sorted as float32 when that is lossless, else
+    as float64. Decoding is `key / scale`, which is exact in every case.
+    """
+    nan = np.isnan(values)
+    finite = values[~nan]
+    doubled = finite * 2
+    if finite.size == 0 or (np.abs(doubled).max() < INT16_NAN_KEY and np.array_equal(doubled, np.round(doubled))):
+        keys = np.where(nan, INT16_NAN_KEY, values * 2).astype(np.int16)
+        return keys, 2.0, INT16_NAN_KEY
+
+    if values.dtype == np.float64:
+        as_f32 = values.astype(np.float32)
+        if np.array_equal(as_f32, values, equal_nan=True):
+            return as_f32, 1.0, np.nan
+
+    return values, 1.0, np.nan
+
+
+def _window_counts(values: np.ndarray, window: int, starts: np.ndarray | None) -> np.ndarray:
+    """Number of non-NaN observations in each row's trailing (group-bounded) window."""
+    n = len(values)
+    cum = np.concatenate([[0], np.cumsum(~np.isnan(values))])
+    first = np.maximum(np.arange(n) - window + 1, 0)
+    if starts is not None:
+        first = np.maximum(first, starts)
+    return cum[1:] - cum[first]
+
+
+def _window_blocks(
+    keys: np.ndarray,
+    window: int,
+    starts: np.ndarray | None,
+    pad,
+    chunk_rows: int = DEFAULT_CHUNK_ROWS,
+) -> Iterator[Tuple[int, int, np.ndarray]]:
+    """
+    Yield (lo, hi, block) where block[k] holds the sorted trailing window of
+    row lo + k. Slots before the array start or the row's group start hold
+    `pad`, which sorts after every observation.
+    """
+    n = len(keys)
+    padded = np.concatenate([np.full(window - 1, pad, dtype=keys.dtype), keys])
+    view = sliding_window_view(padded, window)
+    positions = np.arange(window)
+
+    for lo in range(0, n, chunk_rows):
+        hi = min(lo + chunk_rows, n)
+        block = view[lo:hi].copy()
+        if starts is not None:
+            # number of leading slots that belong to a previous group
+            offset = starts[lo:hi] - (np.arange(lo, hi) - window + 1)
+            if (offset > 0).any():
+                block[positions[None, :] < offset[:, None]] = pad
+        block.sort(axis=1)
+        yield lo, hi, block
+
+
+def _take(block: np.ndarray, idx: np.ndarray, scale: float) -> np.ndarray:
+    flat = np.arange(len(idx)) * block.shape[1] + idx
+    taken = block.ravel()[flat].astype(np.float64)
+    return taken / scale if scale != 1.0 else taken
+
+
+def rolling_median(
+    values,
+    window: int,
+    min_periods: int,
+    starts: np.ndarray | None = None,
+    chunk_rows: int = DEFAULT_CHUNK_ROWS,
+) -> np.ndarray:
+    """
+    Trailing-window median, equal to pandas `rolling(window, min_periods).median()`
+    (applied per group when `starts` is given). Windows are sorted in
+    compact keys (see _sort_keys) in chunks of `chunk_rows` rows.
+    """
+    values = _as_values(values)
+    out = np.full(len(values), np.nan)
+    counts = _window_counts(values, window, starts)
+    keys, scale, pad = _sort_keys(values)
+
+    for lo, hi, block in _window_blocks(keys, window, starts, pad, chunk_rows):
+        nobs = counts[lo:hi]
+        valid = nobs >= max(min_periods, 1)
+        n = np.maximum(nobs, 1)
+        lower = _take(block, (n - 1) // 2, scale)
+        upper = _take(block, n // 2, scale)
+        out[lo:hi] = np.where(valid, np.where(n % 2 == 1, lower, (lower + upper) / 2), np.nan)
+
+    return out
+
+
+def rolling_quantiles(
+    values,
+    quantiles: Sequence[float],
+    window: int,
+    min_periods: int,
+    starts: np.ndarray | None = None,
+    chunk_rows: int = DEFAULT_CHUNK_ROWS,
+) -> Tuple[np.ndarray, ...]:
+    """
+    Trailing-window quantiles with linear interpolation, equal to pandas
+    `rolling(window, min_periods).quantile(q)`. All quantiles share one sort.
+    """
+    values = _as_values(values)
+    outs = tuple(np.full(len(values), np.nan) for _ in quantiles)
+    counts = _window_counts(values, window, starts)
+    keys, scale, pad = _sort_keys(values)
+
+    for lo, hi, block in _window_blocks(keys, window, starts, pad, chunk_rows):
+        nobs = counts[lo:hi]
+        valid = nobs >= max(min_periods, 1)
+        n = np.maximum(nobs, 1)
+        for q, out in zip(quantiles, outs):
+            pos = q * (n - 1)
+            idx = pos.astype(np.int64)
+            frac = pos - idx
+            vlow = _take(block, idx, scale)
+            vhigh = _take(block, np.minimum(idx + 1, n - 1), scale)
+            res = np.where(frac == 0, vlow, vlow + (vhigh - vlow) * frac)
+            out[lo:hi] = np.where(valid, res, np.nan)
+
+    return outs
+
+
+def rolling_mad(
+    values,
+    window: int,
+    min_periods: int,
+    starts: np.ndarray | None = None,
+    chunk_rows: int = DEFAULT_CHUNK_ROWS,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Return (rolling_median, rolling median absolute deviation), where the
+    deviation of each row is taken from its own rolling median, as in the
+    spike detector.
+    """
+    values = _as_values(values)
+    med = rolling_median(values, window, min_periods, starts, chunk_rows)
+    mad = rolling_median(np.abs(values - med), window, min_periods, starts, chunk_rows)
+    return med, mad
+
+
+def rolling_mean_std(
+    values,
+    window: int,
+    min_periods: int,
+    starts: np.ndarray | None = None,
+    chunk_rows: int = DEFAULT_CHUNK_ROWS,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Trailing-window mean and sample std (ddof=1), computed two-pass inside
+    each window in float64. Unlike a streaming add/remove accumulator, the
+    result depends only on the window's own values: constant windows give
+    exactly their value and a std of 0, wherever the series starts.
+    """
+    values = _as_values(values).astype(np.float64)
+    mean_out = np.full(len(values), np.nan)
+    std_out = np.full(len(values), np.nan)
+    counts = _window_counts(values, window, starts)
+
+    n_total = len(values)
+    padded = np.concatenate([np.full(window - 1, np.nan), values])
+    view = sliding_window_view(padded, window)
+    positions = np.arange(window)
+
+    for lo in range(0, n_total, chunk_rows):
+        hi = min(lo + chunk_rows, n_total)
+        block = view[lo:hi].copy()
+        if starts is not None:
+            offset = starts[lo:hi] - (np.arange(lo, hi) - window + 1)
+            if (offset > 0).any():
+                block[positions[None, :] < offset[:, None]] = np.nan
+        nobs = counts[lo:hi]
+        valid = nobs >= max(min_periods, 1)
+        n = np.maximum(nobs, 1)
+        mean = np.nansum(block, axis=1) / n
+        sq = np.nansum((block - mean[:, None]) ** 2, axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            std = np.sqrt(sq / (n - 1))
+        mean_out[lo:hi] = np.where(valid, mean, np.nan)
+        std_out[lo:hi] = np.where(valid & (n > 1), std, np.nan)
+
+    return mean_out, std_out
+
+
+def run_length(mask, starts: np.ndarray | None = None) -> np.ndarray:
+    """
+    Length of the run of consecutive True values ending at each row (0 where
+    mask is False). Runs restart at group starts. `run_length(m) >= w` equals
+    `rolling(w, min_periods=w).sum() >= w` on a boolean series.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    idx = np.arange(len(mask))
+    reset = np.where(~mask, idx + 1, 0)
+    if starts is not None:
+        reset = np.maximum(reset, starts)
+    last_reset = np.maximum.accumulate(reset) if len(mask) else reset
+    return np.where(mask, idx - last_reset + 1, 0)
+
+
+def group_ends(codes: np.ndarray) -> np.ndarray:
+    """Index of the last row of each row's group, for rows sorted by group code."""
+    n = len(codes)
+    last = np.ones(n, dtype=bool)
+    if n > 1:
+        last[:-1] = codes[1:] != codes[:-1]
+    return np.minimum.accumulate(np.where(last, np.arange(n), n)[::-1])[::-1]
+
+
+def interpolate_linear(values, limit: int, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """
+    Group-wise linear interpolation over row positions, equal to pandas
+    `interpolate(method="linear", limit=limit, limit_direction="both")`
+    on each group: a NaN is filled when an observation of its group lies
+    at most `limit` rows before or after it. Leading/trailing NaNs take the
+    nearest observation, as np.interp does.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    n = len(values)
+    idx = np.arange(n)
+    valid = ~np.isnan(values)
+
+    prev = np.maximum.accumulate(np.where(valid, idx, -1)) if n else idx
+    nxt = np.minimum.accumulate(np.where(valid, idx, n)[::-1])[::-1] if n else idx
+    has_prev = prev >= starts
+    has_next = nxt <= ends
+
+    fill = ~valid & ((has_prev & (idx - prev <= limit)) | (has_next & (nxt - idx <= limit)))
+    p = np.where(has_prev, prev, 0)
+    q = np.where(has_next, nxt, 0)
+
+    out = values.copy()
+    both = fill & has_prev & has_next
+    # np.interp: slope * (x - xp[j]) + fp[j]
+    slope = (values[q[both]] - values[p[both]]) / (q[both] - p[both]).astype(np.float64)
+    out[both] = slope * (idx[both] - p[both]).astype(np.float64) + values[p[both]]
+    only_prev = fill & has_prev & ~has_next
+    out[only_prev] = values[p[only_prev]]
+    only_next = fill & ~has_prev & has_next
+    out[only_next] = values[q[only_next]]
+    return out
+
+
+def rolling_median_centered(
+    values,
+    window: int,
+    min_periods: int,
+    codes: np.ndarray,
+    chunk_rows: int = DEFAULT_CHUNK_ROWS,
+) -> np.ndarray:
+    """
+    Centered rolling median per group, equal to pandas
+    `rolling(window, center=True, min_periods=min_periods).median()` on each
+    group. Every group is followed by `(window - 1) // 2` NaN slots so the
+    trailing kernel evaluated at row + offset sees exactly the centered window.
+    """
+    values = _as_values(values)
+    offset = (window - 1) // 2
+    first, _ = group_bounds(codes)
+    gid = np.cumsum(first) - 1
+    lengths = np.bincount(gid) if len(gid) else np.zeros(0, dtype=np.int64)
+
+    pos = np.arange(len(values)) + gid * offset
+    padded = np.full(len(values) + len(lengths) * offset, np.nan, dtype=values.dtype)
+    padded[pos] = values
+    _, padded_starts = group_bounds(np.repeat(np.arange(len(lengths)), lengths + offset))
+
+    trailing = rolling_median(padded, window, min_periods, padded_starts, chunk_rows)
+    return trailing[pos + offset]
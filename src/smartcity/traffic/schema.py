@@ -0,0 +1,243 @@
+"""
+Compact schema of the cleaned pre-fusion output.
+
+The wide schema keeps every flag as its own integer column and the labels
+as object strings. The compact schema stores:
+
+- `flags`: uint16 bitmask, bit i set <=> FLAG_BITS[i] == 1
+- `sensor_id`: pandas categorical (dictionary-encoded in Parquet)
+- measures as float32
+- no avg_dwell / count_clean / dwell_clean: they are exact functions of
+  the raw measures and the flag bits and are restored by restore_derived()
+- no missing_reason / confidence when they equal the labels the flag bits
+  assign (REASON_FLAGS, first match in MISSING_REASON_PRIORITY, then
+  CONFIDENCE_MAP), which holds for every cleaning output; restore_derived()
+  rebuilds them as categoricals. Other frames keep them as categoricals.
+
+Compact Parquet files are written with zstd, byte-stream-split floats and
+delta-encoded timestamps (compact_parquet_options).
+
+Bit positions (never reorder, only append):
+
+    0 phys_flag          7 spike_flag
+    1 logic_flag         8 cliff_flag
+    2 cap_flag           9 profile_flag_soft
+    3 cap_suspicious    10 profile_flag_hard
+    4 zero_run_soft     11 soft_flag
+    5 stuck_off         12 is_clean_observed
+    6 stuck_on          13 imputable
+"""
+
+from typing import Iterable, List
+
+import numpy as np
+import pandas as pd
+
+from smartcity.traffic.config import CONFIDENCE_LEVELS, CONFIDENCE_MAP, HARD_FLAGS, MISSING_REASON_PRIORITY, REASON_FLAGS
+
+
+FLAG_COLUMN = "flags"
+
+FLAG_BITS = [
+    "phys_flag",
+    "logic_flag",
+    "cap_flag",
+    "cap_suspicious",
+    "zero_run_soft",
+    "stuck_off",
+    "stuck_on",
+    "spike_flag",
+    "cliff_flag",
+    "profile_flag_soft",
+    "profile_flag_hard",
+    "soft_flag",
+    "is_clean_observed",
+    "imputable",
+]
+
+FLOAT32_COLUMNS = [
+    "count_raw",
+    "dwell_raw",
+    "avg_dwell",
+    "profile_z_count",
+    "profile_z_dwell",
+    "count_clean",
+    "dwell_clean",
+    "count_imputed",
+    "dwell_imputed",
+]
+
+DERIVED_COLUMNS = ["avg_dwell", "count_clean", "dwell_clean"]
+LABEL_COLUMNS = ["missing_reason", "confidence"]
+
+# confidence code per missing_reason code (position in MISSING_REASON_PRIORITY)
+REASON_CONFIDENCE = np.array(
+    [CONFIDENCE_LEVELS.index(CONFIDENCE_MAP[reason]) if reason in CONFIDENCE_MAP else -1 for reason in MISSING_REASON_PRIORITY],
+    dtype="int8",
+)
+
+
+def flag_bit(name: str) -> int:
+    if name not in FLAG_BITS:
+        raise ValueError(f"Unknown flag column: {name}")
+    return FLAG_BITS.index(name)
+
+
+def is_compact(columns: Iterable[str]) -> bool:
+    columns = set(columns)
+    return FLAG_COLUMN in columns and not (columns & set(FLAG_BITS))
+
+
+def pack_flags(df: pd.DataFrame) -> np.ndarray:
+    packed = np.zeros(len(df), dtype=np.uint16)
+    for bit, name in enumerate(FLAG_BITS):
+        if name in df.columns:
+            packed |= (df[name].to_numpy() != 0).astype(np.uint16) << np.uint16(bit)
+    return packed
+
+
+def unpack_flags(flags, names: List[str] | None = None) -> dict:
+    """Return {flag name: int8 array} for `names` (all flags by default)."""
+    flags = np.asarray(flags, dtype=np.uint16)
+    return {
+        name: ((flags >> np.uint16(flag_bit(name))) & 1).astype("int8")
+        for name in (names or FLAG_BITS)
+    }
+
+
+def reason_codes(flags: dict) -> np.ndarray:
+    """
+    missing_reason codes (positions in MISSING_REASON_PRIORITY) assigned by
+    the flag arrays in `flags` (name -> values): first match wins.
+    """
+    ranked = [(code, reason) for code, reason in enumerate(MISSING_REASON_PRIORITY) if reason in REASON_FLAGS]
+    return np.select(
+        [np.asarray(flags[REASON_FLAGS[reason]]) == 1 for _, reason in ranked],
+        [code for code, _ in ranked],
+        default=MISSING_REASON_PRIORITY.index("NONE"),
+    ).astype(np.int8)
+
+
+def flag_values(df: pd.DataFrame, name: str) -> np.ndarray:
+    """int8 values of flag `name` from a frame in either schema (missing -> 0)."""
+    if is_compact(df.columns):
+        return unpack_flags(df[FLAG_COLUMN], [name])[name]
+    return (df[name].fillna(0).to_numpy() == 1).astype("int8")
+
+
+def set_flag(df: pd.DataFrame, name: str, rows: np.ndarray) -> pd.DataFrame:
+    """Copy of `df` (either schema) with flag `name` set to 1 on `rows`."""
+    if is_compact(df.columns):
+        flags = df[FLAG_COLUMN].to_numpy(dtype=np.uint16, copy=True)
+        flags[rows] |= np.uint16(1 << flag_bit(name))
+        return df.assign(**{FLAG_COLUMN: flags})
+    values = flag_values(df, name).copy()
+    values[rows] = 1
+    return df.assign(**{name: values})
+
+
+def to_compact(df: pd.DataFrame) -> pd.DataFrame:
+    """Convert a wide cleaned (or imputed) frame to the compact schema."""
+    if is_compact(df.columns):
+        return df
+
+    drop = [c for c in FLAG_BITS if c in df.columns]
+    if set(HARD_FLAGS) <= set(drop) and {"count_raw", "dwell_raw"} <= set(df.columns):
+        drop += [c for c in DERIVED_COLUMNS if c in df.columns]
+    out = df.drop(columns=drop)
+    out[FLAG_COLUMN] = pack_flags(df)
+
+    if "missing_reason" in out.columns:
+        codes = reason_codes(unpack_flags(out[FLAG_COLUMN], list(set(REASON_FLAGS.values()))))
+        stored = pd.Categorical(out["missing_reason"], categories=MISSING_REASON_PRIORITY).codes
+        if np.array_equal(stored, codes):
+            labels = ["missing_reason"]
+            if "confidence" in out.columns and np.array_equal(
+                pd.Categorical(out["confidence"], categories=CONFIDENCE_LEVELS).codes, REASON_CONFIDENCE[codes]
+            ):
+                labels.append("confidence")
+            out = out.drop(columns=labels)
+
+    for col in FLOAT32_COLUMNS:
+        if col in out.columns:
+            out[col] = out[col].astype("float32")
+
+    out["sensor_id"] = pd.Categorical(out["sensor_id"], categories=sorted(out["sensor_id"].unique()))
+    if "missing_reason" in out.columns:
+        out["missing_reason"] = pd.Categorical(out["missing_reason"], categories=MISSING_REASON_PRIORITY)
+    if "confidence" in out.columns:
+        out["confidence"] = pd.Categorical(out["confidence"], categories=CONFIDENCE_LEVELS)
+    return out
+
+
+def restore_labels(df: pd.DataFrame) -> pd.DataFrame:
+    """Add the missing_reason / confidence a compact frame dropped, from its flag bitmask."""
+    if "missing_reason" in df.columns:
+        return df
+    codes = reason_codes(unpack_flags(df[FLAG_COLUMN], list(set(REASON_FLAGS.values()))))
+    out = df.assign(missing_reason=pd.Categorical.from_codes(codes, categories=MISSING_REASON_PRIORITY))
+    if "confidence" not in df.columns:
+        out["confidence"] = pd.Categorical.from_codes(REASON_CONFIDENCE[codes], categories=CONFIDENCE_LEVELS)
+    return out
+
+
+def restore_derived(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Add avg_dwell, count_clean and dwell_clean (and the dropped labels, see
+    restore_labels) to a compact frame, computed exactly as compute_flags
+    does. The flag bitmask stays packed. Frames projected without the raw
+    measures get only the labels.
+    """
+    if not is_compact(df.columns):
+        return df
+    df = restore_labels(df)
+    if "count_clean" in df.columns or not {"count_raw", "dwell_raw"} <= set(df.columns):
+        return df
+
+    count = df["count_raw"].to_numpy(dtype=np.float32)
+    dwell = df["dwell_raw"].to_numpy(dtype=np.float32)
+    hard = np.zeros(len(df), dtype=bool)
+    for values in unpack_flags(df[FLAG_COLUMN], HARD_FLAGS).values():
+        hard |= values == 1
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        avg_dwell = np.where(count > 0, dwell / np.maximum(count, np.float32(1.0)), np.nan).astype(np.float32)
+    count_clean = np.where(hard, np.nan, count).astype(np.float32)
+    dwell_clean = np.where(hard, np.nan, dwell).astype(np.float32)
+    dwell_clean[(count_clean == 0) & (dwell_clean > 0)] = 0.0
+
+    return df.assign(avg_dwell=avg_dwell, count_clean=count_clean, dwell_clean=dwell_clean)
+
+
+def to_wide(df: pd.DataFrame, names: List[str] | None = None) -> pd.DataFrame:
+    """
+    Expand the flag bitmask of a compact frame back into int8 columns and
+    restore the derived measures. Frames already in the wide schema are
+    returned unchanged.
+    """
+    if not is_compact(df.columns):
+        return df
+    out = restore_derived(df).drop(columns=[FLAG_COLUMN])
+    for name, values in unpack_flags(df[FLAG_COLUMN], names).items():
+        out[name] = values
+    return out
+
+
+def compact_parquet_options(df: pd.DataFrame) -> dict:
+    """pyarrow write options for a compact frame (keyword arguments of to_parquet)."""
+    encodings = {col: "BYTE_STREAM_SPLIT" for col in df.columns if df[col].dtype == np.float32}
+    if "timestamp" in df.columns:
+        encodings["timestamp"] = "DELTA_BINARY_PACKED"
+    encodings[FLAG_COLUMN] = "DELTA_BINARY_PACKED"
+    return {
+        "compression": "zstd",
+        "use_dictionary": [col for col in df.columns if isinstance(df[col].dtype, pd.CategoricalDtype)],
+        "column_encoding": encodings,
+    }
+
+
+def flag_sql(name: str, columns: Iterable[str]) -> str:
+    """DuckDB expression yielding 0/1 for flag `name` in either schema."""
+    if is_compact(columns):
+        return f"((COALESCE({FLAG_COLUMN}, 0) >> {flag_bit(name)}) & 1)::INTEGER"
+    return f"CASE WHEN COALESCE({name}, 0) IN (1, TRUE) THEN 1 ELSE 0 END"
@@ -0,0 +1,89 @@
+"""
+Persistent DuckDB traffic store.
+
+One DuckDB database file holds:
+
+- `traffic_minutes`: the minute rows aggregation reads (imputed traffic),
+  with a `source_file` column naming the input parquet file each row came
+  from, inserted ordered by (sensor_id, timestamp) per file
+- `traffic_agg_{freq}`: one materialised aggregate per frequency, with the
+  columns of run_traffic_aggregation, sorted by (sensor_id, timestamp) so
+  DuckDB's per-row-group min/max skip everything but the requested sensors
+  and time range. Refreshes append their recomputed rows as further
+  sorted runs; `traffic_store_sort` counts those rows per table, and a
+  table is re-sorted once they exceed SORT_SLACK of it
+- `traffic_store_files`: size, mtime and extent of every loaded input file,
+  which refresh_traffic_store (store_refresh.py) compares to update the
+  tables incrementally
+
+Readers attach the file read-only to their own connection
+(attach_traffic_store), so several can query it at once; traffic_source
+gives aggregation, validation and the ABox builder the same table
+expression whether they read the store or a parquet file.
+"""
+
+from pathlib import Path
+from typing import List, Tuple
+
+import duckdb
+
+
+MINUTE_TABLE = "traffic_minutes"
+FILES_TABLE = "traffic_store_files"
+SORT_TABLE = "traffic_store_sort"
+# share of out-of-order rows an aggregate table may hold before a re-sort
+SORT_SLACK = 0.25
+SOURCE_FILE_COLUMN = "source_file"
+STORE_ALIAS = "traffic_store"
+
+
+def aggregate_table(freq_label: str) -> str:
+    return f"traffic_agg_{freq_label.lower().strip()}"
+
+
+def store_tables(con: duckdb.DuckDBPyConnection, database: str | None = None) -> List[str]:
+    """Table names of the store open as `con`'s default database, or attached as `database`."""
+    where = f"database_name = '{database}'" if database else "database_name = current_database()"
+    return [row[0] for row in con.execute(f"SELECT table_name FROM duckdb_tables() WHERE {where}").fetchall()]
+
+
+def connect_traffic_store(store_path: str | Path, threads: int = 8) -> duckdb.DuckDBPyConnection:
+    """Read-write connection to the store file (created if missing)."""
+    store_path = Path(store_path)
+    store_path.parent.mkdir(parents=True, exist_ok=True)
+    con = duckdb.connect(database=str(store_path))
+    con.execute(f"PRAGMA threads={threads};")
+    return con
+
+
+def attach_traffic_store(con: duckdb.DuckDBPyConnection, store_path: str | Path, table: str) -> str:
+    """Attach the store read-only to `con` and return the qualified name of `table` in it."""
+    store_path = Path(store_path)
+    if not store_path.exists():
+        raise FileNotFoundError(f"Traffic store not found: {store_path}")
+
+    con.execute(f"ATTACH '{store_path.as_posix()}' AS {STORE_ALIAS} (READ_ONLY)")
+    if table not in store_tables(con, STORE_ALIAS):
+        raise ValueError(f"Table {table} not found in traffic store {store_path}. Run scripts/refresh_traffic_store.py first.")
+    return f"{STORE_ALIAS}.{table}"
+
+
+def traffic_source(
+    con: duckdb.DuckDBPyConnection,
+    input_path: str | Path | None,
+    store_path: str | Path | None = None,
+    table: str = MINUTE_TABLE,
+) -> Tuple[str, List[str]]:
+    """
+    Table expression and data columns to read: `table` of the store at
+    `store_path` if given, else the parquet file `input_path`.
+    """
+    if store_path is not None:
+        source = attach_traffic_store(con, store_path, table)
+    elif input_path is not None:
+        source = f"read_parquet('{Path(input_path).as_posix()}')"
+    else:
+        raise ValueError("Either an input parquet file or a traffic store is required.")
+
+    columns = [row[0] for row in con.execute(f"DESCRIBE SELECT * FROM {source}").fetchall()]
+    return source, [c for c in columns if c != SOURCE_FILE_COLUMN]
@@ -0,0 +1,238 @@
+"""
+Incremental refresh of the persistent DuckDB traffic store (store.py).
+
+A refresh compares the input parquet files with `traffic_store_files`,
+like the incremental Parquet aggregation does with its state file. Rows of
+new, modified or removed files are deleted from / inserted into
+`traffic_minutes` by `source_file`. The affected sensor x bucket cells
+(old and new extents of those files, widened to whole buckets of every
+stored frequency) are then recomputed from the minute table with the
+cascade of aggregation.py and replaced in each `traffic_agg_{freq}`
+table. The replacement rows are appended as one sorted run; the table is
+only rewritten in (sensor_id, timestamp) order when the appended runs that
+break the order add up to more than SORT_SLACK of its rows.
+
+Frequencies asked for the first time are built in full from the minute
+table. The whole refresh is one transaction, so an interrupted run leaves
+the previous store intact.
+"""
+
+from pathlib import Path
+from typing import Dict, List
+
+import duckdb
+
+from smartcity.traffic.aggregation import cascade_output_sql, create_cascade_tables, frequency_to_label, frequency_to_seconds
+from smartcity.traffic.incremental_aggregation import (
+    bucket_intervals,
+    file_extent,
+    file_signature,
+    in_intervals_sql,
+    in_sensors_sql,
+    input_files,
+)
+from smartcity.traffic.store import (
+    FILES_TABLE,
+    MINUTE_TABLE,
+    SORT_SLACK,
+    SORT_TABLE,
+    SOURCE_FILE_COLUMN,
+    aggregate_table,
+    connect_traffic_store,
+    store_tables,
+)
+
+
+def load_store_files(con: duckdb.DuckDBPyConnection) -> Dict[str, dict]:
+    con.execute(f"""
+    CREATE TABLE IF NOT EXISTS {FILES_TABLE} (
+      path VARCHAR PRIMARY KEY,
+      size BIGINT,
+      mtime_ns BIGINT,
+      first BIGINT,
+      last BIGINT,
+      sensors VARCHAR[]
+    )
+    """)
+    rows = con.execute(f"SELECT path, size, mtime_ns, first, last, sensors FROM {FILES_TABLE}").fetchall()
+    return {
+        path: {"size": size, "mtime_ns": mtime_ns, "first": first, "last": last, "sensors": sensors}
+        for path, size, mtime_ns, first, last, sensors in rows
+    }
+
+
+def load_unsorted_rows(con: duckdb.DuckDBPyConnection) -> Dict[str, int]:
+    """Rows appended out of (sensor_id, timestamp) order per aggregate table since its last sort."""
+    con.execute(f"CREATE TABLE IF NOT EXISTS {SORT_TABLE} (table_name VARCHAR PRIMARY KEY, unsorted_rows BIGINT)")
+    return dict(con.execute(f"SELECT table_name, unsorted_rows FROM {SORT_TABLE}").fetchall())
+
+
+def save_unsorted_rows(con: duckdb.DuckDBPyConnection, table: str, rows: int) -> None:
+    load_unsorted_rows(con)
+    con.execute(f"DELETE FROM {SORT_TABLE} WHERE table_name = ?", [table])
+    con.execute(f"INSERT INTO {SORT_TABLE} VALUES (?, ?)", [table, rows])
+
+
+def stored_freqs(con: duckdb.DuckDBPyConnection) -> List[str]:
+    prefix = aggregate_table("")
+    return sorted(
+        (t[len(prefix):] for t in store_tables(con) if t.startswith(prefix)),
+        key=frequency_to_seconds,
+    )
+
+
+def replace_minute_rows(con: duckdb.DuckDBPyConnection, rel: str, path: Path | None) -> None:
+    """Drop the rows of input file `rel` and, if it still exists, load it again."""
+    quoted = rel.replace("'", "''")
+    if MINUTE_TABLE in store_tables(con):
+        con.execute(f"DELETE FROM {MINUTE_TABLE} WHERE {SOURCE_FILE_COLUMN} = '{quoted}'")
+    if path is None:
+        return
+
+    select = f"""
+    SELECT *, '{quoted}' AS {SOURCE_FILE_COLUMN}
+    FROM read_parquet('{path.as_posix()}', hive_partitioning = false)
+    ORDER BY sensor_id, timestamp
+    """
+    if MINUTE_TABLE in store_tables(con):
+        con.execute(f"INSERT INTO {MINUTE_TABLE} BY NAME {select}")
+    else:
+        con.execute(f"CREATE TABLE {MINUTE_TABLE} AS {select}")
+
+
+def minute_columns(con: duckdb.DuckDBPyConnection) -> List[str]:
+    columns = [row[0] for row in con.execute(f"DESCRIBE {MINUTE_TABLE}").fetchall()]
+    return [c for c in columns if c != SOURCE_FILE_COLUMN]
+
+
+def build_aggregates(con: duckdb.DuckDBPyConnection, freqs: List[str]) -> None:
+    """Create `traffic_agg_{freq}` for `freqs` from the whole minute table."""
+    create_cascade_tables(con, MINUTE_TABLE, minute_columns(con), freqs)
+    for freq in freqs:
+        level, label = frequency_to_seconds(freq), frequency_to_label(freq)
+        con.execute(f"""
+        CREATE OR REPLACE TABLE {aggregate_table(label)} AS
+        {cascade_output_sql(f'cells_{level}', level, label)}
+        ORDER BY sensor_id, timestamp
+        """)
+        save_unsorted_rows(con, aggregate_table(label), 0)
+
+
+def update_aggregates(con: duckdb.DuckDBPyConnection, freqs: List[str], touched: List[dict]) -> None:
+    """Recompute the sensor x bucket cells of `touched` extents in the `traffic_agg_{freq}` tables."""
+    # whole affected buckets per frequency; the minute scan covers their union
+    sensors = sorted({s for e in touched for s in e["sensors"]})
+    intervals = {freq: bucket_intervals(touched, frequency_to_seconds(freq)) for freq in freqs}
+    widest = bucket_intervals([{"first": lo, "last": hi - 1} for iv in intervals.values() for lo, hi in iv], 1)
+    if not sensors or not widest:
+        return
+
+    where = f" AND {in_sensors_sql('sensor_id', sensors)} AND {in_intervals_sql('CAST(timestamp AS TIMESTAMPTZ)', widest)}"
+    create_cascade_tables(con, MINUTE_TABLE, minute_columns(con), freqs, where)
+
+    unsorted = load_unsorted_rows(con)
+    for freq in freqs:
+        level, label = frequency_to_seconds(freq), frequency_to_label(freq)
+        table = aggregate_table(label)
+        con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE fresh AS
+        SELECT * FROM ({cascade_output_sql(f'cells_{level}', level, label)})
+        WHERE {in_intervals_sql('timestamp', intervals[freq])}
+        ORDER BY sensor_id, timestamp
+        """)
+        stale = f"{in_sensors_sql('sensor_id', sensors)} AND {in_intervals_sql('timestamp', intervals[freq])}"
+        con.execute(f"DELETE FROM {table} WHERE {stale}")
+
+        # the appended run keeps the table sorted only if no kept row sorts after its first row
+        n_fresh = con.execute("SELECT COUNT(*) FROM fresh").fetchone()[0]
+        out_of_order = con.execute(f"""
+        SELECT EXISTS (
+          SELECT 1
+          FROM {table} t, (SELECT sensor_id, timestamp FROM fresh ORDER BY sensor_id, timestamp LIMIT 1) f
+          WHERE t.sensor_id > f.sensor_id OR (t.sensor_id = f.sensor_id AND t.timestamp > f.timestamp)
+        )
+        """).fetchone()[0]
+        con.execute(f"INSERT INTO {table} SELECT * FROM fresh")
+
+        n_unsorted = unsorted.get(table, 0) + (n_fresh if out_of_order else 0)
+        if n_unsorted > SORT_SLACK * con.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]:
+            con.execute(f"CREATE OR REPLACE TABLE {table} AS SELECT * FROM {table} ORDER BY sensor_id, timestamp")
+            n_unsorted = 0
+        save_unsorted_rows(con, table, n_unsorted)
+
+
+def refresh_traffic_store(
+    store_path: str | Path,
+    input_path: str | Path,
+    freqs: List[str] | None = None,
+    threads: int = 8,
+) -> Path:
+    """
+    Bring the store at `store_path` up to date with the minute data in
+    `input_path` (a parquet file or dataset folder) and materialise the
+    aggregates of `freqs` in addition to the ones already stored.
+    """
+    store_path = Path(store_path)
+    input_path = Path(input_path)
+
+    if not input_path.exists():
+        raise FileNotFoundError(f"Input file not found: {input_path}")
+
+    con = connect_traffic_store(store_path, threads=threads)
+    con.begin()
+    try:
+        old_files = load_store_files(con)
+        existing = stored_freqs(con)
+        new_freqs = [f for f in dict.fromkeys(frequency_to_label(f) for f in freqs or []) if f not in existing]
+
+        files = input_files(input_path)
+        touched: List[dict] = []
+        changed = 0
+        for rel, path in files.items():
+            signature = file_signature(path)
+            old = old_files.get(rel)
+            if old is not None and all(old[k] == signature[k] for k in signature):
+                continue
+            entry = dict(signature, **file_extent(con, path))
+            replace_minute_rows(con, rel, path)
+            con.execute(f"DELETE FROM {FILES_TABLE} WHERE path = ?", [rel])
+            con.execute(
+                f"INSERT INTO {FILES_TABLE} VALUES (?, ?, ?, ?, ?, ?)",
+                [rel, entry["size"], entry["mtime_ns"], entry["first"], entry["last"], entry["sensors"]],
+            )
+            touched.append(entry)
+            changed += 1
+            if old is not None:
+                touched.append(old)
+
+        removed = [rel for rel in old_files if rel not in files]
+        for rel in removed:
+            replace_minute_rows(con, rel, None)
+            con.execute(f"DELETE FROM {FILES_TABLE} WHERE path = ?", [rel])
+            touched.append(old_files[rel])
+
+        if MINUTE_TABLE not in store_tables(con):
+            raise RuntimeError(f"No minute data loaded into the traffic store from {input_path}")
+
+        if existing and touched:
+            update_aggregates(con, existing, touched)
+        if new_freqs:
+            build_aggregates(con, new_freqs)
+        con.commit()
+    except Exception:
+        con.rollback()
+        con.close()
+        raise
+
+    minute_rows = con.execute(f"SELECT COUNT(*) FROM {MINUTE_TABLE}").fetchone()[0]
+    con.close()
+
+    print("Traffic store refresh finished.")
+    print(f"Store: {store_path}")
+    print(f"Input: {input_path}")
+    print(f"New or modified input files: {changed}, removed: {len(removed)}")
+    print(f"Minute rows: {minute_rows}")
+    print(f"Updated aggregates: {', '.join(existing if touched else []) or 'none'}")
+    print(f"Built aggregates: {', '.join(new_freqs) or 'none'}")
+
+    return store_path
@@ -0,0 +1,474 @@
+"""
+Monte-Carlo validation of the layered traffic imputation.
+
+Every trial hides randomized gaps in clean observed minutes (missing_reason
+NONE) of every sensor, labels them with one layer's missing reason, runs
+the imputation layers over all sensors and scores the filled values
+against the hidden truth. Trials cycle over the layers (ZERO_RUN_SHORT,
+SPIKE, PROFILE_SOFT) and are independent, so they run in a process pool
+over shared memory; trial t always uses the same random gaps whatever
+`workers` is.
+
+With lane metadata and/or an ML model, LANE_FUSION and ML are scored as
+further layers: their trials hide clean observed minutes of the layered
+output (loop sensors of a loop/video pair, sensors with a model) and fill
+them with apply_lane_fusion / apply_ml_models. Scales and models are
+learned on a training window only (default: the first TRAIN_SHARE of the
+time range) and these gaps are hidden outside it, so no hidden value is
+trained on. Scales and models are cached as in run_traffic_imputation.
+These trials run in the main process, after the in-engine ones.
+
+Gaps are placed one per slot: the rows of a sensor are split into
+`gaps_per_sensor` equal slots and each gap lies strictly inside its slot,
+so gaps never overlap or touch. PROFILE_SOFT trials rebuild the profile
+medians without their hidden rows (cell_quantiles, float32 medians as in
+the profile store), so the hidden truth never enters the profile it is
+filled from.
+
+Errors are summed per (layer, key) with bincount and reported as MAE,
+RMSE and bias (imputed - true) for count and dwell, plus the share of
+hidden minutes that got a value, per layer, gap length, sensor and hour of
+day.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from smartcity.imputation.lane_fusion import (
+    LANE_FUSION_METHOD,
+    apply_lane_fusion,
+    build_lane_pairs,
+    load_lane_metadata,
+    load_or_learn_scales,
+    training_window,
+)
+from smartcity.imputation.models import ModelRegistry, apply_ml_models, train_sensor_models
+from smartcity.imputation.shared import BlockSpecs, attach_arrays, release_blocks, share_arrays
+from smartcity.imputation.traffic_imputation import LAYER_REASONS, IMPUTE_METHODS, impute_layers, load_clean_traffic, prepare_layers
+from smartcity.traffic.cleaning import utc_timestamp
+from smartcity.traffic.profiles import cell_quantiles
+from smartcity.traffic.rolling import group_bounds
+from smartcity.traffic.schema import set_flag
+
+
+GAP_LENGTHS = {
+    "ZERO_RUN_SHORT": (1, 5),
+    "SPIKE": (1, 2),
+    "PROFILE_SOFT": (1, 30),
+    "LANE_FUSION": (1, 30),
+    "ML": (1, 30),
+}
+
+# share of the time range the lane scales and ML models are learned on by default
+TRAIN_SHARE = 0.7
+
+STATS = [
+    "hidden",
+    "count_n", "count_err", "count_abs", "count_sq",
+    "dwell_n", "dwell_err", "dwell_abs", "dwell_sq",
+]
+
+LAYER_INPUTS = ["count", "dwell", "reason", "codes", "cells", "profile_count", "profile_dwell"]
+
+
+def inject_gaps(
+    codes: np.ndarray,
+    eligible: np.ndarray,
+    gaps_per_sensor: int,
+    min_len: int,
+    max_len: int,
+    rng: np.random.Generator,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Random gap rows for all sensors at once (rows sorted by sensor code).
+    Returns (row index, gap length) of the hidden rows that are `eligible`.
+    """
+    first, _ = group_bounds(codes)
+    starts = np.flatnonzero(first)
+    sizes = np.diff(np.append(starts, len(codes)))
+
+    per_sensor = np.minimum(gaps_per_sensor, sizes // (max_len + 2))
+    slot = np.where(per_sensor > 0, sizes // np.maximum(per_sensor, 1), 0)
+    n_gaps = int(per_sensor.sum())
+    if n_gaps == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    sensor = np.repeat(np.arange(len(starts)), per_sensor)
+    slot_no = np.arange(n_gaps) - np.repeat(np.cumsum(per_sensor) - per_sensor, per_sensor)
+    length = rng.integers(min_len, max_len + 1, n_gaps)
+    # one free row before and after the gap inside its slot
+    offset = 1 + (rng.random(n_gaps) * (slot[sensor] - length - 1)).astype(np.int64)
+    gap_start = starts[sensor] + slot_no * slot[sensor] + offset
+
+    within = np.arange(int(length.sum())) - np.repeat(np.cumsum(length) - length, length)
+    rows = np.repeat(gap_start, length) + within
+    row_len = np.repeat(length, length)
+    keep = eligible[rows]
+    return rows[keep], row_len[keep]
+
+
+def accumulate(key: np.ndarray, size: int, count_err: np.ndarray, dwell_err: np.ndarray) -> np.ndarray:
+    """STATS x size sums of the errors of hidden rows grouped by `key` (NaN error = not filled)."""
+    out = np.zeros((len(STATS), size))
+    out[0] = np.bincount(key, minlength=size)
+    for i, err in ((1, count_err), (5, dwell_err)):
+        ok = ~np.isnan(err)
+        k, e = key[ok], err[ok]
+        out[i] = np.bincount(k, minlength=size)
+        out[i + 1] = np.bincount(k, weights=e, minlength=size)
+        out[i + 2] = np.bincount(k, weights=np.abs(e), minlength=size)
+        out[i + 3] = np.bincount(k, weights=e * e, minlength=size)
+    return out
+
+
+def evaluate_trial(
+    arrays: dict,
+    trial: int,
+    seed: int,
+    gaps_per_sensor: int,
+    n_sensors: int,
+    max_gap: int,
+    n_layers: int,
+) -> Dict[str, np.ndarray]:
+    """Hide one in-engine trial's gaps, run the layers and return its error sums per breakdown."""
+    layer = trial % n_layers
+    min_len, max_len = GAP_LENGTHS[LAYER_REASONS[layer]]
+    rng = np.random.default_rng([seed, trial])
+    rows, gap_len = inject_gaps(arrays["codes"], arrays["truth"], gaps_per_sensor, min_len, max_len, rng)
+
+    layer_arrays = {name: arrays[name] for name in LAYER_INPUTS}
+    layer_arrays["count"] = arrays["count"].copy()
+    layer_arrays["dwell"] = arrays["dwell"].copy()
+    layer_arrays["reason"] = arrays["reason"].copy()
+    layer_arrays["count"][rows] = np.nan
+    layer_arrays["dwell"][rows] = np.nan
+    layer_arrays["reason"][rows] = layer + 1
+    if LAYER_REASONS[layer] == "PROFILE_SOFT":
+        keep = arrays["profile_rows"].copy()
+        keep[rows] = False
+        n_cells = len(arrays["profile_count"])
+        for stat, values in (("profile_count", arrays["count"]), ("profile_dwell", arrays["dwell"])):
+            median = cell_quantiles(arrays["cells"][keep], values[keep], n_cells, [0.5])[0.5]
+            layer_arrays[stat] = median.astype(np.float64)
+    impute_layers(**layer_arrays)
+
+    count_err = layer_arrays["count"][rows] - arrays["count"][rows]
+    dwell_err = layer_arrays["dwell"][rows] - arrays["dwell"][rows]
+    return trial_stats(arrays, layer, rows, gap_len, count_err, dwell_err, n_sensors, max_gap, n_layers)
+
+
+def evaluate_frame_trial(
+    base: pd.DataFrame,
+    arrays: dict,
+    frame_layer: dict,
+    trial: int,
+    seed: int,
+    gaps_per_sensor: int,
+    n_sensors: int,
+    max_gap: int,
+    n_layers: int,
+) -> Dict[str, np.ndarray]:
+    """Hide one LANE_FUSION / ML trial's gaps in the layered output `base`, fill them and return the error sums."""
+    layer = trial % n_layers
+    min_len, max_len = GAP_LENGTHS[frame_layer["name"]]
+    rng = np.random.default_rng([seed, trial])
+    rows, gap_len = inject_gaps(arrays["codes"], frame_layer["eligible"], gaps_per_sensor, min_len, max_len, rng)
+
+    count = base["count_imputed"].to_numpy(dtype=np.float64, copy=True)
+    dwell = base["dwell_imputed"].to_numpy(dtype=np.float64, copy=True)
+    count[rows] = np.nan
+    dwell[rows] = np.nan
+    # hidden rows stand in for imputable gaps, so the fill may touch them
+    hidden = set_flag(base.assign(count_imputed=count, dwell_imputed=dwell), "imputable", rows)
+    out = frame_layer["fill"](hidden)
+
+    count_err = out["count_imputed"].to_numpy(dtype=np.float64)[rows] - arrays["count"][rows]
+    dwell_err = out["dwell_imputed"].to_numpy(dtype=np.float64)[rows] - arrays["dwell"][rows]
+    return trial_stats(arrays, layer, rows, gap_len, count_err, dwell_err, n_sensors, max_gap, n_layers)
+
+
+def trial_stats(
+    arrays: dict,
+    layer: int,
+    rows: np.ndarray,
+    gap_len: np.ndarray,
+    count_err: np.ndarray,
+    dwell_err: np.ndarray,
+    n_sensors: int,
+    max_gap: int,
+    n_layers: int,
+) -> Dict[str, np.ndarray]:
+    """Error sums of one trial's hidden `rows` per breakdown."""
+    sensor = arrays["codes"][rows]
+    hour = arrays["hour"][rows]
+    offset = layer * np.ones(len(rows), dtype=np.int64)
+    return {
+        "layer": accumulate(offset, n_layers, count_err, dwell_err),
+        "gap_length": accumulate(offset * max_gap + gap_len - 1, n_layers * max_gap, count_err, dwell_err),
+        "sensor": accumulate(offset * n_sensors + sensor, n_layers * n_sensors, count_err, dwell_err),
+        "hour": accumulate(offset * 24 + hour, n_layers * 24, count_err, dwell_err),
+    }
+
+
+def trial_worker(specs: BlockSpecs, trials: List[int], *args) -> Dict[str, np.ndarray]:
+    """Worker: run `trials` on the shared arrays and return their summed errors."""
+    arrays, blocks = attach_arrays(specs)
+    try:
+        return sum_results(evaluate_trial(arrays, t, *args) for t in trials)
+    finally:
+        del arrays
+        release_blocks(blocks, unlink=False)
+
+
+def sum_results(results) -> Dict[str, np.ndarray]:
+    total: Dict[str, np.ndarray] = {}
+    for result in results:
+        for name, stats in result.items():
+            total[name] = total[name] + stats if name in total else stats
+    return total
+
+
+def metrics_table(stats: np.ndarray, keys: pd.DataFrame) -> pd.DataFrame:
+    """MAE / RMSE / bias / filled rate per row of `keys` from STATS sums."""
+    s = dict(zip(STATS, stats))
+    out = keys.copy()
+    out["hidden_minutes"] = s["hidden"].astype(np.int64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        out["filled_rate"] = s["count_n"] / s["hidden"]
+        for var in ["count", "dwell"]:
+            n = s[f"{var}_n"]
+            out[f"{var}_mae"] = s[f"{var}_abs"] / n
+            out[f"{var}_rmse"] = np.sqrt(s[f"{var}_sq"] / n)
+            out[f"{var}_bias"] = s[f"{var}_err"] / n
+    return out[out["hidden_minutes"] > 0].reset_index(drop=True)
+
+
+def layer_keys(layers: pd.DataFrame, values, name: str) -> pd.DataFrame:
+    """(layer, method, `name`) for every layer x value, in accumulate's key order."""
+    values = np.asarray(values)
+    n = len(values)
+    return pd.DataFrame({
+        "layer": np.repeat(layers["layer"].to_numpy(), n),
+        "impute_method": np.repeat(layers["impute_method"].to_numpy(), n),
+        name: np.tile(values, len(layers)),
+    })
+
+
+def train_window(df: pd.DataFrame, train_start=None, train_end=None) -> Tuple[str, str]:
+    """Training window of the lane scales and ML models: explicit bounds, else the first TRAIN_SHARE of the data."""
+    if train_end is None:
+        ts = pd.to_datetime(df["timestamp"], errors="coerce", utc=True)
+        first = utc_timestamp(train_start) if train_start is not None else ts.min()
+        train_end = (first + (ts.max() - first) * TRAIN_SHARE).floor("min")
+    return training_window(df, train_start, train_end)
+
+
+def frame_layers(
+    base: pd.DataFrame,
+    held_out: np.ndarray,
+    train_start: str,
+    train_end: str,
+    lane_metadata: str | Path | None = None,
+    scale_cache_dir: str | Path | None = None,
+    ml_model: str | None = None,
+    ml_model_dir: str | Path | None = None,
+    intersection_id: str | None = None,
+    workers: int = 1,
+) -> List[dict]:
+    """
+    The LANE_FUSION and ML layers to score on the layered output `base`:
+    name, impute_method, the rows their gaps may hide (`held_out` rows of
+    the sensors they fill) and the fill function. Scales and models are
+    learned on [train_start, train_end).
+    """
+    sensors = base["sensor_id"].astype(str)
+    layers = []
+
+    if lane_metadata is not None:
+        if scale_cache_dir is None:
+            raise ValueError("scale_cache_dir is required to validate lane fusion.")
+        pairs = build_lane_pairs(load_lane_metadata(lane_metadata))
+        if pairs.empty:
+            print("No loop/video pairs on shared lanes; lane fusion not validated.")
+        else:
+            scales = load_or_learn_scales(base, pairs, scale_cache_dir, train_start=train_start, train_end=train_end)
+            layers.append({
+                "name": "LANE_FUSION",
+                "method": LANE_FUSION_METHOD,
+                "eligible": held_out & sensors.isin(set(pairs["loop_sensor_id"])).to_numpy(),
+                "fill": partial(apply_lane_fusion, pairs=pairs, scales=scales),
+            })
+
+    if ml_model is not None:
+        if ml_model_dir is None or intersection_id is None:
+            raise ValueError("ml_model_dir and intersection_id are required to validate the ML layer.")
+        registry = ModelRegistry(ml_model_dir)
+        keys = train_sensor_models(
+            base, registry, intersection_id, model_name=ml_model,
+            train_start=train_start, train_end=train_end, workers=workers,
+        )
+        layers.append({
+            "name": "ML",
+            "method": f"ML_{ml_model.upper()}",
+            "eligible": held_out & sensors.isin(set(keys)).to_numpy(),
+            "fill": partial(apply_ml_models, registry=registry, keys=keys),
+        })
+
+    return layers
+
+
+def validate_imputation(
+    df: pd.DataFrame,
+    n_trials: int = 30,
+    gaps_per_sensor: int = 100,
+    workers: int = 1,
+    seed: int = 42,
+    lane_metadata: str | Path | None = None,
+    scale_cache_dir: str | Path | None = None,
+    ml_model: str | None = None,
+    ml_model_dir: str | Path | None = None,
+    intersection_id: str | None = None,
+    train_start=None,
+    train_end=None,
+) -> Dict[str, pd.DataFrame]:
+    """
+    Run `n_trials` gap-injection trials on cleaned traffic and return the
+    metric tables "by_layer", "by_gap_length", "by_sensor" and "by_hour".
+    With `lane_metadata` or `ml_model`, the trials also cycle over the
+    LANE_FUSION / ML layers, trained on [train_start, train_end).
+    """
+    df, arrays = prepare_layers(df)
+    _, sensor_ids = pd.factorize(df["sensor_id"])
+    ts = pd.to_datetime(df["timestamp"], errors="coerce", utc=True)
+
+    # rows the profile medians are built from, and the hidden rows' truth:
+    # clean observed minutes
+    arrays["profile_rows"] = (df["missing_reason"] == "NONE").to_numpy() & (arrays["cells"] >= 0)
+    arrays["truth"] = (
+        arrays["profile_rows"]
+        & ~np.isnan(arrays["count"])
+        & ~np.isnan(arrays["dwell"])
+    )
+    arrays["hour"] = ts.dt.hour.fillna(0).to_numpy(dtype=np.int64)
+
+    layers = pd.DataFrame({"layer": LAYER_REASONS, "impute_method": IMPUTE_METHODS[1:]})
+    frames: List[dict] = []
+    if lane_metadata is not None or ml_model is not None:
+        # layered output without hidden gaps, which the frame layers start from
+        base_arrays = {name: arrays[name] for name in LAYER_INPUTS}
+        base_arrays["count"] = arrays["count"].copy()
+        base_arrays["dwell"] = arrays["dwell"].copy()
+        method = impute_layers(**base_arrays)
+        base = df.assign(
+            count_imputed=base_arrays["count"],
+            dwell_imputed=base_arrays["dwell"],
+            impute_method=np.asarray(IMPUTE_METHODS, dtype=object)[method],
+        )
+        train_start, train_end = train_window(df, train_start, train_end)
+        held_out = arrays["truth"] & ((ts < utc_timestamp(train_start)) | (ts >= utc_timestamp(train_end))).to_numpy()
+        frames = frame_layers(
+            base, held_out, train_start, train_end,
+            lane_metadata=lane_metadata, scale_cache_dir=scale_cache_dir,
+            ml_model=ml_model, ml_model_dir=ml_model_dir,
+            intersection_id=intersection_id, workers=workers,
+        )
+        extra = pd.DataFrame({"layer": [f["name"] for f in frames], "impute_method": [f["method"] for f in frames]})
+        layers = pd.concat([layers, extra], ignore_index=True)
+        print(f"Frame layers trained on [{train_start}, {train_end}), gaps hidden outside it.")
+
+    n_layers = len(layers)
+    n_sensors = len(sensor_ids)
+    max_gap = max(GAP_LENGTHS[name][1] for name in LAYER_REASONS + [f["name"] for f in frames])
+    args = (seed, gaps_per_sensor, n_sensors, max_gap, n_layers)
+    engine_trials = [t for t in range(n_trials) if t % n_layers < len(LAYER_REASONS)]
+
+    if workers > 1 and len(engine_trials) > 1:
+        chunks = [engine_trials[i::workers] for i in range(min(workers, len(engine_trials)))]
+        specs, blocks = share_arrays(arrays)
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(trial_worker, [specs] * len(chunks), chunks, *[[a] * len(chunks) for a in args]))
+        finally:
+            release_blocks(blocks)
+    else:
+        results = [evaluate_trial(arrays, t, *args) for t in engine_trials]
+
+    for t in range(n_trials):
+        if t % n_layers >= len(LAYER_REASONS):
+            frame_layer = frames[t % n_layers - len(LAYER_REASONS)]
+            results.append(evaluate_frame_trial(base, arrays, frame_layer, t, *args))
+    total = sum_results(results)
+
+    return {
+        "by_layer": metrics_table(total["layer"], layers),
+        "by_gap_length": metrics_table(total["gap_length"], layer_keys(layers, np.arange(1, max_gap + 1), "gap_length")),
+        "by_sensor": metrics_table(total["sensor"], layer_keys(layers, np.asarray(sensor_ids, dtype=str), "sensor_id")),
+        "by_hour": metrics_table(total["hour"], layer_keys(layers, np.arange(24), "hour")),
+    }
+
+
+def run_imputation_validation(
+    input_path: str | Path,
+    output_dir: str | Path,
+    n_trials: int = 30,
+    gaps_per_sensor: int = 100,
+    workers: int = 1,
+    seed: int = 42,
+    start=None,
+    end=None,
+    sensor_ids: List[str] | None = None,
+    lane_metadata: str | Path | None = None,
+    scale_cache_dir: str | Path | None = None,
+    ml_model: str | None = None,
+    ml_model_dir: str | Path | None = None,
+    intersection_id: str | None = None,
+    train_start=None,
+    train_end=None,
+) -> Dict[str, Path]:
+    """
+    Validate the imputation layers on a cleaned traffic file and save the
+    metric tables as CSV. Lane scales and ML models are cached in
+    `lane_scales/` and `models/` of `output_dir` unless given;
+    `intersection_id` defaults to the input file name prefix.
+    """
+    output_dir = Path(output_dir)
+    if scale_cache_dir is None:
+        scale_cache_dir = output_dir / "lane_scales"
+    if ml_model_dir is None:
+        ml_model_dir = output_dir / "models"
+    if intersection_id is None:
+        intersection_id = Path(input_path).name.split("_")[0]
+
+    df = load_clean_traffic(input_path, start=start, end=end, sensor_ids=sensor_ids)
+    tables = validate_imputation(
+        df,
+        n_trials=n_trials,
+        gaps_per_sensor=gaps_per_sensor,
+        workers=workers,
+        seed=seed,
+        lane_metadata=lane_metadata,
+        scale_cache_dir=scale_cache_dir,
+        ml_model=ml_model,
+        ml_model_dir=ml_model_dir,
+        intersection_id=intersection_id,
+        train_start=train_start,
+        train_end=train_end,
+    )
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    paths = {}
+    for name, table in tables.items():
+        paths[name] = output_dir / f"imputation_validation_{name}.csv"
+        table.to_csv(paths[name], index=False)
+
+    print("Imputation validation finished.")
+    print(f"Input: {input_path}")
+    print(f"Trials: {n_trials}, gaps per sensor and trial: {gaps_per_sensor}")
+    print(tables["by_layer"].to_string(index=False))
+    print(f"Saved tables to: {output_dir}")
+    return paths